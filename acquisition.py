@@ -55,7 +55,6 @@ from __future__ import absolute_import
 #    import sys
 #    sys.path.insert(1,'/home/leon/Software/magpy-git/')
 
-import threading
 import sys, getopt, os
 from datetime import datetime
 
@@ -63,6 +62,8 @@ from datetime import datetime
 ## -----------------------------------------------------------
 from magpy.opt import cred as mpcred
 from core import acquisitionsupport as acs
+from core.mqttspool import MQTTSpool
+from libmqtt import registry
 
 ## Import specific MARTAS packages
 ## -----------------------------------------------------------
@@ -103,9 +104,9 @@ hostname = socket.gethostname()
 msgcount = 0
 
 
-SUPPORTED_PROTOCOLS = ['Env','Ow','Lemi','Arduino','GSM90','GSM19','Cs','POS1','MySQL','Lm','Lnm','BM35','Test','GP20S3','Active','ActiveArduino','DSP','Disdro','ad7714','cr1000jc','GIC'] # should be provided by MagPy
+SUPPORTED_PROTOCOLS = registry.supported()
 """
-Protocol types:
+Protocol types (see libmqtt/registry.py for mode, python versions and capabilities):
 ok		Env   		: py2,py3	: passive		: environment
 ok		Ow		: py2 		: active (group)	: environment
 ok		Arduino		: py2,py3	: passive (group)	: environment
@@ -118,10 +119,8 @@ written (time test missing)GSM19: py2		: passive 		: mag
 ok	 	Cs		: py2,py3	: passive 		: mag
 -	   	PalmDac 	: 		: passive		: mag
 ok		MySQL		: py2		: active (group)	: general db call
--	        Active		:		: active		: general active call
 current work	CR1000		: py2		: active		: all
 ok 		Test 	  	: py2		: active                : random number
-ok		Lnm		: py2		: active 		: environment
 ok		Disdro		: py2		: active 		: environment
 ok              AD7714          : py2 		: autonomous		: general ADC
 """
@@ -133,10 +132,8 @@ def SendInit(confdict,sensordict):
     """
     pass
 
-def do_every (interval, worker_func, iterations = 0):
-    if iterations != 1:
-        threading.Timer(interval,do_every, [interval, worker_func, 0 if iterations == 0 else iterations-1]).start ()
-    worker_func()
+# Central scheduler for all active sensors - created in main
+scheduler = None
 
 def ActiveThread(confdict,sensordict, mqttclient, activeconnections):
     """
@@ -151,23 +148,12 @@ def ActiveThread(confdict,sensordict, mqttclient, activeconnections):
     protocolname = sensordict.get('protocol')
     log.msg("  -> Importing protocol {}".format(protocolname))
 
-    protlst = [activeconnections[key] for key in activeconnections]
-    amount = protlst.count(protocolname) + 1 # Load existing connections (new amount is len(exist)+1)
-    #amount = 1                           # Load existing connections (new amount is len(exist)+1)
     if protocolname in SUPPORTED_PROTOCOLS:
-        importstr = "from libmqtt.{}protocol import {}Protocol as {}Prot{}".format(protocolname.lower(),protocolname,protocolname,amount)
-        if confdict.get('debug') == 'True':
-            log.msg("DEBUG -> Importstring looks like: {}".format(importstr))
-
-        evalstr = "{}Prot{}(mqttclient,sensordict, confdict)".format(protocolname,amount)
-        exec (importstr)
-        protocol = eval(evalstr)
-        log.msg(evalstr)
+        protocol = registry.create(protocolname, mqttclient, sensordict, confdict)
     else:
         log.msg("  -> did not find protocol in SUPPORTED_PROTOCOL list")
 
     log.msg("  -> Starting active thread ...")
-    proto = "{}Prot{}".format(protocolname,amount)
 
     try:
         rate = int(sensordict.get('rate'))
@@ -176,7 +162,7 @@ def ActiveThread(confdict,sensordict, mqttclient, activeconnections):
         log.msg("  -> did not find appropriate sampling rate - using 30 sec")
         rate = 30
 
-    do_every(rate, protocol.sendRequest)
+    scheduler.add(sensorid, rate, protocol.sendRequest, group=protocolname)
 
     activeconnection = {sensorid: protocolname}
     log.msg("  -> active connection established ... sampling every {} sec".format(rate))
@@ -194,16 +180,8 @@ def PassiveThread(confdict,sensordict, mqttclient, establishedconnections):
     log.msg("Starting PassiveThread for {}".format(sensorid))
     protocolname = sensordict.get('protocol')
     log.msg("  -> Found protocol {}".format(protocolname))
-    protlst = [establishedconnections[key] for key in establishedconnections]
-    amount = protlst.count(protocolname) + 1 # Load existing connections (new amount is len(exist)+1)
-    #amount = 1                           # Load existing connections (new amount is len(exist)+1)
     if protocolname in SUPPORTED_PROTOCOLS:
-        importstr = "from libmqtt.{}protocol import {}Protocol as {}Prot{}".format(protocolname.lower(),protocolname,protocolname,amount)
-        if confdict.get('debug') == 'True':
-            log.msg("DEBUG  -> Importstring looks like: {}".format(importstr))
-        evalstr = "{}Prot{}(mqttclient,sensordict, confdict)".format(protocolname,amount)
-        exec(importstr)
-        protocol = eval(evalstr)
+        protocol = registry.create(protocolname, mqttclient, sensordict, confdict)
 
     port = confdict['serialport']+sensordict.get('port')
     log.msg("  -> Connecting to port {} ...".format(port)) 
@@ -223,16 +201,8 @@ def AutoThread(confdict,sensordict, mqttclient, establishedconnections):
     log.msg("Starting AutoThread for {}".format(sensorid))
     protocolname = sensordict.get('protocol')
     log.msg("  -> Found protocol {}".format(protocolname))
-    protlst = [establishedconnections[key] for key in establishedconnections]
-    amount = protlst.count(protocolname) + 1 # Load existing connections (new amount is len(exist)+1)
-    #amount = 1                           # Load existing connections (new amount is len(exist)+1)
     if protocolname in SUPPORTED_PROTOCOLS:
-        importstr = "from libmqtt.{}protocol import {}Protocol as {}Prot{}".format(protocolname.lower(),protocolname,protocolname,amount)
-        if confdict.get('debug') == 'True':
-            log.msg("DEBUG  -> Importstring looks like: {}".format(importstr))
-        evalstr = "{}Prot{}(mqttclient,sensordict, confdict)".format(protocolname,amount)
-        exec(importstr)
-        protocol = eval(evalstr)
+        protocol = registry.create(protocolname, mqttclient, sensordict, confdict)
 
     autoconnection = {sensorid: protocolname}
     log.msg("  ->  autonomous connection established")
@@ -326,6 +296,10 @@ def main(argv):
     mqttport = int(conf.get('mqttport'))
     mqttdelay = int(conf.get('mqttdelay'))
 
+    ##  Set flush policy of buffer file writer
+    ##  ----------------------------
+    acs.ConfigureBuffer(conf)
+
     ##  Get Sensor data
     ##  ----------------------------
     sensorlist = acs.GetSensors(conf.get('sensorsconf'))
@@ -384,11 +358,35 @@ def main(argv):
     ## connect to MQTT client
     ##  ----------------------------
     client.on_connect = onConnect
+    client.on_disconnect = onDisconnect
+
+    ## spool data messages on disk while the broker is not reachable
+    ##  ----------------------------
+    spooldir = conf.get('spooldirectory','')
+    if not spooldir in ['','-',None,'None']:
+        try:
+            client = MQTTSpool(client, spooldir, maxsize=int(float(conf.get('spoolmaxsize',100))*1000000), rate=float(conf.get('spoolrate',50)))
+            log.msg("  -> Spooling unsent data to {}".format(spooldir))
+        except Exception as e:
+            log.msg("  -> Could not initialize spool directory {}: {}".format(spooldir, e))
     try:
         client.connect(broker, mqttport, mqttdelay)
         client.loop_start()
     except:
         log.msg("Critical error - no network connection available during startup or mosquitto server not running - check whether data is recorded")
+        if isinstance(client, MQTTSpool):
+            # keep trying in the background - data is spooled meanwhile
+            client.connect_async(broker, mqttport, mqttdelay)
+            client.loop_start()
+
+    ## Scheduler for active sensors
+    ##  ----------------------------
+    global scheduler
+    try:
+        groupconcurrency = int(conf.get('protocolconcurrency'))
+    except:
+        groupconcurrency = None
+    scheduler = acs.ActiveScheduler(workers=int(conf.get('schedulerworkers',4)), groupconcurrency=groupconcurrency, reportinterval=float(conf.get('schedulerreport',3600)))
 
     establishedconnections = {}
     ## Connect to serial port (sensor dependency) -> returns publish 
@@ -443,6 +441,11 @@ def main(argv):
 
         sensorid = sensor.get('sensorid')
 
+    # Start requesting data from active sensors
+    if len(scheduler.jobs) > 0:
+        log.msg("acquisition: Starting scheduler for {} active sensors".format(len(scheduler.jobs)))
+        scheduler.start()
+
     # Start all passive clients
     if passive_count > 0:
         log.msg("acquisition: Starting reactor for passive sensors. Sending data now ...")
@@ -19,6 +19,13 @@ from acquisitionsupport import GetConf2 as GetConf2
 import getopt
 import pwd
 import socket
+import glob
+import json
+import time
+from multiprocessing import Pool
+import numpy as np
+
+workerdb = None
 
 
 """
@@ -55,6 +62,17 @@ sensordict      :    Sensor1:depth,format,writeDB,writeArchive,applyFlags,cleanr
 # Sensors present in path to be skipped (Begging of Sensorname is enough
 blacklist       :    BLV,QUAKES,Sensor2,Sensor3,
 
+# DataIDs are archived in parallel by this amount of processes (each with its own DB connection)
+workers         :    1
+
+# Each day is read from the database in chunks of chunkhours (use e.g. 6 for shorter queries on high resolution tables).
+# This is no memory limit: the complete day is kept in memory and written once.
+chunkhours      :    24
+
+# Table modification times after the last run - days with up to date archive files are skipped
+# (default: archive-state.json in path)
+#statepath       :    /srv/archive/archive-state.json
+
 
 
 DESCRIPTION:
@@ -210,6 +228,307 @@ def validtimerange(timetuple, mintime, maxtime, debug=False):
         print ("  Found invalid time range")
     return False
 
+def getupdatetimes(db):
+    """
+    DESCRIPTION
+        last modification of all tables (UPDATE_TIME from table metadata).
+        Not available for all storage engines and versions - such tables are
+        missing in the returned dictionary
+    """
+    updatetimes = {}
+    if not db:
+        return updatetimes
+    sql = "SELECT TABLE_NAME, UPDATE_TIME FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE()"
+    try:
+        cursor = db.cursor()
+        cursor.execute(sql)
+        for name, updatetime in cursor.fetchall():
+            if updatetime:
+                updatetimes[name] = str(updatetime)
+        cursor.close()
+    except:
+        print ("   Could not read table metadata")
+    return updatetimes
+
+
+def readstate(path):
+    """
+    DESCRIPTION
+        read the table modification times recorded after the last run
+    """
+    try:
+        with open(path,'r') as fh:
+            return json.load(fh)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def writestate(path, state):
+    try:
+        tmppath = path+'.tmp'
+        with open(tmppath,'w') as fh:
+            json.dump(state, fh)
+        os.rename(tmppath, path)
+    except (IOError, OSError) as e:
+        print ("   Could not write state file {}: {}".format(path, e))
+
+
+def chunktimes(starttime, endtime, chunkhours=24):
+    """
+    DESCRIPTION
+        split a time range into chunks of chunkhours. The end of each chunk
+        (except the last one) is one microsecond before the begin of the next
+    """
+    starttime = DataStream()._testtime(starttime)
+    endtime = DataStream()._testtime(endtime)
+    step = timedelta(hours=chunkhours)
+    chunks = []
+    current = starttime
+    while current + step < endtime:
+        chunks.append((current, current + step - timedelta(microseconds=1)))
+        current = current + step
+    chunks.append((current, endtime))
+    return chunks
+
+
+def archiveuptodate(archivepath, datainfoid, day, lastmod, statelastmod):
+    """
+    DESCRIPTION
+        True if an archive file for day exists, which has been written after
+        the last modification of the table. If the table has not been
+        modified since the last run (statelastmod), any existing file is up to date.
+    """
+    if not archivepath or not lastmod:
+        return False
+    files = glob.glob(os.path.join(archivepath, "{}_{}*".format(datainfoid, day)))
+    if not files:
+        return False
+    if lastmod == statelastmod:
+        return True
+    filetime = datetime.fromtimestamp(max([os.path.getmtime(f) for f in files]))
+    return filetime > DataStream()._testtime(lastmod)
+
+
+def concatenatearrays(arrays):
+    """
+    DESCRIPTION
+        combine the ndarrays of several DataStreams (e.g. chunks of a day)
+        into a single ndarray. Columns missing in a chunk are filled with
+        NaN (numerical keys) or empty strings. Columns of the chunks are
+        released while combining, so that the day is not held twice.
+    """
+    if len(arrays) == 1:
+        return arrays[0]
+    lengths = [len(ar[0]) for ar in arrays]
+    result = []
+    for idx, key in enumerate(KEYLIST):
+        cols = [ar[idx] if idx < len(ar) else np.asarray([]) for ar in arrays]
+        if all(len(col) == 0 for col in cols):
+            result.append(np.asarray([]))
+            continue
+        fill = np.nan if key in NUMKEYLIST else ''
+        cols = [np.asarray(col) if len(col) == lengths[i] else np.asarray([fill]*lengths[i]) for i, col in enumerate(cols)]
+        result.append(np.concatenate(cols))
+        cols = None
+        for ar in arrays:
+            if idx < len(ar) and ar.ndim == 1:
+                ar[idx] = np.asarray([])
+    return np.asarray(result, dtype=object)
+
+
+def initworker(cred):
+    """
+    DESCRIPTION
+        initialize a worker process of the archive pool with its own database connection
+    """
+    global workerdb
+    workerdb = connectDB(cred, exitonfailure=False, report=False)
+
+
+def archivetask(task):
+    """
+    DESCRIPTION
+        archive a single DataID - runs in a worker process (see initworker)
+    RETURNS
+        statusname, message, DataID, timing dictionary
+    """
+    data = task[0]
+    hostname = task[7]
+    name = "{}-archiving-{}".format(hostname,data.replace("_","-"))
+    start = time.time()
+    try:
+        msg, timing = archivedataid(*task[:7], debug=task[8])
+    except Exception as e:
+        print (" Archiving {} failed: {}".format(data, e))
+        msg, timing = "failure: {}".format(e), {}
+    timing['total'] = time.time()-start
+    return name, msg, data, timing
+
+
+def archivedataid(data, times, config, startdate='', obsdepth=0, lastmod=None, statelastmod=None, debug=False):
+    """
+    DESCRIPTION
+        archive a DataID day by day. Each day is read from the database in
+        chunks of 'chunkhours' hours (shorter queries) and the chunks are
+        written to the archive file at once. chunkhours does not limit the
+        memory - the complete day is kept before writing.
+        Days whose archive file is newer than the last modification of the
+        table are skipped.
+    RETURNS
+        message (None if no data exists for the selected days), timing dictionary
+    """
+    global workerdb
+    db = workerdb
+    sr = 1
+    datainfoid = ''
+    archivepath = None
+    timing = {'read':0.0, 'flag':0.0, 'write':0.0, 'clean':0.0, 'chunks':0, 'skipped':0}
+    print (" ---------------------------- ")
+    print (" Checking data set {}".format(data))
+    msg = "checking"
+    if debug:
+        print ("  Times: {}".format(times))
+    # TODO create a warning if mintime is much younger as it should be after cleaning
+
+    if not db: # check whether db is still connected
+        print ("    Lost DB - reconnecting ...")
+        db = connectDB(config.get('credentials'), exitonfailure=False, report=False)
+        workerdb = db
+
+    para = [config.get('defaultdepth'), config.get('archiveformat'),config.get('writearchive'),config.get('applyflags'), config.get('cleandb'),config.get('cleanratio')]
+    # Get default parameter from config
+    depth,fo,wa,af,cdb,ratio = getparameter(para)
+    writemode = config.get('writemode','replace')
+    try:
+        chunkhours = float(config.get('chunkhours',24))
+    except (TypeError, ValueError):
+        chunkhours = 24
+
+    # Modify parameters if DataID specifications are give
+    for sensd in config.get('sensordict',{}):
+        if data.find(sensd) >= 0:
+            print ("  Found data specific parameters for sensorgroup {}:".format(sensd)) 
+            para = config.get('sensordict').get(sensd)
+            depth,fo,wa,af,cdb,ratio = getparameter(para)
+            print ("   -> {}".format(para))
+
+    # Manual specifications
+    if obsdepth:
+        print ("  Overriding configuration file data with manual specifications - new depth = {}".format(obsdepth)) 
+        depth = obsdepth
+
+    # Create datelist (needs to be sorted)
+    dateslist = createDatelist(startdate=startdate, depth=depth, debug=debug)
+
+    # check time range
+    try:
+        # This method might fail if datainfodict does not contain dates - in this case just proceed with normal analysis
+        gettrstate = validtimerange(dateslist, times.get('mintime'), times.get('maxtime'))
+    except:
+        print ("   -> Could not extract time ranges from datainfo dictionary")
+        gettrstate = True
+
+    if not gettrstate:
+        print ("  Apparently no data is existing for the seleceted days - skipping")
+        return None, timing
+
+    path = config.get('path')
+    if path:
+        # archive path from database meta information - required for skipping up to date days
+        try:
+            header = dbfields2dict(db,data)
+            archivepath = os.path.join(path,header['StationID'],header['SensorID'],data)
+        except:
+            archivepath = None
+
+    for tup in dateslist:
+        if debug:
+            print ("  Running for range", tup)
+        if archiveuptodate(archivepath, data, tup[0], lastmod, statelastmod):
+            print ("  Archive file of {} for {} is newer than the last table modification - skipping".format(data, tup[0]))
+            timing['skipped'] += 1
+            datainfoid = data
+            msg = "successfully finished"
+            continue
+        arrays = []
+        header = {}
+        for chunkstart, chunkend in chunktimes(tup[0], tup[1], chunkhours):
+            if debug:
+                print ("  Reading data from DB ...")
+            t0 = time.time()
+            stream = readDB(db,data,starttime=chunkstart,endtime=chunkend)
+            timing['read'] += time.time()-t0
+            timing['chunks'] += 1
+            if debug:
+                print ("    -> Done ({} data points)".format(stream.length()[0]))
+            if stream.length()[0] > 0:
+                arrays.append(stream.ndarray)
+                header = stream.header
+            stream = None
+
+        # Data found
+        if not arrays:
+            print ("No data between {} and {}".format(tup[0],tup[1]))
+            msg = "successfully finished"
+            continue
+        # the chunks are combined and each day file is written once
+        stream = DataStream([], header, concatenatearrays(arrays))
+        arrays = []
+        if not num2date(max(stream.ndarray[0])).replace(tzinfo=None) < datetime.utcnow().replace(tzinfo=None):
+            print ("  Found in-appropriate date in stream - maxdate = {} - cutting off".format(num2date(max(stream.ndarray[0]))))
+            stream = stream.trim(endtime=datetime.utcnow())
+        print ("  Archiving {} data from {} to {}".format(data,tup[0],tup[1]))
+        sr = stream.samplingrate()
+        print ("   with sampling period {} sec".format(sr))
+        if isnan(sr):
+            print ("Please take care - could not extract sampling rate - will assume 60 seconds")
+            sr = 60
+
+        if path:
+            #construct archive path
+            try:
+                sensorid = stream.header['SensorID']
+                stationid = stream.header['StationID']
+                datainfoid = stream.header['DataID']
+                archivepath = os.path.join(path,stationid,sensorid,stream.header['DataID'])
+            except:
+                print ("  Obviously a problem with insufficient header information")
+                print ("  - check StationID, SensorID and DataID in DB")
+                archivepath = None
+
+        if af and sr > 0.9:
+            print ("You selected to apply flags and save them along with the cdf archive.")
+            t0 = time.time()
+            flaglist = db2flaglist(db,sensorid=stream.header['SensorID'],begin=tup[0],end=tup[1])
+            if len(flaglist) > 0:
+                print ("  Found {} flags in database for the selected time range - adding them to the archive file".format(len(flaglist)))
+                stream = stream.flag(flaglist)
+            timing['flag'] += time.time()-t0
+
+        if not debug and wa and archivepath:
+            t0 = time.time()
+            stream.write(archivepath,filenamebegins=datainfoid+'_',format_type=fo,mode=writemode)
+            timing['write'] += time.time()-t0
+        else:
+            print ("   Debug: skip writing")
+            print ("    -> without debug a file with {} inputs would be written to {}".format(stream.length()[0],archivepath))
+        stream = None
+        msg = "successfully finished"
+
+    if not debug and cdb and not datainfoid == '':
+        print ("Now deleting old entries in database older than {} days".format(sr*ratio))
+        # TODO get coverage before
+        t0 = time.time()
+        dbdelete(db,datainfoid,samplingrateratio=ratio)
+        timing['clean'] = time.time()-t0
+        # TODO get coverage after
+    else:
+        print ("   Debug: skip deleting DB")
+        print ("    -> without debug all entries older than {} days would be deleted".format(sr*ratio))
+
+    return msg, timing
+
+
 def main(argv):
     version = "1.0.0"
     conf = ''
@@ -305,125 +624,54 @@ def main(argv):
 
     datainfoiddict = gettingDataDictionary(db,sql,debug=False)
 
+    try:
+        workers = max(1,int(config.get('workers',1)))
+    except (TypeError, ValueError):
+        workers = 1
+    statepath = config.get('statepath','')
+    if not statepath:
+        statepath = os.path.join(config.get('path','/tmp'), 'archive-state.json')
+    state = readstate(statepath)
+    updatetimes = getupdatetimes(db)
+
+    tasks = []
     for data in datainfoiddict:
-        sr = 1
-        datainfoid = ''
-        print (" ---------------------------- ")
-        print (" Checking data set {}".format(data))
-        name = "{}-archiving-{}".format(hostname,data.replace("_","-"))
-        msg = "checking"
-        if debug:
-            print ("  Times: {}".format(datainfoiddict.get(data)))
-        # TODO create a warning if mintime is much younger as it should be after cleaning
-
         if obssenslist and not data in obssenslist:
-            print ("  Not in observers specified dataid list - this DataID will be skipped")
+            print (" Not in observers specified dataid list - {} will be skipped".format(data))
             continue
-
-        if not db: # check whether db is still connected
-            print ("    Lost DB - reconnecting ...")
-            db = connectDB(config.get('credentials'), exitonfailure=False, report=False)
-
-        para = [config.get('defaultdepth'), config.get('archiveformat'),config.get('writearchive'),config.get('applyflags'), config.get('cleandb'),config.get('cleanratio')]
-        # Get default parameter from config
-        depth,fo,wa,af,cdb,ratio = getparameter(para)
-        writemode = config.get('writemode','replace')
-
-        # Modify parameters if DataID specifications are give
-        for sensd in config.get('sensordict',{}):
-            if data.find(sensd) >= 0:
-                print ("  Found data specific parameters for sensorgroup {}:".format(sensd)) 
-                para = config.get('sensordict').get(sensd)
-                depth,fo,wa,af,cdb,ratio = getparameter(para)
-                print ("   -> {}".format(para))
-
-        # Manual specifications
-        if obsdepth:
-            print ("  Overriding configuration file data with manual specifications - new depth = {}".format(obsdepth)) 
-            depth = obsdepth
-
-        # Create datelist (needs to be sorted)
-        dateslist = createDatelist(startdate=startdate, depth=depth, debug=debug)
-
-        # check time range
+        lastmod = updatetimes.get(data)
+        if testbool(config.get('applyflags')) and updatetimes.get('FLAGS'):
+            lastmod = max(lastmod, updatetimes.get('FLAGS')) if lastmod else None
+        tasks.append((data, datainfoiddict.get(data), config, startdate, obsdepth, lastmod, state.get(data), hostname, debug))
+
+    results = []
+    if workers > 1 and len(tasks) > 1:
+        print ("  Archiving {} DataIDs using {} processes".format(len(tasks), workers))
+        pool = Pool(processes=workers, initializer=initworker, initargs=(config.get('credentials'),))
         try:
-            # This method might fail if datainfodict does not contain dates - in this case just proceed with normal analysis
-            gettrstate = validtimerange(dateslist, datainfoiddict.get(data).get('mintime'), datainfoiddict.get(data).get('maxtime'))
-        except:
-            print ("   -> Could not extract time ranges from datainfo dictionary")
-            gettrstate = True
-
-        if not gettrstate:
-            print ("  Apparently no data is existing for the seleceted days - skipping")
-            continue
-
-        # run the following in a daily manner? to save memory... check
-        for tup in dateslist:
-            if debug:
-                print ("  Running for range", tup)
-            stream = DataStream()
-            #tup = (day,nextday)
-            if debug:
-                print ("  Reading data from DB ...")
-            stream = readDB(db,data,starttime=tup[0],endtime=tup[1])
-            if debug:
-                print ("    -> Done ({} data points)".format(stream.length()[0]))
-
-            # Data found
-            if stream.length()[0] > 0:
-                dataidnum = stream.header.get('DataID')
-                if not num2date(max(stream.ndarray[0])).replace(tzinfo=None) < datetime.utcnow().replace(tzinfo=None):
-                    print ("  Found in-appropriate date in stream - maxdate = {} - cutting off".format(num2date(max(stream.ndarray[0]))))
-                    stream = stream.trim(endtime=datetime.utcnow())
-                print ("  Archiving {} data from {} to {}".format(data,tup[0],tup[1]))
-                sr = stream.samplingrate()
-                print ("   with sampling period {} sec".format(sr))
-                if isnan(sr):
-                    print ("Please take care - could not extract sampling rate - will assume 60 seconds")
-                    sr = 60
-
-                path = config.get('path')
-
-                if path:
-                    #construct archive path
-                    try:
-                        sensorid = stream.header['SensorID']
-                        stationid = stream.header['StationID']
-                        datainfoid = stream.header['DataID']
-                        archivepath = os.path.join(path,stationid,sensorid,stream.header['DataID'])
-                    except:
-                        print ("  Obviously a problem with insufficient header information")
-                        print ("  - check StationID, SensorID and DataID in DB")
-                        archivepath = None
-
-                if af and sr > 0.9:
-                    print ("You selected to apply flags and save them along with the cdf archive.")
-                    flaglist = db2flaglist(db,sensorid=stream.header['SensorID'],begin=tup[0],end=tup[1])
-                    if len(flaglist) > 0:
-                        print ("  Found {} flags in database for the selected time range - adding them to the archive file".format(len(flaglist)))
-                        stream = stream.flag(flaglist)
-
-                if not debug and wa and archivepath:
-                    stream.write(archivepath,filenamebegins=datainfoid+'_',format_type=fo,mode=writemode)
-                else:
-                    print ("   Debug: skip writing")
-                    print ("    -> without debug a file with {} inputs would be written to {}".format(stream.length()[0],archivepath))
-
-                #msg = "successfully finished"
-            else:
-                print ("No data between {} and {}".format(tup[0],tup[1]))
-            msg = "successfully finished"
-
-        if not debug and cdb and not datainfoid == '':
-                    print ("Now deleting old entries in database older than {} days".format(sr*ratio))
-                    # TODO get coverage before
-                    dbdelete(db,datainfoid,samplingrateratio=ratio)
-                    # TODO get coverage after
-        else:
-                    print ("   Debug: skip deleting DB")
-                    print ("    -> without debug all entries older than {} days would be deleted".format(sr*ratio))
-
-        statusmsg[name] = msg
+            results = pool.map(archivetask, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        global workerdb
+        workerdb = db
+        results = [archivetask(task) for task in tasks]
+
+    print (" ---------------------------- ")
+    print (" Timing (seconds):")
+    for name, msg, data, timing in results:
+        if not msg is None:
+            statusmsg[name] = msg
+        print ("  {}: {}".format(data, ", ".join(["{} {:.1f}".format(key, timing[key]) if isinstance(timing[key],float) else "{} {}".format(key, timing[key]) for key in sorted(timing)])))
+
+    # remember the table modification after this run (cleaning the database modifies the table)
+    updatetimes = getupdatetimes(db)
+    for name, msg, data, timing in results:
+        if msg == "successfully finished" and updatetimes.get(data):
+            state[data] = updatetimes.get(data)
+    if not debug:
+        writestate(statepath, state)
 
     if debug or obssenslist:   #No update of statusmessages if only a selected sensor list is analyzed
         print (statusmsg)
@@ -19,6 +19,14 @@ from dateutil import parser
 from shutil import copyfile
 import subprocess
 import socket
+import json
+import time
+import hashlib
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 
 # Relative import of core methods as long as martas is not configured as package
@@ -144,6 +152,14 @@ defaultdepth           :      2
 # Sensor specific modifications - defaulttimecolumn, offsets by KEY:value pairs
 SENSORID               :      defaulttimecolumn:sectime;sectime:2.3
 
+# Amount of concurrent connections to the remote source
+connections     :      2
+
+# Manifest of fetched and written files - interrupted runs resume from it
+# (default: file_download-<configname>.json in the temporary directory)
+# Entries of files not seen within defaultdepth+1 days are removed.
+#manifest        :      /srv/archive/file_download-janus.json
+
 # Perform as user - uncomment if not used
 # necessary for cron and other root jobs 
 defaultuser     :      cobs
@@ -641,55 +657,155 @@ def CreateTransferList(config={},datelist=[],debug=False):
     return filelist
 
 
-def ObtainDatafiles(config={},filelist=[],debug=False):
+def _destinationpath(localpath,stationid,sensorid, forcelocal=False):
+    if not stationid and not sensorid or forcelocal:
+        destpath = os.path.join(localpath)
+    elif not stationid:
+        destpath = os.path.join(localpath,sensorid,'raw')
+    elif not sensorid:
+        destpath = os.path.join(localpath,stationid.upper())
+    else:
+        destpath = os.path.join(localpath,stationid.upper(),sensorid,'raw')
+    return destpath
+
+
+def _ftpconnect(config={}):
     """
     DESCRIPTION
-        Download data files ane write either to raw directory ot tmp (or to specified folder)
-    ###   2.3 Get selected files and copy them to destination
-    ###
-    ### only if not protocol == '' and localpath
-
-    ### update filelist with new filenamens on local harddisk
+        open a ftp session to the remote source and change to the source directory
+    """
+    import ftplib
+    port = config.get('rmport')
+    address = config.get('rmaddress')
+    if not port == 21:
+        ftp = ftplib.FTP()
+        ftp.connect(address,port)
+    else:
+        ftp = ftplib.FTP(address)
+    ftp.login(config.get('rmuser'),config.get('rmpassword'))
+    ftp.cwd(config.get('source'))
+    return ftp
 
-        What about rsync? -> no need to use create list but requires passwd-less connection
 
-    RETURNS
-        localfilelist (a list with full paths to all files copied to the localfilesystem)
+def _local(config={}):
     """
+    DESCRIPTION
+        True if files are read directly from the local source (no copy)
+    """
+    return config.get('protocol') == '' and config.get('destination') == tempfile.gettempdir()
+
 
+def FetchDatafile(config={},f='',ftp=None,debug=False):
+    """
+    DESCRIPTION
+        Download a single data file and write it either to raw directory or tmp (or to specified folder)
+        ftp: an open ftp session (see _ftpconnect), required for protocol ftp
 
-    # Requires
+    RETURNS
+        destname (full path of the file on the local filesystem)
+    """
     stationid = config.get('stationid')
     # if sensorid is not provided it will be extracted from the filelist
     sensorid = config.get('sensorid')
-    localpath = config.get('rawpath')
     protocol = config.get('protocol')
-    source = config.get('source')
     destination = config.get('destination')
     deleteremote = config.get('deleteremote',False)
     user = config.get('rmuser')
     password = config.get('rmpassword')
     address = config.get('rmaddress')
-    port = config.get('rmport')
     zipping = GetBool(config.get('zipdata'))
     forcelocal = GetBool(config.get('forcedirectory',False))
-    deleteopt = " "
-
-    #filename = config.get('filenamestructure')
-    #dateformat = config.get('dateformat')
-
-    def createdestinationpath(localpath,stationid,sensorid, forcelocal=False):
-            subdir = 'raw'
-            if not stationid and not sensorid or forcelocal:
-                destpath = os.path.join(localpath)
-            elif not stationid:
-                destpath = os.path.join(localpath,sensorid,'raw')
-            elif not sensorid:
-                destpath = os.path.join(localpath,stationid.upper())
-            else:
-                destpath = os.path.join(localpath,stationid.upper(),sensorid,'raw')
-            return destpath
 
+    if _local(config):
+        return f
+
+    if debug:
+        print ("   Accessing file {}".format(f))
+    path = os.path.normpath(f)
+    li = path.split(os.sep)
+    sensid = sensorid
+    if not sensorid and not protocol in ['ftp','FTP']:
+        if len(li) >= 2:
+            sensid = li[-2]
+        if sensid == 'raw' and len(li) >= 3:  # in case an archive raw data structure is loaded
+            sensid = li[-3]
+    elif not sensorid and protocol in ['ftp','FTP']:
+        sensid = f.split('.')[0].rpartition('_')[0]
+
+    destpath = _destinationpath(destination,stationid,sensid,forcelocal=forcelocal)
+
+    destname = os.path.join(destpath,li[-1])
+
+    if not os.path.isdir(destpath):
+        try:
+            os.makedirs(destpath)
+        except OSError:
+            # created in the meantime by another fetch worker
+            pass
+    if debug:
+        print ("   -> write destination (for raw files): {} , {}".format(destpath, li[-1]))
+
+    if protocol in ['ftp','FTP']:
+        fhandle = open(destname, 'wb')
+        ftp.retrbinary('RETR ' + f, fhandle.write)
+        fhandle.close()
+        if deleteremote in [True,'True']:
+            ftp.delete(f)
+    elif protocol in ['scp','SCP']:
+        scptransfer(user+'@'+address+':'+f,destpath,password,timeout=600)
+    elif protocol in ['rsync']:
+        # create a command line string with rsync ### please note,,, rsync requires password less comminuctaion
+        if deleteremote in [True,'True']:
+            deleteopt = " --remove-source-files "
+        else:
+            deleteopt = " "
+        rsyncstring = "rsync -avz -e ssh{}{} {}".format(deleteopt, user+'@'+address+':'+f,destpath)
+        print ("Executing:", rsyncstring)
+        subprocess.call(rsyncstring.split())
+    elif protocol in ['html','HTML']:
+        pass
+    elif protocol in ['']:
+        if not os.path.exists(destname):
+            copyfile(f, destname)
+            if deleteremote in [True,'True']:
+                os.remove(f)
+        else:
+            print ("   -> raw file already existing - skipping write")
+    if zipping:
+        if debug:
+            print (" raw data wil be zipped")
+        dirname = os.path.dirname(destname)
+        oldname = os.path.basename(destname)
+        pname = os.path.splitext(oldname)
+        if not pname[1] in [".zip",".gz",".ZIP",".GZ"]:
+            zipname = pname[0]+'.zip'
+            with zipfile.ZipFile(os.path.join(dirname,zipname), 'w') as myzip:
+                myzip.write(destname,oldname, zipfile.ZIP_DEFLATED)
+            os.remove(destname)
+            destname = os.path.join(dirname,zipname)
+        else:
+            if debug:
+                print (" data is zipped already")
+    return destname
+
+
+def ObtainDatafiles(config={},filelist=[],debug=False):
+    """
+    DESCRIPTION
+        Download data files ane write either to raw directory ot tmp (or to specified folder)
+    ###   2.3 Get selected files and copy them to destination
+    ###
+    ### only if not protocol == '' and localpath
+
+    ### update filelist with new filenamens on local harddisk
+
+        What about rsync? -> no need to use create list but requires passwd-less connection
+
+    RETURNS
+        localfilelist (a list with full paths to all files copied to the localfilesystem)
+    """
+    protocol = config.get('protocol')
+    deleteremote = config.get('deleteremote',False)
 
     print("  Writing data to a local directory (or tmp)")
 
@@ -698,99 +814,251 @@ def ObtainDatafiles(config={},filelist=[],debug=False):
 
     if debug:
         print ("   Please Note: files will be copied to local filesystem even when debug is selected")
-  
-    localpathlist = []
-
-    if not protocol == '' or (protocol == '' and not destination == tempfile.gettempdir()):
-        ### Create a directory by getting sensorid names (from source directory)
-        # Open the specific channel
-        if protocol in ['ftp','FTP']:
-            if not port == 21:
-                ftp = ftplib.FTP()
-                ftp.connect(address,port)
-            else:
-                ftp = ftplib.FTP(address)
-            ftp.login(user,password)
-            ftp.cwd(source)
 
-        for f in filelist:
-            if debug:
-                print ("   Accessing file {}".format(f))
-            path = os.path.normpath(f)
-            li = path.split(os.sep)
-            if not sensorid and not protocol in ['ftp','FTP']:
-                if len(li) >= 2:
-                    sensid = li[-2]
-                if sensid == 'raw' and len(li) >= 3:  # in case an archive raw data structure is loaded
-                    sensid = li[-3]
-            elif not sensorid and protocol in ['ftp','FTP']:
-                sensid = f.split('.')[0].rpartition('_')[0]
-            else:
-                sensid = sensorid
+    localpathlist = []
+    ftp = None
+    if protocol in ['ftp','FTP'] and not _local(config):
+        ftp = _ftpconnect(config)
+    for f in filelist:
+        localpathlist.append(FetchDatafile(config=config,f=f,ftp=ftp,debug=debug))
+    if ftp:
+        ftp.close()
 
-            
-            destpath = createdestinationpath(destination,stationid,sensid,forcelocal=forcelocal)
+    if debug:
+        print ("   => all files are now on local system: {}".format(localpathlist))
 
-            destname = os.path.join(destpath,li[-1])
+    return localpathlist
 
-            if not os.path.isdir(destpath):
-                os.makedirs(destpath)
-            if debug:
-                print ("   -> write destination (for raw files): {} , {}".format(destpath, li[-1]))
 
+class Manifest(object):
+    """
+    DESCRIPTION
+        persistent record of all files handled by the download pipeline.
+        For each remote file the remote size, the local path, the md5 checksum
+        of the local file, the checksum of the last version written to
+        database/archive and the time it was last seen are stored. Changes
+        are written (atomically) every 'flushevery' updates or 'flushinterval'
+        seconds and by flush(), so that an interrupted run can resume.
+        prune() removes entries which have not been seen for some time.
+    """
+    def __init__(self, path, flushevery=50, flushinterval=10.0):
+        self.path = path
+        self.flushevery = int(flushevery)
+        self.flushinterval = float(flushinterval)
+        self.lock = threading.Lock()
+        self.content = {}
+        self.changes = 0
+        self.lastflush = time.time()
+        if path and os.path.isfile(path):
+            try:
+                with open(path,'r') as fh:
+                    self.content = json.load(fh)
+            except (IOError, OSError, ValueError):
+                print ("  Manifest {} not readable - starting a new one".format(path))
+
+    def get(self, name):
+        with self.lock:
+            return dict(self.content.get(name,{}))
+
+    def update(self, name, **kwargs):
+        with self.lock:
+            entry = self.content.setdefault(name,{})
+            entry.update(kwargs)
+            entry['seen'] = time.time()
+            self.changes += 1
+            if self.changes >= self.flushevery or time.time()-self.lastflush >= self.flushinterval:
+                self._write()
+
+    def prune(self, maxage):
+        """
+        DESCRIPTION
+            remove entries not seen within maxage seconds
+        """
+        limit = time.time()-maxage
+        with self.lock:
+            old = [name for name in self.content if self.content[name].get('seen',0) < limit]
+            for name in old:
+                del self.content[name]
+            if old:
+                self.changes += 1
+        return len(old)
+
+    def flush(self):
+        with self.lock:
+            if self.changes > 0:
+                self._write()
+
+    def _write(self):
+        # requires lock
+        if self.path:
+            tmppath = self.path+'.tmp'
+            with open(tmppath,'w') as fh:
+                json.dump(self.content, fh)
+            os.rename(tmppath, self.path)
+        self.changes = 0
+        self.lastflush = time.time()
+
+
+def _md5(path, blocksize=1048576):
+    md5 = hashlib.md5()
+    with open(path,'rb') as fh:
+        for block in iter(lambda: fh.read(blocksize), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+class DownloadPipeline(object):
+    """
+    DESCRIPTION
+        Pipelined replacement of CreateTransferList, ObtainDatafiles and
+        WriteData: file lists are obtained date by date, files are fetched by
+        a bounded pool of workers (each with its own remote session) and
+        written to database/archive by a single writer, all at the same time.
+        Files whose remote size (ftp, local sources) and local copy are
+        unchanged according to the manifest are not fetched again, files
+        whose checksum has already been written are not written again.
+    PARAMETERS
+        config:        checked configuration (see CheckConfiguration)
+        datelist:      see GetDatelist
+        connections:   amount of concurrent fetch workers
+        manifestpath:  path of the json manifest
+        write:         write fetched files to database/archive
+    """
+    def __init__(self, config={}, datelist=[], connections=2, manifestpath=None, write=True, debug=False):
+        self.config = config
+        self.datelist = datelist
+        self.connections = max(1,int(connections))
+        self.manifest = Manifest(manifestpath)
+        self.write = write
+        self.debug = debug
+        self.fetchqueue = queue.Queue(maxsize=100)
+        self.writequeue = queue.Queue()
+        self.lock = threading.Lock()
+        self.localpathlist = []
+        self.stats = {'listed':0, 'fetched':0, 'skipped':0, 'written':0, 'unchanged':0, 'errors':0}
+
+    def run(self):
+        """
+        RETURNS
+            localpathlist (a list with full paths to all local files)
+        """
+        start = time.time()
+        writer = threading.Thread(target=self._writer)
+        writer.start()
+        fetchers = [threading.Thread(target=self._fetcher) for i in range(self.connections)]
+        for fetcher in fetchers:
+            fetcher.start()
+        try:
+            self._lister()
+        finally:
+            for fetcher in fetchers:
+                self.fetchqueue.put(None)
+            for fetcher in fetchers:
+                fetcher.join()
+            self.writequeue.put(None)
+            writer.join()
+            # entries of files older than the download depth are not needed any more
+            try:
+                depth = max(1,int(self.config.get('defaultdepth',2)))
+            except (TypeError, ValueError):
+                depth = 2
+            removed = self.manifest.prune((depth+1)*86400)
+            if self.debug and removed:
+                print ("  Removed {} old entries from the manifest".format(removed))
+            self.manifest.flush()
+        print ("  Download pipeline finished in {:.1f} sec: {}".format(time.time()-start, self.stats))
+        return self.localpathlist
+
+    def _lister(self):
+        protocol = self.config.get('protocol','')
+        dateformat = self.config.get('dateformat')
+        if dateformat in ['','ctime','mtime'] or protocol in ['ftp','FTP']:
+            # a single listing covers all dates
+            chunks = [self.datelist]
+        else:
+            chunks = [[date] for date in self.datelist]
+        listed = set()
+        for chunk in chunks:
+            for f in CreateTransferList(config=self.config,datelist=chunk,debug=self.debug):
+                if not f in listed:
+                    listed.add(f)
+                    self.stats['listed'] += 1
+                    self.fetchqueue.put(f)
+
+    def _remotesize(self, f, ftp):
+        protocol = self.config.get('protocol','')
+        try:
             if protocol in ['ftp','FTP']:
-                fhandle = open(destname, 'wb')
-                ftp.retrbinary('RETR ' + f, fhandle.write)
-                fhandle.close()
-                if deleteremote in [True,'True']:
-                    ftp.delete(f)
-            elif protocol in ['scp','SCP']:
-                scptransfer(user+'@'+address+':'+f,destpath,password,timeout=600)
-            elif protocol in ['rsync']:
-                # create a command line string with rsync ### please note,,, rsync requires password less comminuctaion
-                if deleteremote in [True,'True']:
-                    deleteopt = " --remove-source-files "
-                else:
-                    deleteopt = " "
-                rsyncstring = "rsync -avz -e ssh{}{} {}".format(deleteopt, user+'@'+address+':'+f,destpath)
-                print ("Executing:", rsyncstring)
-                subprocess.call(rsyncstring.split())
-            elif protocol in ['html','HTML']:
-                pass
-            elif protocol in ['']:
-                if not os.path.exists(destname):
-                    copyfile(f, destname)
-                    if deleteremote in [True,'True']:
-                        os.remove(f)
-                else:
-                    print ("   -> raw file already existing - skipping write")
-            if zipping:
-                if debug:
-                    print (" raw data wil be zipped")
-                dirname = os.path.dirname(destname)
-                oldname = os.path.basename(destname)
-                pname = os.path.splitext(oldname)
-                if not pname[1] in [".zip",".gz",".ZIP",".GZ"]:
-                    zipname = pname[0]+'.zip'
-                    with zipfile.ZipFile(os.path.join(dirname,zipname), 'w') as myzip:
-                        myzip.write(destname,oldname, zipfile.ZIP_DEFLATED)
-                    os.remove(destname)
-                    destname = os.path.join(dirname,zipname)
+                return ftp.size(f)
+            elif protocol == '':
+                return os.path.getsize(f)
+        except:
+            pass
+        return None
+
+    def _fetcher(self):
+        protocol = self.config.get('protocol','')
+        ftp = None
+        while True:
+            f = self.fetchqueue.get()
+            if f is None:
+                break
+            try:
+                if protocol in ['ftp','FTP'] and not _local(self.config) and not ftp:
+                    ftp = _ftpconnect(self.config)
+                    ftp.voidcmd('TYPE I')
+                entry = self.manifest.get(f)
+                size = self._remotesize(f, ftp)
+                if size is not None and entry.get('size') == size and entry.get('local') and os.path.isfile(entry.get('local')):
+                    destname = entry.get('local')
+                    checksum = entry.get('md5')
+                    self.manifest.update(f)
+                    with self.lock:
+                        self.stats['skipped'] += 1
+                    if self.debug:
+                        print ("   -> {} unchanged - skipping download".format(f))
                 else:
-                    if debug:
-                        print (" data is zipped already")
-            localpathlist.append(destname)
-
-        if protocol in ['ftp','FTP']:
+                    destname = FetchDatafile(config=self.config,f=f,ftp=ftp,debug=self.debug)
+                    checksum = _md5(destname)
+                    self.manifest.update(f, size=size, local=destname, md5=checksum)
+                    with self.lock:
+                        self.stats['fetched'] += 1
+                with self.lock:
+                    self.localpathlist.append(destname)
+                if self.write:
+                    if entry.get('written') == checksum:
+                        with self.lock:
+                            self.stats['unchanged'] += 1
+                    else:
+                        self.writequeue.put((f, destname, checksum))
+            except Exception as e:
+                print ("   -> fetching {} failed: {}".format(f, e))
+                with self.lock:
+                    self.stats['errors'] += 1
+                if ftp:
+                    try:
+                        ftp.close()
+                    except:
+                        pass
+                    ftp = None
+        if ftp:
             ftp.close()
-    else:
-        localpathlist = [elem for elem in filelist]
-
-    if debug:
-        print ("   => all files are now on local system: {}".format(localpathlist))
-
-    return localpathlist
 
+    def _writer(self):
+        while True:
+            item = self.writequeue.get()
+            if item is None:
+                break
+            f, destname, checksum = item
+            try:
+                WriteData(config=self.config,localpathlist=[destname],debug=self.debug)
+                if not self.debug:
+                    self.manifest.update(f, written=checksum)
+                self.stats['written'] += 1
+            except Exception as e:
+                print ("   -> writing {} failed: {}".format(destname, e))
+                with self.lock:
+                    self.stats['errors'] += 1
 
 
 def WriteData(config={},localpathlist=[],debug=False):
@@ -1075,31 +1343,26 @@ def main(argv):
         # -----------------------
         datelist = GetDatelist(config=config,current=current,debug=debug)
 
-        # Obtain list of files to be transferred
+        # List, fetch and write files in a pipeline
         # -----------------------
-        #try:
-        filelist = CreateTransferList(config=config,datelist=datelist,debug=debug)
-        moveon = True
-        #except:
-        #    statusmsg[name] = 'could not obtain remote file list - aborting'
-        #    moveon = False
-
-        if moveon:
-            # Obtain list of files to be transferred
-            # -----------------------
-            try:
-                localpathlist = ObtainDatafiles(config=config,filelist=filelist,debug=debug)
-            except:
-                statusmsg[name] = 'getting local file list failed - check permission'
-                localpathlist = []
-
-            # Write data to specified destinations
-            # -----------------------
-            #try:
-            if config.get('db') and len(localpathlist) > 0 and (GetBool(config.get('writedatabase')) or GetBool(config.get('writearchive'))):
-                    succ = WriteData(config=config,localpathlist=localpathlist,debug=debug)
-            #except:
-            #    statusmsg[name] = 'problem when writing data'
+        write = config.get('db') and (GetBool(config.get('writedatabase')) or GetBool(config.get('writearchive')))
+        manifestpath = config.get('manifest')
+        if not manifestpath:
+            manifestpath = os.path.join(tempfile.gettempdir(), "file_download-{}.json".format(os.path.split(conf)[1].split('.')[0]))
+        try:
+            connections = int(config.get('connections',2))
+        except (TypeError, ValueError):
+            connections = 2
+        if config.get('deleteremote',False) in [True,'True']:
+            print("  IMPORTANT: deleting remote data has been activated")
+        pipeline = DownloadPipeline(config=config, datelist=datelist, connections=connections, manifestpath=manifestpath, write=write, debug=debug)
+        try:
+            localpathlist = pipeline.run()
+            if pipeline.stats.get('errors',0) > 0:
+                statusmsg[name] = 'getting or writing {} files failed - check permission'.format(pipeline.stats.get('errors'))
+        except:
+            statusmsg[name] = 'getting local file list failed - check permission'
+            localpathlist = []
 
     # Send Logging
     # -----------------------
@@ -11,7 +11,9 @@ DESCRIPTION
 JOBLIST:
    Jobs are listed in a json structure and read by the upload process.
    You can have multiple jobs. Each job refers to a local path. Each job
-   can have multiple destinations.
+   can have multiple destinations. Uploads to different destinations run in
+   parallel. ftp and sftp uploads use one persistent session per worker. Add
+   "concurrency" to a destination to use several workers for it (default 1).
 
 
    {"graphmag" :  {"path":"/home/leon/Tmp/Upload/graph/aut.png",
@@ -53,7 +55,13 @@ import magpy.opt.cred as mpcred
 import io, pickle
 
 import itertools
+import time
+import threading
 from threading import Thread
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 from subprocess import check_output   # used for checking whether send process already finished
 
 import getopt
@@ -90,8 +98,12 @@ def writecurrentdata(path,dic):
     >>> see getcurrentdata
     >>>
     """
-    with open(path, 'w',encoding="utf-8") as file:
+    # write to a temporary file first and rename it, so that the memory is
+    # never left incomplete if the upload process is killed
+    tmppath = path+'.tmp'
+    with open(tmppath, 'w',encoding="utf-8") as file:
         file.write(unicode(json.dumps(dic)))
+    os.rename(tmppath, path)
 
 
 def active_pid(name):
@@ -145,7 +157,9 @@ def uploaddata(localpath, destinationpath, typus='ftp', address='', user='', pwd
                 success = ginupload(localpath, user, pwd, address, stdout=stdout)
             print ("   -> Done GINUPLOAD")
         else:
-            print ("curl is active")
+            # not uploaded - keep the file in the todo list
+            print ("curl is active - skipping upload of {}".format(localpath))
+            success = False
     elif typus == 'test':
            print ("No file transfer - just a test run")
     else:
@@ -378,6 +392,258 @@ def ftptransfer (source, destination, host="yourserverdomainorip.com", user="roo
 
     return transfersuccess
 
+class FTPSession(object):
+    """
+    DEFINITION:
+        persistent ftp session for uploading many files to one destination.
+        Tries FTP_TLS first and falls back to plain FTP if the TLS
+        connection or a transfer via TLS fails (like ftptransfer). The
+        session is reopened once if a transfer fails.
+    """
+    def __init__(self, host, user, password, debug=False):
+        self.host = host
+        self.user = user
+        self.password = password
+        self.debug = debug
+        self.ftp = None
+        self.cwd = None
+        self.plain = False      # True after TLS failed - used for the rest of the session
+
+    def connect(self):
+        self.close()
+        if not self.plain:
+            try:
+                self.ftp = ftplib.FTP_TLS(self.host, self.user, self.password)
+                print ("FTP TLS connection established...")
+            except:
+                self.plain = True
+        if self.plain:
+            self.ftp = ftplib.FTP(self.host, self.user, self.password)
+            print ("FTP connection established...")
+        if self.debug:
+            self.ftp.set_debuglevel(1)
+        self.cwd = None
+
+    def upload(self, source, destination):
+        for attempt in [0,1]:
+            try:
+                if not self.ftp:
+                    self.connect()
+                self._store(source, destination)
+                return True
+            except Exception as e:
+                print ("FTP upload of {} failed: {}".format(source, e))
+                self.close()
+                if not self.plain:
+                    print ("  -> retrying with plain FTP")
+                    self.plain = True
+        return False
+
+    def _store(self, source, destination):
+        filename = os.path.basename(source)
+        if not self.cwd == destination:
+            self.ftp.cwd(destination)
+            self.cwd = destination
+        try:
+            self.ftp.delete(filename)
+        except:
+            pass
+        with open(source, 'rb') as image_file:
+            self.ftp.storbinary('STOR {}'.format(filename), image_file)
+
+    def close(self):
+        if self.ftp:
+            try:
+                self.ftp.quit()
+            except:
+                try:
+                    self.ftp.close()
+                except:
+                    pass
+        self.ftp = None
+        self.cwd = None
+
+
+class SFTPSession(object):
+    """
+    DEFINITION:
+        persistent sftp session (paramiko) for uploading many files to one
+        destination. The session is reopened once if a transfer fails.
+    """
+    def __init__(self, host, user, password, port=22, proxy=None, debug=False):
+        self.host = host
+        self.user = user
+        self.password = password
+        self.port = int(port) if port else 22
+        self.proxy = proxy
+        self.debug = debug
+        self.transport = None
+        self.client = None
+
+    def connect(self):
+        import paramiko
+        self.close()
+        if not self.proxy:
+            self.transport = paramiko.Transport((self.host, self.port))
+        else:
+            import socks
+            s = socks.socksocket()
+            s.set_proxy(proxy_type=socks.SOCKS5, addr=self.proxy[0], port=self.proxy[1])
+            s.connect((self.host,self.port))
+            self.transport = paramiko.Transport(s)
+        self.transport.connect(username=self.user,password=self.password)
+        self.client = paramiko.SFTPClient.from_transport(self.transport)
+
+    def upload(self, source, destination):
+        for attempt in [0,1]:
+            try:
+                if not self.client:
+                    self.connect()
+                self.client.put(source, os.path.join(destination,os.path.basename(source)))
+                return True
+            except Exception as e:
+                print ("SFTP upload of {} failed: {}".format(source, e))
+                self.close()
+        return False
+
+    def close(self):
+        for obj in [self.client, self.transport]:
+            if obj:
+                try:
+                    obj.close()
+                except:
+                    pass
+        self.client = None
+        self.transport = None
+
+
+class UploadEngine(object):
+    """
+    DEFINITION:
+        uploads files to several destinations in parallel.
+        Each destination gets its own task queue served by 'concurrency'
+        workers (default 1, set in the destination dictionary of the job).
+        ftp and sftp workers keep one persistent session each, all other
+        transfer types are handed to uploaddata.
+        After a file has been sent successfully to all destinations of its
+        job, it is added to the memory, which is written atomically.
+    APPLICATION:
+        >>> engine = UploadEngine(sendlogpath, fulldict)
+        >>> engine.add(job, nfile, mtime, [(dest, destdict, credentials), ...])
+        >>> engine.run()
+        >>> engine.report()
+    """
+    def __init__(self, memorypath, memory, debug=False):
+        self.memorypath = memorypath
+        self.memory = memory
+        self.debug = debug
+        self.lock = threading.Lock()
+        self.queues = {}        # destination -> task queue
+        self.settings = {}      # destination -> (destdict, credentials)
+        self.pending = {}       # (job, file) -> amount of open destinations
+        self.failed = set()
+        self.stats = {}         # destination -> list of (bytes, seconds, success)
+        self.runtime = 0.0
+        self.ginlock = threading.Lock()   # curl based gin uploads are run one at a time
+
+    def add(self, job, nfile, mtime, destinations):
+        if not destinations:
+            self.memory.setdefault(job,{})[nfile] = mtime
+            return
+        self.pending[(job,nfile)] = len(destinations)
+        for dest, destdict, credentials in destinations:
+            # jobs sharing credentials and transfer type share a destination queue
+            dest = "{}:{}".format(dest, destdict.get('type'))
+            if not dest in self.queues:
+                self.queues[dest] = queue.Queue()
+                self.settings[dest] = (destdict, credentials)
+                self.stats[dest] = []
+            self.queues[dest].put((job, nfile, mtime, destdict.get('path')))
+
+    def run(self):
+        start = time.time()
+        threads = []
+        for dest in self.queues:
+            destdict, credentials = self.settings[dest]
+            try:
+                concurrency = max(1,int(destdict.get('concurrency',1)))
+            except (TypeError, ValueError):
+                concurrency = 1
+            for i in range(min(concurrency, self.queues[dest].qsize())):
+                thread = threading.Thread(target=self._worker, args=(dest,))
+                thread.start()
+                threads.append(thread)
+        for thread in threads:
+            thread.join()
+        self.runtime = time.time()-start
+
+    def _session(self, dest):
+        destdict, (address, user, passwd, port) = self.settings[dest]
+        typus = destdict.get('type')
+        if typus == 'ftp':
+            return FTPSession(address, user, passwd, debug=self.debug)
+        elif typus == 'sftp':
+            return SFTPSession(address, user, passwd, port=port, proxy=destdict.get('proxy',None), debug=self.debug)
+        return None
+
+    def _worker(self, dest):
+        destdict, (address, user, passwd, port) = self.settings[dest]
+        session = self._session(dest)
+        while True:
+            try:
+                job, nfile, mtime, path = self.queues[dest].get_nowait()
+            except queue.Empty:
+                break
+            print ("    -> Uploading {} to dest {}".format(nfile, dest))
+            start = time.time()
+            if session:
+                success = session.upload(nfile, path)
+            elif destdict.get('type','').startswith('gin'):
+                with self.ginlock:
+                    success = uploaddata(nfile, path, destdict.get('type'), address, user, passwd, port, proxy=destdict.get('proxy',None), logfile=destdict.get('logfile','stdout'))
+            else:
+                success = uploaddata(nfile, path, destdict.get('type'), address, user, passwd, port, proxy=destdict.get('proxy',None), logfile=destdict.get('logfile','stdout'))
+            duration = time.time()-start
+            print ("    -> Success", success)
+            try:
+                size = os.path.getsize(nfile)
+            except OSError:
+                size = 0
+            with self.lock:
+                self.stats[dest].append((size, duration, success))
+            self._done(job, nfile, mtime, success)
+        if session:
+            session.close()
+
+    def _done(self, job, nfile, mtime, success):
+        with self.lock:
+            if not success:
+                # not added to memory - thus it will be retried next time
+                print (" !---> upload of {} not successful: keeping it in todo list".format(nfile))
+                self.failed.add((job,nfile))
+            self.pending[(job,nfile)] -= 1
+            if self.pending[(job,nfile)] == 0 and not (job,nfile) in self.failed:
+                self.memory.setdefault(job,{})[nfile] = mtime
+                writecurrentdata(self.memorypath, self.memory)
+
+    def report(self):
+        """
+        DEFINITION:
+            print throughput and latency for each destination
+        """
+        print ("Upload report (total runtime {:.2f} sec):".format(self.runtime))
+        for dest in sorted(self.stats):
+            stats = self.stats[dest]
+            if not stats:
+                continue
+            durations = [el[1] for el in stats]
+            volume = sum([el[0] for el in stats if el[2]])
+            succeeded = len([el for el in stats if el[2]])
+            total = sum(durations)
+            rate = volume/total/1024. if total > 0 else 0
+            print ("  {}: {} of {} files, {:.1f} kB, mean latency {:.2f} sec, max {:.2f} sec, {:.1f} kB/s".format(dest, succeeded, len(stats), volume/1024., total/len(stats), max(durations), rate))
+
+
 def ginupload(filename, user, password, url, authentication=' --digest ', stdout=True):
     """
     DEFINITION:
@@ -509,19 +775,20 @@ def main(argv):
     """
     Main Prog
     """
+    fulldict = {}
+    if os.path.isfile(sendlogpath):
+        with open(sendlogpath, 'r') as file:
+            fulldict = json.load(file)
+    engine = UploadEngine(sendlogpath, fulldict)
+    name = "FileUploads"
     try:
       for key in workdictionary:
         name = "FileUploads-{}".format(key)
         print ("DEALING with ", key)
-        lastfiles = {}
-        fulldict = {}
-        if os.path.isfile(sendlogpath):
-            with open(sendlogpath, 'r') as file:
-                fulldict = json.load(file)
-                lastfiles = fulldict.get(key)
-                # lastfiles looks like: {'/path/to/my/file81698.txt' : '2019-01-01T12:33:12', ...}
-
-        if not lastfiles == {}:
+        lastfiles = fulldict.get(key,{})
+        # lastfiles looks like: {'/path/to/my/file81698.txt' : '2019-01-01T12:33:12', ...}
+
+        if lastfiles:
             print ("opened memory")
             pass
 
@@ -539,6 +806,7 @@ def main(argv):
 
         print ("Found new: {} and all {}".format(newfiledict, alldic))
 
+        destinations = []
         for dest in workdictionary.get(key).get('destinations'):
             print ("  -> Destination: {}".format(dest))
             address=mpcred.lc(dest,'address')
@@ -546,21 +814,17 @@ def main(argv):
             passwd=mpcred.lc(dest,'passwd')
             port=mpcred.lc(dest,'port')
             destdict = workdictionary.get(key).get('destinations')[dest]
-            proxy = destdict.get('proxy',None)
-            #print (destdict)
-            if address and user and newfiledict:
-                for nfile in newfiledict:
-                    print ("    -> Uploading {} to dest {}".format(nfile, dest))
-                    success = uploaddata(nfile, destdict.get('path'), destdict.get('type'), address, user, passwd, port, proxy=proxy, logfile=destdict.get('logfile','stdout'))
-                    print ("    -> Success", success)
-                    if not success:
-                        #remove nfile from alldic
-                        # thus it will be retried again next time
-                        print (" !---> upload of {} not successful: keeping it in todo list".format(nfile))
-                        del alldic[nfile]
-
-        fulldict[key] = alldic
+            if address and user:
+                destinations.append((dest, destdict, (address, user, passwd, port)))
+
+        # memory of this job: all unchanged files, new files are added when uploaded
+        fulldict[key] = dict([(nfile, alldic[nfile]) for nfile in alldic if not nfile in newfiledict])
+        for nfile in newfiledict:
+            engine.add(key, nfile, alldic[nfile], destinations)
         writecurrentdata(sendlogpath, fulldict)
+
+      engine.run()
+      engine.report()
       statusmsg[name] = "uploading data succesful"
     except:
       statusmsg[name] = "error when uploading files - please check"
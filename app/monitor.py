@@ -34,6 +34,8 @@ from __future__ import unicode_literals
 # ------------------------------------------------------------
 import os, sys, getopt
 import glob
+import time
+import threading
 from datetime import datetime
 import paho.mqtt.client as mqtt
 import json
@@ -42,7 +44,18 @@ from magpy.stream import DataStream
 import magpy.database as mpdb
 import magpy.opt.cred as mpcred
 import numpy as np
-import filecmp, shutil
+import hashlib
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 # Relative import of core methods as long as martas is not configured as package
 scriptpath = os.path.dirname(os.path.realpath(__file__))
@@ -91,6 +104,105 @@ def _latestfile(path, date=False, latest=True):
         return ""
 
 
+def _listdir(path):
+    """
+    DESCRIPTION
+        return names of subdirectories and (name, mtime) of files in path
+        using a single scandir call (listdir and stat for old pythons)
+    """
+    subdirs = []
+    files = []
+    if scandir:
+        for entry in scandir(path):
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(entry.name)
+                elif entry.is_file():
+                    files.append((entry.name, entry.stat().st_mtime))
+            except OSError:
+                pass
+    else:
+        for name in os.listdir(path):
+            fullname = os.path.join(path,name)
+            try:
+                if os.path.isdir(fullname) and not os.path.islink(fullname):
+                    subdirs.append(name)
+                elif os.path.isfile(fullname):
+                    files.append((name, os.path.getmtime(fullname)))
+            except OSError:
+                pass
+    return subdirs, files
+
+
+def _freshnessindex(testpath, statefile=None, excludelist=['archive','products','projects'], debug=False):
+    """
+    DESCRIPTION
+        get the newest file and its modification time for testpath and all
+        subdirectories in one pass. The result of the last run is stored in
+        statefile (json). Directories whose own mtime did not change since
+        then (i.e. no files added or removed) are not listed again - only the
+        previously newest file is checked.
+    RETURNS
+        dictionary {directory: (newestfile, mtime)} for all directories containing files
+    """
+    state = {}
+    if statefile and os.path.isfile(statefile):
+        try:
+            with open(statefile,'r') as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError):
+            state = {}
+    newstate = {}
+    index = {}
+    scanned = 0
+    stack = [testpath]
+    while stack:
+        d = stack.pop()
+        if any([d.find(ex) > -1 for ex in excludelist]):
+            continue
+        try:
+            dmtime = os.stat(d).st_mtime
+        except OSError:
+            continue
+        entry = state.get(d)
+        if entry and entry.get('mtime') == dmtime:
+            latest = entry.get('latest')
+            latestmtime = entry.get('latestmtime')
+            if latest:
+                try:
+                    latestmtime = os.stat(os.path.join(d,latest)).st_mtime
+                except OSError:
+                    entry = None
+        else:
+            entry = None
+        if entry:
+            subdirs = entry.get('subdirs',[])
+        else:
+            try:
+                subdirs, files = _listdir(d)
+            except OSError:
+                continue
+            scanned += 1
+            latest, latestmtime = None, None
+            if files:
+                latest, latestmtime = max(files, key=lambda x: x[1])
+        newstate[d] = {'mtime':dmtime, 'subdirs':subdirs, 'latest':latest, 'latestmtime':latestmtime}
+        if latest:
+            index[d] = (os.path.join(d,latest), latestmtime)
+        stack.extend([os.path.join(d,sub) for sub in subdirs])
+    if debug:
+        print ("Freshness index: listed {} of {} directories".format(scanned, len(newstate)))
+    if statefile:
+        try:
+            tmpfile = statefile+'.tmp'
+            with open(tmpfile,'w') as f:
+                json.dump(newstate, f)
+            os.rename(tmpfile, statefile)
+        except (IOError, OSError) as e:
+            print ("Could not write freshness state file {}: {}".format(statefile, e))
+    return index
+
+
 def GetConf2(path, confdict={}):
     """
     Version 2020-10-28
@@ -192,21 +304,22 @@ def _testJobs(joblist, allowedjobs):
     return joblist
 
 
-def CheckMARTAS(testpath='/srv', threshold=600, jobname='JOB', statusdict={}, ignorelist=[], thresholddict={}, debug=False):
+def CheckMARTAS(testpath='/srv', threshold=600, jobname='JOB', statusdict={}, ignorelist=[], thresholddict={}, statefile=None, debug=False):
     """
     DESCRIPTION:
         Walk through all subdirs of /srv and check for latest files in all subdirs
         add active or inactive to a log file
         if log file not exists: just add data
         if existis: check for changes and create message with all changes
+        statefile: cache of the freshness index (see _freshnessindex)
     """
     defaultthreshold = threshold
     # neglect archive, products and projects directories of MARCOS
-    dirs=[x[0] for x in os.walk(testpath) if not x[0].find("archive")>-1 and not x[0].find("products")>-1 and not x[0].find("projects")>-1]
-    for d in dirs:
-        ld = _latestfile(os.path.join(d,'*'),date=True)
-        lf = _latestfile(os.path.join(d,'*'))
-        if os.path.isfile(lf):
+    index = _freshnessindex(testpath, statefile=statefile, excludelist=['archive','products','projects'], debug=debug)
+    for d in sorted(index):
+        lf, mtime = index[d]
+        ld = datetime.fromtimestamp(mtime)
+        if lf:
             if debug:
                 print ("Ckecking {} ...".format(lf))
             # check white and blacklists
@@ -289,7 +402,103 @@ def ConnectDB(dbcred):
     return db
 
 
-def CheckMARCOS(db,threshold=600, statusdict={},jobname='JOB',excludelist=[],acceptedoffsets={},debug=False):
+def _lasttime(cursor, table):
+    """
+    DESCRIPTION
+        get the time of the last input of a table
+    RETURNS
+        lasttime (None if not available), seconds spent for the query
+    """
+    start = time.time()
+    lasttime = None
+    lastsql = 'SELECT time FROM {} ORDER BY time DESC LIMIT 1'.format(table)
+    try:
+        cursor.execute(lastsql)
+        value = cursor.fetchall()
+        if len(value) > 0:
+            lasttime = value[0][0]
+    except mpdb.mysql.IntegrityError as message:
+        print (' -- check table: {}'.format(message))
+    except mpdb.mysql.Error as message:
+        print (' -- check table: {}'.format(message))
+    except:
+        print (' -- check table: unkown error')
+    return lasttime, time.time()-start
+
+
+def _updatetimes(cursor):
+    """
+    DESCRIPTION
+        get the last modification of all tables from the table metadata.
+        UPDATE_TIME is not available for all storage engines and versions -
+        such tables are missing in the returned dictionary
+    """
+    updatetimes = {}
+    sql = "SELECT TABLE_NAME, UPDATE_TIME FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE()"
+    try:
+        cursor.execute(sql)
+        for name, updatetime in cursor.fetchall():
+            if updatetime:
+                updatetimes[name] = str(updatetime)
+    except:
+        print (' -- check table: could not read table metadata')
+    return updatetimes
+
+
+def _lasttimes(db, tables, dbcred=None, workers=1, debug=False):
+    """
+    DESCRIPTION
+        get the time of the last input for a list of tables. If dbcred is
+        given and workers > 1, the queries are distributed on a bounded
+        amount of concurrent connections.
+    RETURNS
+        dictionary {table: (lasttime, seconds spent)}
+    """
+    results = {}
+    if workers > 1 and dbcred and len(tables) > 1:
+        tablequeue = queue.Queue()
+        for table in tables:
+            tablequeue.put(table)
+
+        def worker():
+            workerdb = ConnectDB(dbcred)
+            if not workerdb:
+                return
+            workercursor = workerdb.cursor()
+            while True:
+                try:
+                    table = tablequeue.get_nowait()
+                except queue.Empty:
+                    break
+                results[table] = _lasttime(workercursor, table)
+            workercursor.close()
+            workerdb.close()
+
+        threads = [threading.Thread(target=worker) for i in range(min(workers,len(tables)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    # remaining tables (sequential mode or failed worker connections)
+    cursor = db.cursor()
+    for table in tables:
+        if not table in results:
+            if debug:
+                print (' -> running for {}'.format(table))
+            results[table] = _lasttime(cursor, table)
+    cursor.close()
+    return results
+
+
+def CheckMARCOS(db,threshold=600, statusdict={},jobname='JOB',excludelist=[],acceptedoffsets={},dbcred=None,workers=1,cachefile=None,debug=False):
+    """
+    DESCRIPTION:
+        check the time of the last input in all data tables.
+        If cachefile is given, the last input times are kept between runs and
+        only tables, whose UPDATE_TIME in the table metadata has changed, are
+        queried again. Queries are distributed on up to workers connections
+        (requires dbcred). The time spent per table is stored in cachefile.
+    """
 
     testst = DataStream()
     offset = {}
@@ -356,33 +565,47 @@ def CheckMARCOS(db,threshold=600, statusdict={},jobname='JOB',excludelist=[],acc
         if debug:
             print ("4. Getting last input in each table")
             print ("-----------------------------------")
-        for table in tables:
-            if debug:
-                print (' -> running for {}'.format(table))
-            lastsql = 'SELECT time FROM {} ORDER BY time DESC LIMIT 1'.format(table)
-            try:
-                cursor.execute(lastsql)
-            except mpdb.mysql.IntegrityError as message:
-                print (' -- check table: {}'.format(message))
-            except mpdb.mysql.Error as message:
-                print (' -- check table: {}'.format(message))
-            except:
-                print (' -- check table: unkown error')
-            value = cursor.fetchall()
+        cache = {}
+        if cachefile and os.path.isfile(cachefile):
             try:
-                lasttime = value[0][0]
-                timetest = True
-            except:
-                timetest = False
-                pass
-            if timetest:
+                with open(cachefile,'r') as f:
+                    cache = json.load(f)
+            except (IOError, OSError, ValueError):
+                cache = {}
+        updatetimes = _updatetimes(cursor)
+        lasttimes = {}
+        toquery = []
+        for table in tables:
+            cached = cache.get(table,{})
+            if updatetimes.get(table) and cached.get('updatetime') == updatetimes.get(table) and cached.get('lasttime'):
+                lasttimes[table] = (cached.get('lasttime'), 0.0)
+            else:
+                toquery.append(table)
+        start = time.time()
+        lasttimes.update(_lasttimes(db, toquery, dbcred=dbcred, workers=workers, debug=debug))
+        print ("Table actuality: {} tables, {} queried, {} from cache in {:.2f} sec".format(len(tables), len(toquery), len(tables)-len(toquery), time.time()-start))
+        newcache = {}
+        current = datetime.utcnow()
+        for table in tables:
+            lasttime, duration = lasttimes.get(table,(None,0.0))
+            if table in toquery and debug:
+                print (' -> {}: {:.3f} sec'.format(table, duration))
+            if lasttime:
+                newcache[table] = {'lasttime':str(lasttime), 'updatetime':updatetimes.get(table), 'duration':duration if table in toquery else cache.get(table,{}).get('duration')}
                 lastt = testst._testtime(lasttime)
                 # Get difference to current time
-                current = datetime.utcnow()
                 tdiff = np.abs((current-lastt).total_seconds())
                 offset[table] = tdiff
                 if debug:
                     print ("Difference: {}".format(tdiff))
+        if cachefile:
+            try:
+                tmpfile = cachefile+'.tmp'
+                with open(tmpfile,'w') as f:
+                    json.dump(newcache, f)
+                os.rename(tmpfile, cachefile)
+            except (IOError, OSError) as e:
+                print ("Could not write table cache {}: {}".format(cachefile, e))
 
     if ok:
         if debug:
@@ -417,76 +640,136 @@ def dbsize():
     pass
 
 
+def _headchecksum(path, size=1024):
+    """
+    DESCRIPTION
+        checksum of the first bytes of a file - used to detect log rotation
+    """
+    with open(path,'rb') as f:
+        head = f.read(size)
+    return len(head), hashlib.md5(head).hexdigest()
+
+
+def _tail(path, lines=2, blocksize=4096):
+    """
+    DESCRIPTION
+        return the last lines of a file by reading backwards from its end
+    """
+    with open(path,'rb') as f:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+        data = b''
+        while end > 0 and data.count(b'\n') <= lines:
+            step = min(blocksize, end)
+            end -= step
+            f.seek(end)
+            data = f.read(step) + data
+    return [el.decode('utf-8','replace') for el in data.splitlines()[-lines:]]
+
+
+def _readappended(path, offset, blocksize=1048576):
+    """
+    DESCRIPTION
+        generator returning complete lines appended after offset together
+        with the offset behind each line. An incomplete last line is kept
+        for the next run.
+    """
+    with open(path,'rb') as f:
+        f.seek(offset)
+        rest = b''
+        while True:
+            block = f.read(blocksize)
+            if not block:
+                break
+            block = rest + block
+            lines = block.split(b'\n')
+            rest = lines.pop()
+            for line in lines:
+                offset += len(line)+1
+                yield line.decode('utf-8','replace'), offset
+
+
 def CheckLogfile(logfilepath, tmpdir='/tmp', statusdict={}, jobname='JOB', testtype='new', logsearchmessage='Error', tolerance=20, debug=False):
     """
     DESCRIPTION:
-        read a log file and compare it with a copy in tmp (created in the last call)
-    """
-    # 1 Read log file
-    # 2 Read copy in tmp
-    # 3 Compare both files
-    # or
-    # 4 check for specific messages and occurences (if not present in last 4 lines -> ignore)
-    # 5 Save log to tmp
-
-    def compare(f1,f2):
-        diff = []
-        with open(f1,'r') as f:
-            d=f.readlines()
-        with open(f2,'r') as f:
-            e=f.readlines()
-        lengthdiff = len(d)-len(e)
-        if lengthdiff > 0:
-            # new log is larger than old log
-            # else do not return a difference (because of logrotate)
-            diff = d[-lengthdiff:]
-        return diff
-
-    def last(f1, lines=None):
-        with open(f1,'r') as f:
-            d=f.readlines()
-        if not lines:
-            return d
-        if lines and len(d) > lines:
-            return d[-lines:]
-        elif lines and len(d) < lines:
-            return d
-        else:
-            return d
-
+        check the content appended to a log file since the last call.
+        Inode, read offset, a checksum of the file head and counters of
+        logsearchmessage (since the last rotation) are stored in a state file in tmpdir. Only
+        appended bytes are read. If the inode changes, the file shrinks or
+        its head differs, the log has been rotated and is read from the
+        beginning.
+    TESTTYPES:
+        new:      report the last new lines
+        repeat:   critical if at least tolerance new lines contain logsearchmessage
+        last:     logsearchmessage needs to be present in the last two lines
+        contain:  logsearchmessage needs to be present in the log file
+    """
     testname = "{}-checklog".format(jobname)
-    tmplogfilename = "monitor-{}.tmp".format(os.path.basename(logfilepath))
-    tmplogfile = os.path.join(tmpdir,tmplogfilename)
+    statefilename = "monitor-{}.state".format(os.path.basename(logfilepath))
+    statefile = os.path.join(tmpdir,statefilename)
 
     if not os.path.isfile(logfilepath):
         statusdict[testname] = "failed to find logfile"
         return statusdict
 
-    if os.path.isfile(tmplogfile):
-        # temporary file existing - running comparison
-        res = filecmp.cmp(logfilepath, tmplogfile)
+    state = {}
+    if os.path.isfile(statefile):
+        try:
+            with open(statefile,'r') as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError):
+            state = {}
+
+    stat = os.stat(logfilepath)
+    headsize, checksum = _headchecksum(logfilepath)
+    offset = state.get('offset',0)
+    rotated = False
+    if state:
+        if not state.get('inode') == stat.st_ino or stat.st_size < offset:
+            rotated = True
+        elif state.get('headsize',0) <= headsize and not state.get('headsum') == _headchecksum(logfilepath, state.get('headsize',0))[1]:
+            rotated = True
+    if rotated:
+        if debug:
+            print ("Log file has been rotated - reading from the beginning")
+        offset = 0
+        state['counts'] = {}
+
+    counts = state.get('counts',{})
+    newlines = 0
+    newmatches = 0
+    lastnew = []
+    if not state or stat.st_size > offset:
+        for line, pos in _readappended(logfilepath, offset):
+            newlines += 1
+            if line.find(logsearchmessage) > -1:
+                newmatches += 1
+            lastnew.append(line+'\n')
+            if len(lastnew) > 3:
+                lastnew.pop(0)
+            offset = pos
+        counts[logsearchmessage] = counts.get(logsearchmessage,0) + newmatches
+
+    if state:
+        # state from the last call existing - running checks
         checkname = "{}-content".format(testname)
         statusdict[checkname] = "log file ok"
-        if res:
+        if newlines == 0:
             if debug:
                 print ("Log file did not change")
         else:
             if debug:
-                print ("Log file changed")
-            diff = compare(logfilepath, tmplogfile)
-            if testtype == 'new' and len(diff) > 0:
-                statusdict[checkname] = "new content: {}".format(diff[-3:])
-            elif testtype == 'repeat' and len(diff) > 0:
-                # change of file is not important, only content in diff
-                # analyse diff
-                if len(diff) >= tolerance:
-                    testamount = sum([el.find(logsearchmessage) > -1 for el in diff])
-                    if testamount >= tolerance:
-                        statusdict[checkname] = "CRITICAL: execute script"
+                print ("Log file changed: {} new lines, {} containing '{}'".format(newlines, newmatches, logsearchmessage))
+            if testtype == 'new':
+                statusdict[checkname] = "new content: {}".format(lastnew)
+            elif testtype == 'repeat':
+                # change of file is not important, only content of new lines
+                if newlines >= tolerance and newmatches >= tolerance:
+                    statusdict[checkname] = "CRITICAL: execute script"
         if testtype == 'last':
             # just check last line - independent from changes
             #  REQUIRES logsearchmessage to be success
-            lines = last(logfilepath,2)
+            lines = _tail(logfilepath,2)
             if any([el.find(logsearchmessage) > -1 for el in lines]):
                 if debug:
                     print ("Fine - found success message")
@@ -495,21 +778,23 @@ def CheckLogfile(logfilepath, tmpdir='/tmp', statusdict={}, jobname='JOB', testt
         elif testtype == 'contain':
             # check all lines - independent from changes
             #  REQUIRES logsearchmessage to be success
-            lines = last(logfilepath)
-            if any([el.find(logsearchmessage) > -1 for el in lines]):
+            if counts.get(logsearchmessage,0) > 0:
                 if debug:
                     print ("Fine - found message {}".format(logsearchmessage))
             else:
                 statusdict[checkname] = "Did not find {} in {}".format(logsearchmessage.replace("_",""), os.path.basename(logfilepath).replace("_",""))
-
     else:
-        # Nothing to do ... create log file first
+        # Nothing to do ... create state file first
         pass
 
-    # save logfile to tmp
-    shutil.copy(logfilepath,tmpdir) # copy the logfile to destination dir
-    tmplogtorename = os.path.join(tmpdir,os.path.basename(logfilepath))
-    os.rename(tmplogtorename, tmplogfile) # rename
+    state = {'inode':stat.st_ino, 'offset':offset, 'headsize':headsize, 'headsum':checksum, 'counts':counts}
+    try:
+        tmpstate = statefile+'.tmp'
+        with open(tmpstate,'w') as f:
+            json.dump(state, f)
+        os.rename(tmpstate, statefile)
+    except (IOError, OSError) as e:
+        print ("Could not write log state file {}: {}".format(statefile, e))
 
     return statusdict
 
@@ -668,6 +953,10 @@ def main(argv):
     testamount = int(monitorconf.get('tolerance'))
     logsearchmessage = monitorconf.get('logsearchmessage')
     execute = monitorconf.get('execute',None)
+    try:
+        dbworkers = int(monitorconf.get('dbworkers',1))
+    except (TypeError, ValueError):
+        dbworkers = 1
 
     if not isinstance(ignorelist, list):
         ignorelist = []
@@ -691,7 +980,10 @@ def main(argv):
         if 'martas' in joblist:
             if debug:
                 print ("Running martas job")
-            statusmsg = CheckMARTAS(testpath=basedirectory, threshold=defaultthreshold, jobname=jobname, statusdict=statusmsg, ignorelist=ignorelist,thresholddict=thresholddict, debug=debug)
+            statefile = None
+            if tmpdir:
+                statefile = os.path.join(tmpdir, "monitor-{}-index.json".format(jobname))
+            statusmsg = CheckMARTAS(testpath=basedirectory, threshold=defaultthreshold, jobname=jobname, statusdict=statusmsg, ignorelist=ignorelist,thresholddict=thresholddict, statefile=statefile, debug=debug)
         elif 'datafile' in joblist:
             if debug:
                 print ("Running datafile job on {}".format(basedirectory))
@@ -700,7 +992,10 @@ def main(argv):
             if debug:
                 print ("Running marcos job")
             db = ConnectDB(dbcred)
-            statusmsg = CheckMARCOS(db, threshold=defaultthreshold, jobname=jobname, statusdict=statusmsg, excludelist=ignorelist,acceptedoffsets=thresholddict, debug=debug)
+            cachefile = None
+            if tmpdir:
+                cachefile = os.path.join(tmpdir, "monitor-{}-tables.json".format(jobname))
+            statusmsg = CheckMARCOS(db, threshold=defaultthreshold, jobname=jobname, statusdict=statusmsg, excludelist=ignorelist,acceptedoffsets=thresholddict, dbcred=dbcred, workers=dbworkers, cachefile=cachefile, debug=debug)
         if 'logfile' in joblist:
             if debug:
                 print ("Running logfile job on {}".format(logfile))
@@ -749,6 +1044,9 @@ basedirectory   :   /srv
 # where to find database credentials
 dbcredentials   :   cobsdb
 
+# amount of concurrent database connections for the table actuality check
+#dbworkers   :   4
+
 # accepted age of data in file or database (in seconds)
 defaultthreshold   :   600
 
@@ -0,0 +1,400 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+Replay benchmark for MARTAS acquisition protocols
+
+replaybench.py feeds recorded (or synthetic) raw serial byte streams through
+the libmqtt protocols without any hardware. Each protocol is connected to a
+fake transport, publishes to a stub MQTT client and writes its buffer files
+into a temporary directory, which is removed afterwards.
+Frames are replayed with a configurable rate (frames per second, 0 = as fast
+as possible) and optionally split into smaller chunks to emulate serial
+reads.
+
+For each protocol the following values are reported:
+ frames/s       fed frames per second of processing time (dataReceived)
+ cpu/frame      process time per fed frame in microseconds
+ latency        time between feeding the last chunk of a frame and the
+                publish call of its data (mean, 95 percentile and max in ms)
+ alloc          peak and retained memory (kB) of an additional replay traced
+                by tracemalloc (python3 only, option -m)
+
+Recordings:
+ Raw streams can be recorded e.g. by
+   cat /dev/ttyUSB0 > /tmp/recordings/Lemi.raw
+ and are used if a file <protocol>.raw is found in the recording directory.
+ Fixed frame streams (Lemi: 153 bytes, POS1: 44 bytes) are replayed in units
+ of their frame length, line based streams line by line.
+
+Application:
+ python3 replaybench.py
+ python3 replaybench.py -p Lemi,POS1 -n 10000 -r 0 -m
+ python3 replaybench.py -p GSM90 -d /tmp/recordings -r 10 -c 8
+"""
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import sys
+import getopt
+import time
+import shutil
+import struct
+import tempfile
+from datetime import datetime, timedelta
+
+scriptpath = os.path.dirname(os.path.realpath(__file__))
+martasdir = os.path.abspath(os.path.join(scriptpath, '..'))
+sys.path.insert(0, martasdir)
+
+try:
+    import tracemalloc
+except ImportError:
+    # python2
+    tracemalloc = None
+
+if hasattr(time, 'process_time'):
+    cputime = time.process_time
+else:
+    cputime = time.clock
+
+
+# -----------------------------------------------------------
+# Synthetic frames
+# -----------------------------------------------------------
+
+def _bcd(value):
+    # LEMI dates are binary coded decimals
+    return int(str(value), 16)
+
+
+def lemiframe(idx, t):
+    """
+    DESCRIPTION:
+        153 byte LEMI025 frame with GPS time t (see LEMIFRAME in lemiprotocol)
+    """
+    values = [b'L', b'0', b'2', b'5', 22]
+    values.extend([_bcd(t.year-2000), _bcd(t.month), _bcd(t.day), _bcd(t.hour), _bcd(t.minute), _bcd(t.second)])
+    values.extend([2150, 2410, 0, 0, 0, 100, 100, 100])
+    values.append(0)
+    for sub in range(10):
+        values.extend([21500.1+0.01*(idx%50), 1500.2+0.01*sub, 43800.3])
+    values.extend([0, 0, 120, b'A', 0])
+    return struct.pack("<4cB6B8hb30f3BcB", *values)
+
+
+def pos1frame(idx, t):
+    """
+    DESCRIPTION:
+        44 byte POS1 frame terminated by a null byte
+    """
+    line = ' {} 1  {} [00] {} {}'.format(48617012+idx%100, 45, t.strftime("%m-%d-%y"), t.strftime("%H:%M:%S.%f")[:11])
+    return line.ljust(43).encode('ascii') + b'\x00'
+
+
+def gsm90line(idx, t):
+    return "{}.0 {:.2f} 99\r\n".format(t.strftime("%H%M%S"), 48464.53+0.01*(idx%100)).encode('ascii')
+
+
+def gsm19line(idx, t):
+    return "{}.0 {:.2f} 099\r\n".format(t.strftime("%H%M%S"), 48464.53+0.01*(idx%100)).encode('ascii')
+
+
+def gp20s3line(idx, t):
+    return "{}.00 111 {:.1f} 48465231.2 48466342.3\r\n".format(t.strftime("%H%M%S"), 48464123.1+idx%100).encode('ascii')
+
+
+def envline(idx, t):
+    return "+{:.1f} 45.3 +9.1\r\n".format(21.0+0.1*(idx%10)).encode('ascii')
+
+
+def bm35line(idx, t):
+    return "{:.2f},1013.10\r\n".format(1013.25+0.01*(idx%10)).encode('ascii')
+
+
+# protocol name (registry) -> sensorid, frame length (None = lines), frame generator
+BENCHMARKS = {
+    'Lemi':   {'sensorid':'LEMI025_22_0003',   'framelength':153,  'generator':lemiframe},
+    'POS1':   {'sensorid':'POS1_N432_0001',    'framelength':44,   'generator':pos1frame},
+    'GSM90':  {'sensorid':'GSM90_14245_0002',  'framelength':None, 'generator':gsm90line},
+    'GSM19':  {'sensorid':'GSM19_7122568_0001','framelength':None, 'generator':gsm19line},
+    'GP20S3': {'sensorid':'GP20S3NS_012201_0001','framelength':None, 'generator':gp20s3line},
+    'Env':    {'sensorid':'ENV05_2_0001',      'framelength':None, 'generator':envline},
+    'BM35':   {'sensorid':'BM35_029_0001',     'framelength':None, 'generator':bm35line},
+}
+
+
+def synthetic(name, amount, samplingperiod=1.0):
+    """
+    DESCRIPTION:
+        return a list of amount frames of protocol name with increasing times
+    """
+    generator = BENCHMARKS.get(name).get('generator')
+    start = datetime.utcnow().replace(microsecond=0)
+    return [generator(idx, start+timedelta(seconds=idx*samplingperiod)) for idx in range(amount)]
+
+
+def recorded(path, framelength=None, amount=0):
+    """
+    DESCRIPTION:
+        read a raw recording and split it into frames of framelength
+        or into lines (including line endings)
+    """
+    with open(path, 'rb') as fh:
+        raw = fh.read()
+    if framelength:
+        frames = [raw[idx:idx+framelength] for idx in range(0, len(raw), framelength)]
+    else:
+        frames = raw.splitlines(True)
+    if amount > 0:
+        frames = frames[:amount]
+    return frames
+
+
+# -----------------------------------------------------------
+# Stubs
+# -----------------------------------------------------------
+
+class StubClient(object):
+    """
+    DESCRIPTION:
+        Replaces the paho client. Counts published messages and data records
+        and measures the time since the current frame was fed (fedat).
+    """
+    def __init__(self):
+        self.fedat = 0.
+        self.reset()
+
+    def reset(self):
+        self.messages = 0
+        self.records = 0
+        self.latencies = []
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        now = time.time()
+        self.messages += 1
+        if topic.endswith('/data'):
+            if payload:
+                self.records += payload.count(';')+1
+            self.latencies.append(now-self.fedat)
+        return (0, self.messages)
+
+
+class FakeTransport(object):
+    """
+    DESCRIPTION:
+        Minimal twisted transport - commands written by a protocol are collected
+    """
+    def __init__(self):
+        self.written = []
+        self.connected = True
+
+    def write(self, data):
+        self.written.append(data)
+
+    def writeSequence(self, seq):
+        self.written.extend(seq)
+
+    def loseConnection(self):
+        self.connected = False
+
+
+# -----------------------------------------------------------
+# Replay
+# -----------------------------------------------------------
+
+def _chunks(frame, chunksize):
+    if not chunksize or chunksize >= len(frame):
+        return [frame]
+    return [frame[idx:idx+chunksize] for idx in range(0, len(frame), chunksize)]
+
+
+def _percentile(values, percent):
+    if not values:
+        return 0.
+    values = sorted(values)
+    return values[int(round(percent/100.*(len(values)-1)))]
+
+
+def createprotocol(name, client, bufferdir, debug=False):
+    """
+    DESCRIPTION:
+        create protocol name with sensors.cfg/martas.cfg like dictionaries
+    """
+    from libmqtt import registry
+    sensordict = {'sensorid':BENCHMARKS.get(name).get('sensorid'), 'protocol':name, 'port':'USB0',
+                  'baudrate':'9600', 'bytesize':'8', 'stopbits':'1', 'parity':'N', 'mode':'passive',
+                  'init':'None', 'rate':'1', 'stack':'1', 'pierid':'A2', 'ptime':'NTP',
+                  'sensorgroup':'benchmark', 'sensordesc':'replay'}
+    confdict = {'station':'bench', 'bufferdirectory':bufferdir, 'serialport':'/dev/tty',
+                'mqttqos':'0', 'debug':str(debug)}
+    return registry.create(name, client, sensordict, confdict)
+
+
+def replay(protocol, client, frames, rate=0., chunksize=0):
+    """
+    DESCRIPTION:
+        feed frames into protocol.dataReceived with rate frames per second
+    RETURNS:
+        dictionary with processing time (busy), process time (cpu) and elapsed time
+    """
+    protocol.makeConnection(FakeTransport())
+    interval = 1./rate if rate > 0 else 0.
+    busy = 0.
+    start = time.time()
+    cpustart = cputime()
+    for idx, frame in enumerate(frames):
+        if interval:
+            delay = start + idx*interval - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        for chunk in _chunks(frame, chunksize):
+            t0 = time.time()
+            client.fedat = t0
+            protocol.dataReceived(chunk)
+            busy += time.time()-t0
+    cpu = cputime()-cpustart
+    elapsed = time.time()-start
+    protocol.connectionLost("replay finished")
+    return {'busy':busy, 'cpu':cpu, 'elapsed':elapsed}
+
+
+def benchmark(name, frames, rate=0., chunksize=0, allocations=False, debug=False):
+    """
+    DESCRIPTION:
+        replay frames through protocol name and return a result dictionary
+    """
+    from core import acquisitionsupport as acs
+    bufferdir = tempfile.mkdtemp(prefix='replaybench_')
+    try:
+        client = StubClient()
+        protocol = createprotocol(name, client, bufferdir, debug=debug)
+        times = replay(protocol, client, frames, rate=rate, chunksize=chunksize)
+        amount = float(max(len(frames), 1))
+        result = {'protocol':name, 'frames':len(frames), 'records':client.records, 'messages':client.messages,
+                  'framespersec':len(frames)/times.get('busy') if times.get('busy') > 0 else 0.,
+                  'cpuperframe':times.get('cpu')/amount*1000000.,
+                  'latmean':sum(client.latencies)/len(client.latencies)*1000. if client.latencies else 0.,
+                  'latp95':_percentile(client.latencies, 95)*1000.,
+                  'latmax':max(client.latencies)*1000. if client.latencies else 0.,
+                  'elapsed':times.get('elapsed')}
+        if allocations and tracemalloc:
+            # separate pass - tracing slows down the protocol
+            client = StubClient()
+            protocol = createprotocol(name, client, bufferdir, debug=debug)
+            tracemalloc.start()
+            before = tracemalloc.get_traced_memory()[0]
+            replay(protocol, client, frames, rate=0., chunksize=chunksize)
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            result['allocpeak'] = (peak-before)/1024.
+            result['allocretained'] = (current-before)/1024.
+        acs.bufferwriter.close()
+    finally:
+        shutil.rmtree(bufferdir, ignore_errors=True)
+    return result
+
+
+def report(results):
+    print ("{:<8} {:>7} {:>8} {:>11} {:>10} {:>9} {:>9} {:>9} {:>10} {:>10}".format(
+           'protocol', 'frames', 'records', 'frames/s', 'cpu/frame', 'lat mean', 'lat p95', 'lat max', 'alloc peak', 'retained'))
+    print ("{:<8} {:>7} {:>8} {:>11} {:>10} {:>9} {:>9} {:>9} {:>10} {:>10}".format(
+           '', '', '', '', '[us]', '[ms]', '[ms]', '[ms]', '[kB]', '[kB]'))
+    for res in results:
+        if res.get('error'):
+            print ("{:<8} not available: {}".format(res.get('protocol'), res.get('error')))
+            continue
+        alloc = ["{:.1f}".format(res.get(key)) if key in res else '-' for key in ['allocpeak','allocretained']]
+        print ("{:<8} {:>7d} {:>8d} {:>11.1f} {:>10.1f} {:>9.3f} {:>9.3f} {:>9.3f} {:>10} {:>10}".format(
+               res.get('protocol'), res.get('frames'), res.get('records'), res.get('framespersec'), res.get('cpuperframe'),
+               res.get('latmean'), res.get('latp95'), res.get('latmax'), alloc[0], alloc[1]))
+        if res.get('frames') and not res.get('records'):
+            print ("{:<8} no data published - check the replayed data and the python version of the protocol".format(''))
+
+
+def main(argv):
+    protocols = sorted(BENCHMARKS.keys())
+    amount = 1000
+    rate = 0.
+    chunksize = 0
+    recordingdir = ''
+    allocations = False
+    debug = False
+    usage = 'replaybench.py -p <protocols> -n <frames> -r <rate> -c <chunksize> -d <recordingdir> -m -D'
+
+    try:
+        opts, args = getopt.getopt(argv,"hp:n:r:c:d:mD",["protocols=","frames=","rate=","chunksize=","recordingdir=","allocations","debug"])
+    except getopt.GetoptError:
+        print (usage)
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            print ('-------------------------------------')
+            print ('Description:')
+            print ('-- replaybench.py replays raw serial streams through acquisition protocols --')
+            print ('-----------------------------------------------------------------')
+            print ('replaybench feeds recorded or synthetic frames through the')
+            print ('libmqtt protocols using a fake transport, a stub MQTT client')
+            print ('and a temporary buffer directory. Throughput, cpu time per')
+            print ('frame, latency to publish and memory allocations are reported.')
+            print ('')
+            print ('-------------------------------------')
+            print ('Usage:')
+            print ('python3 '+usage)
+            print ('-------------------------------------')
+            print ('Options:')
+            print ('-p            : comma separated protocols - default: {}'.format(','.join(protocols)))
+            print ('-n            : amount of frames - default 1000')
+            print ('-r            : replay rate in frames per second - default 0 (as fast as possible)')
+            print ('-c            : chunk size in bytes used for feeding - default 0 (complete frames)')
+            print ('-d            : directory with recordings <protocol>.raw')
+            print ('-m            : measure memory allocations (tracemalloc, python3)')
+            print ('-D            : debug mode of the protocols')
+            print ('-------------------------------------')
+            print ('Application:')
+            print ('python3 replaybench.py -p Lemi,POS1 -n 10000 -m')
+            print ('python3 replaybench.py -p GSM90 -d /tmp/recordings -r 10 -c 8')
+            sys.exit()
+        elif opt in ("-p", "--protocols"):
+            protocols = [el.strip() for el in arg.split(',') if el.strip()]
+        elif opt in ("-n", "--frames"):
+            amount = int(arg)
+        elif opt in ("-r", "--rate"):
+            rate = float(arg)
+        elif opt in ("-c", "--chunksize"):
+            chunksize = int(arg)
+        elif opt in ("-d", "--recordingdir"):
+            recordingdir = os.path.abspath(arg)
+        elif opt in ("-m", "--allocations"):
+            allocations = True
+        elif opt in ("-D", "--debug"):
+            debug = True
+
+    if allocations and not tracemalloc:
+        print ("tracemalloc not available - allocations are not measured")
+
+    results = []
+    for name in protocols:
+        if not name in BENCHMARKS:
+            results.append({'protocol':name, 'error':'no replay data defined'})
+            continue
+        recording = os.path.join(recordingdir, "{}.raw".format(name)) if recordingdir else ''
+        if recording and os.path.isfile(recording):
+            frames = recorded(recording, framelength=BENCHMARKS.get(name).get('framelength'), amount=amount)
+            print ("{}: replaying {} frames from {}".format(name, len(frames), recording))
+        else:
+            frames = synthetic(name, amount)
+            print ("{}: replaying {} synthetic frames".format(name, len(frames)))
+        try:
+            results.append(benchmark(name, frames, rate=rate, chunksize=chunksize, allocations=allocations, debug=debug))
+        except Exception as e:
+            results.append({'protocol':name, 'error':e})
+
+    print ("")
+    report(results)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
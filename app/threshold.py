@@ -48,6 +48,10 @@ bufferpath           :   /srv/mqtt/
 logfile              :   /home/leon/Tmp/threshold.log
 
 
+# Optional directory for caching sensor data between runs (file source only)
+#cachepath            :   /tmp
+
+
 # Notifaction (uses martaslog class, one of email, telegram, mqtt, log)
 notification         :   email
 notificationconfig   :   /etc/martas/notification.cfg
@@ -105,11 +109,14 @@ from __future__ import unicode_literals
 
 # Define packges to be used (local refers to test environment)
 # ------------------------------------------------------------
-from magpy.stream import DataStream, KEYLIST, NUMKEYLIST, read
+from magpy.stream import DataStream, KEYLIST, NUMKEYLIST, read, date2num
 from magpy.database import mysql,readDB
 from datetime import datetime, timedelta
 import magpy.opt.cred as mpcred
 import sys, getopt, os
+import glob
+import json
+import numpy as np
 try:
     import paho.mqtt.client as mqtt
 except:
@@ -271,39 +278,156 @@ def GetData(source, path, db, dbcredentials, sensorid, amount, startdate=None, d
 
     return (data, msg)
 
-def GetTestValue(data=DataStream(), key='x', function='average', debug=False):
+class DataCache(object):
+    """
+    DESCRIPTION:
+        cache of sensor data for one threshold run. Each sensor is read only
+        once for the largest timerange requested by any parameter line (see
+        require). Parameter lines are evaluated on slices of the cached
+        columns.
+        If cachepath is given, the loaded columns are also stored as npz file
+        and reused in the next run as long as the buffer files of the sensor
+        did not change (file source only).
+    EXAMPLE:
+        cache = DataCache(conf.get('source'), conf.get('bufferpath'), ...)
+        cache.require('DS18B20XX', 1800)
+        columns, msg = cache.columns('DS18B20XX', 600)
+    """
+    def __init__(self, source, path, db, dbcredentials, startdate=None, cachepath=None, debug=False):
+        self.source = source
+        self.path = path
+        self.db = db
+        self.dbcredentials = dbcredentials
+        self.startdate = startdate
+        self.cachepath = cachepath
+        self.debug = debug
+        self.amounts = {}
+        self.data = {}
+
+    def require(self, sensorid, amount):
+        self.amounts[sensorid] = max(int(amount), self.amounts.get(sensorid,0))
+
+    def _reference(self):
+        if self.startdate:
+            return self.startdate
+        return datetime.utcnow()
+
+    def _signature(self, sensorid):
+        # newest modification and amount of buffer files - changes whenever data is added
+        if not self.source in ['file','File']:
+            return None
+        files = glob.glob(os.path.join(self.path,sensorid,'*'))
+        if not files:
+            return None
+        return "{}-{}".format(len(files), max([os.path.getmtime(f) for f in files]))
+
+    def _cachefile(self, sensorid):
+        return os.path.join(self.cachepath, "threshold-{}.npz".format(sensorid))
+
+    def _loadcache(self, sensorid, starttime, signature):
+        if not self.cachepath or not signature or not os.path.isfile(self._cachefile(sensorid)):
+            return None
+        try:
+            cached = np.load(self._cachefile(sensorid))
+            meta = json.loads(str(cached['meta']))
+            if not meta.get('signature') == signature or meta.get('starttime') > date2num(starttime):
+                return None
+            columns = dict([(key, cached[key]) for key in meta.get('keys')])
+            columns['time'] = cached['time']
+            if self.debug:
+                print ("Using cached data of {} from {}".format(sensorid, self._cachefile(sensorid)))
+            return columns
+        except:
+            return None
+
+    def _storecache(self, sensorid, columns, starttime, signature):
+        if not self.cachepath or not signature:
+            return
+        try:
+            keys = [key for key in columns if not key == 'time']
+            meta = json.dumps({'signature':signature, 'starttime':date2num(starttime), 'keys':keys})
+            tmpfile = self._cachefile(sensorid)+'.tmp.npz'
+            np.savez(tmpfile, meta=meta, **columns)
+            os.rename(tmpfile, self._cachefile(sensorid))
+        except Exception as e:
+            print ("Could not write data cache for {}: {}".format(sensorid, e))
+
+    def _load(self, sensorid):
+        amount = self.amounts.get(sensorid,0)
+        starttime = self._reference()-timedelta(seconds=amount)
+        signature = self._signature(sensorid)
+        columns = self._loadcache(sensorid, starttime, signature)
+        msg = ''
+        if columns is None:
+            (data, msg) = GetData(self.source, self.path, self.db, self.dbcredentials, sensorid, amount, startdate=self.startdate, debug=self.debug)
+            columns = {}
+            if data.length()[0] > 0:
+                if not len(data.ndarray[0]) > 0:
+                    data = data.linestruct2ndarray()
+                columns['time'] = np.asarray(data.ndarray[0], dtype=float)
+                for key in data._get_key_headers():
+                    col = data.ndarray[KEYLIST.index(key)]
+                    if key in NUMKEYLIST and len(col) == len(columns['time']):
+                        columns[key] = np.asarray(col, dtype=float)
+                self._storecache(sensorid, columns, starttime, signature)
+        self.data[sensorid] = (columns, msg)
+
+    def columns(self, sensorid, amount):
+        """
+        DESCRIPTION:
+            return a dictionary of columns (numpy arrays) covering the last
+            amount seconds and an error message
+        """
+        if not sensorid in self.data:
+            self.require(sensorid, amount)
+            self._load(sensorid)
+        columns, msg = self.data[sensorid]
+        if not 'time' in columns:
+            return {}, msg
+        starttime = date2num(self._reference()-timedelta(seconds=int(amount)))
+        mask = columns['time'] >= starttime
+        if self.startdate:
+            mask &= columns['time'] <= date2num(self.startdate)
+        return dict([(key, columns[key][mask]) for key in columns]), msg
+
+
+def GetTestValueFromColumns(columns={}, key='x', function='average', debug=False):
     """
     DESCRIPTION
-    Returns comparison value(e.g. mean, max etc)
+    Returns comparison value(e.g. mean, max etc) computed on numpy columns (see DataCache)
     """
     if debug:
         print ("Obtaining test value for key {} with function {}".format(key,function))
-    func = 'mean'
     testvalue = None
     msg = ''
-    n = data.length()[0]
-    keys = data._get_key_headers()
+    col = columns.get(key)
 
-    if not key in keys:
+    if col is None:
         print ("Requested key not found")
         return (testvalue, 'failure')
+    col = col[~np.isnan(col)]
+    n = len(col)
+    if not n > 0:
+        print ("No valid data for key {}".format(key))
+        return (testvalue, 'failure')
     if function in ['mean','Mean','average', 'Average','Median','median']:
         if n < 3:
             print ("not enough data points --- {} insignificant".format(function))
         if function in ['mean','Mean','average', 'Average']:
-            func = 'mean'
+            testvalue = np.mean(col)
         elif function in ['Median','median']:
-            func = 'median'
-        testvalue = data.mean(key,meanfunction=func)
+            testvalue = np.median(col)
     elif function in ['max','Max']:
-        testvalue = data._get_max(key)
+        testvalue = np.max(col)
     elif function in ['min','Min']:
-        testvalue = data._get_min(key)
+        testvalue = np.min(col)
     elif function in ['stddev','Stddev']:
-        mean,testvalue = data.mean(key,std=True)
+        testvalue = np.std(col)
     else:
         msg = 'selected test function not available'
 
+    if testvalue is not None:
+        testvalue = float(testvalue)
     if debug:
         print (" ... got {}".format(testvalue))
 
@@ -475,6 +599,13 @@ def main(argv):
     except:
         print ("Could not import martas logging routines - check MARTAS directory path")
 
+    # Read each sensor only once for the largest requested timerange
+    cache = DataCache(conf.get('source'), conf.get('bufferpath'), conf.get('database'), conf.get('dbcredentials'), startdate=conf.get('startdate'), cachepath=conf.get('cachepath'), debug=debug)
+    for i in range(0,1000):
+        valuedict = para.get(str(i),{})
+        if not valuedict == {} and is_number(valuedict.get('timerange')):
+            cache.require(valuedict.get('sensorid'), valuedict.get('timerange'))
+
     # For each parameter
     for i in range(0,1000):
             valuedict = para.get(str(i),{})
@@ -490,8 +621,8 @@ def main(argv):
                 if debug:
                     print ("Accessing data from {} at {}: Sensor {} - Amount: {} sec".format(conf.get('source'),conf.get('bufferpath'),valuedict.get('sensorid'),valuedict.get('timerange') ))
 
-                (data,msg1) = GetData(conf.get('source'), conf.get('bufferpath'), conf.get('database'), conf.get('dbcredentials'), valuedict.get('sensorid'),valuedict.get('timerange'), debug=debug , startdate=conf.get('startdate') )
-                (testvalue,msg2) = GetTestValue( data, valuedict.get('key'), valuedict.get('function'), debug=debug) # Returns comparison value(e.g. mean, max etc)
+                (columns,msg1) = cache.columns(valuedict.get('sensorid'),valuedict.get('timerange'))
+                (testvalue,msg2) = GetTestValueFromColumns( columns, valuedict.get('key'), valuedict.get('function'), debug=debug) # Returns comparison value(e.g. mean, max etc)
                 if not testvalue and travistestrun:
                     print ("Testrun for parameterset {} OK".format(i))
                 elif not testvalue:
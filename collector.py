@@ -60,6 +60,9 @@ from twisted.web.static import File
 from twisted.internet import reactor
 
 import threading
+import atexit
+import signal
+import time
 from multiprocessing import Process
 import struct
 from datetime import datetime
@@ -125,6 +128,7 @@ webpath = './web'
 webport = 8080
 socketport = 5000
 blacklist = []
+dbqueue = None
 
 
 class protocolparameter(object):
@@ -133,6 +137,281 @@ class protocolparameter(object):
 
 po = protocolparameter()
 
+
+class PackDecoder(object):
+    """
+    DESCRIPTION:
+        Converts MagPyBin data payloads into binary buffer records.
+        The packing code is expanded and compiled only once per sensor.
+        A stacked payload (';' separated lines) is converted column wise
+        and packed with a single struct call, each record followed by a linebreak.
+    PARAMETER:
+        packcode: (string) packing code without byte order and trailing B (e.g. 6hLllL)
+    """
+    def __init__(self, packcode):
+        self.packcode = packcode
+        self.struct = struct.Struct('<'+packcode)
+        cpack = []
+        digits = ''
+        for c in packcode:
+            if c.isdigit():
+                digits += c
+            elif c == 's':
+                # a string of given length is a single field
+                cpack.append(c)
+                digits = ''
+            elif c == 'x':
+                # pad bytes do not consume values
+                digits = ''
+            else:
+                cpack.extend([c] * (int(digits) if digits else 1))
+                digits = ''
+        self.cpackcode = "".join(cpack)
+        self.columns = len(self.cpackcode)
+        # per column conversion method
+        self.converter = []
+        for c in self.cpackcode:
+            if c == 's':
+                self.converter.append(_tostring)
+            elif c in ['f','d','e']:
+                self.converter.append(float)
+            else:
+                self.converter.append(_toint)
+        self.batch = {}
+
+    def _batchstruct(self, amount):
+        bs = self.batch.get(amount)
+        if not bs:
+            bs = struct.Struct('<'+(self.packcode+'c')*amount)
+            if len(self.batch) > 16:
+                self.batch.clear()
+            self.batch[amount] = bs
+        return bs
+
+    def decode(self, payload):
+        """
+        DESCRIPTION:
+            returns a list of (filedate, records) tuples. Records is a bytestring
+            containing all packed lines of filedate.
+        """
+        rows = [line.split(',') for line in payload.split(';')]
+        rows = [row for row in rows if len(row) == self.columns]
+        if not rows:
+            return []
+        cols = [list(map(conv, col)) for conv, col in zip(self.converter, zip(*rows))]
+        eol = [b"\n"]*len(rows)
+        result = []
+        dates = ["{}-{:02d}-{:02d}".format(y,m,d) for y,m,d in zip(cols[0],cols[1],cols[2])]
+        start = 0
+        for idx in range(1,len(rows)+1):
+            if idx == len(rows) or not dates[idx] == dates[start]:
+                values = [val for rec in zip(*[col[start:idx] for col in cols]+[eol[start:idx]]) for val in rec]
+                result.append((dates[start], self._batchstruct(idx-start).pack(*values)))
+                start = idx
+        return result
+
+
+def _tostring(value):
+    return value.encode('ascii','ignore')
+
+def _toint(value):
+    return int(float(value))
+
+
+def get_decoder(sensorid):
+    """
+    DESCRIPTION:
+        return the cached PackDecoder of sensorid, create it from the packing code if not existing
+    """
+    decoder = po.identifier.get(sensorid+':decoder')
+    if not decoder:
+        packcode = po.identifier.get(sensorid+':packingcode','')
+        if sys.version_info >= (3,0) and isinstance(packcode, bytes):
+            packcode = packcode.decode()
+        if packcode.endswith('B'):
+            packcode = packcode.strip('<')[:-1] # drop leading < and final B
+        else:
+            packcode = packcode.strip('<') # drop leading <
+        # temporary code - too be deleted when lemi protocol has been updated
+        if packcode.find('4cb6B8hb30f3Bc') >= 0:
+            packcode = '6hLffflll'
+        decoder = PackDecoder(packcode)
+        po.identifier[sensorid+':decoder'] = decoder
+    return decoder
+
+class DBWriteQueue(object):
+    """
+    DESCRIPTION:
+        Write-behind queue for the 'db' destination. Incoming data arrays are
+        collected per table and written by a dedicated writer thread as one
+        DataStream (i.e. one multi-row insert and transaction) whenever
+        'batchsize' rows are queued for a table or the oldest row is older
+        than 'maxdelay' seconds. At most 'maxrows' rows wait in the queue,
+        if the database cannot keep up the oldest waiting block of the
+        largest table is dropped. Rows already handed to the writer thread
+        (in flight) are not counted and never dropped.
+        Remaining rows are written when stop() is called.
+    PARAMETER:
+        db:         database connection
+        batchsize:  (int) rows per table which trigger a write
+        maxdelay:   (float) maximal latency in seconds before writing
+        maxrows:    (int) upper limit of queued rows
+    """
+    def __init__(self, db, batchsize=500, maxdelay=5.0, maxrows=100000, debug=False):
+        self.db = db
+        self.batchsize = int(batchsize)
+        self.maxdelay = float(maxdelay)
+        self.maxrows = int(maxrows)
+        self.debug = debug
+        self.tables = {}
+        self.queued = 0         # rows waiting in self.tables
+        self.inflight = 0       # rows currently written by _write
+        self.running = False
+        self.condition = threading.Condition()
+        self.thread = None
+        self.stats = {'rows':0, 'flushes':0, 'dropped':0, 'errors':0, 'maxdepth':0, 'lastlatency':0.0, 'maxlatency':0.0, 'totallatency':0.0}
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, ndarray, header, tablename=None):
+        """
+        DESCRIPTION:
+            add a data array with its header to the queue of table 'tablename'.
+            If tablename is None, the table is determined by writeDB.
+        """
+        rows = len(ndarray[0])
+        key = tablename if tablename else header.get('SensorID')
+        with self.condition:
+            entry = self.tables.get(key)
+            if not entry:
+                entry = {'tablename':tablename, 'header':{}, 'arrays':[], 'rows':0, 'first':time.time()}
+                self.tables[key] = entry
+            if not entry['arrays']:
+                entry['first'] = time.time()
+            entry['header'] = header.copy()
+            entry['arrays'].append(ndarray)
+            entry['rows'] += rows
+            self.queued += rows
+            while self.queued > self.maxrows:
+                self._drop()
+            self.stats['maxdepth'] = max(self.stats['maxdepth'], self.queued)
+            if entry['rows'] >= self.batchsize:
+                self.condition.notify()
+
+    def depth(self):
+        return self.queued + self.inflight
+
+    def _drop(self):
+        # remove the oldest block of the largest table
+        key = max(self.tables, key=lambda k: self.tables[k]['rows'])
+        entry = self.tables[key]
+        ar = entry['arrays'].pop(0)
+        entry['rows'] -= len(ar[0])
+        self.queued -= len(ar[0])
+        self.stats['dropped'] += len(ar[0])
+        if self.stats['dropped'] == len(ar[0]) or self.debug:
+            log.msg("DB queue: memory limit of {} rows reached - dropping data of {}".format(self.maxrows, key))
+
+    def _due(self, force=False):
+        now = time.time()
+        due = []
+        for key in list(self.tables.keys()):
+            entry = self.tables[key]
+            if entry['rows'] > 0 and (force or entry['rows'] >= self.batchsize or now-entry['first'] >= self.maxdelay):
+                due.append((entry['tablename'], entry['header'], entry['arrays'], entry['rows']))
+                self.queued -= entry['rows']
+                self.inflight += entry['rows']
+                entry['arrays'] = []
+                entry['rows'] = 0
+        return due
+
+    def _run(self):
+        while self.running:
+            with self.condition:
+                self.condition.wait(min(1.0,self.maxdelay))
+                due = self._due()
+            self._write(due)
+
+    def flush(self):
+        """
+        DESCRIPTION:
+            write all queued data now
+        """
+        with self.condition:
+            due = self._due(force=True)
+        self._write(due)
+
+    def stop(self):
+        """
+        DESCRIPTION:
+            stop the writer thread and write all remaining data
+        """
+        if not self.thread:
+            return
+        self.running = False
+        with self.condition:
+            self.condition.notify()
+        if self.thread and not self.thread is threading.current_thread():
+            self.thread.join(10)
+        self.thread = None
+        self.flush()
+        log.msg("DB queue: {}".format(self.statistics()))
+
+    def statistics(self):
+        st = self.stats.copy()
+        st['depth'] = self.queued
+        st['inflight'] = self.inflight
+        if st['flushes'] > 0:
+            st['meanlatency'] = st['totallatency']/st['flushes']
+        return st
+
+    def _write(self, due):
+        for tablename, header, arrays, rows in due:
+            start = time.time()
+            try:
+                datastream = DataStream([], header, _concatenate(arrays))
+                if tablename:
+                    writeDB(self.db,datastream,tablename=tablename)
+                else:
+                    writeDB(self.db,datastream)
+                self.stats['rows'] += rows
+            except Exception as e:
+                self.stats['errors'] += 1
+                log.msg("DB queue: writing {} rows to {} failed: {}".format(rows, tablename, e))
+            latency = time.time()-start
+            with self.condition:
+                self.inflight -= rows
+                self.stats['flushes'] += 1
+                self.stats['lastlatency'] = latency
+                self.stats['maxlatency'] = max(self.stats['maxlatency'],latency)
+                self.stats['totallatency'] += latency
+            if self.debug:
+                log.msg("DB queue: wrote {} rows to {} in {:.3f} sec (depth {})".format(rows, tablename, latency, self.depth()))
+
+
+def _concatenate(arrays):
+    """
+    DESCRIPTION:
+        combine a list of KEYLIST ndarrays into a single ndarray
+    """
+    if len(arrays) == 1:
+        return arrays[0]
+    lengths = [len(ar[0]) for ar in arrays]
+    result = []
+    for idx in range(len(KEYLIST)):
+        cols = [ar[idx] for ar in arrays]
+        if all(len(col) == 0 for col in cols):
+            result.append(np.asarray([]))
+        else:
+            cols = [col if len(col) == lengths[i] else np.full(lengths[i], np.nan) for i, col in enumerate(cols)]
+            result.append(np.concatenate(cols))
+    return np.asarray(result,dtype=object)
+
+
 ## WebServer Methods
 ## -----------------------------------------------------------
 def wsThread(wsserver):
@@ -233,6 +512,9 @@ def analyse_meta(header,sensorid,debug=False):
     po.identifier[sensorid+':elemlist'] = elemlist
     po.identifier[sensorid+':unitlist'] = unitlist
     po.identifier[sensorid+':multilist'] = multilist
+    po.identifier.pop(sensorid+':decoder', None)
+    po.identifier.pop(sensorid+':columnmap', None)
+    get_decoder(sensorid)
 
 
 def create_head_dict(header,sensorid):
@@ -293,36 +575,71 @@ def create_head_dict(header,sensorid):
     head_dict['ColumnUnits'] = ','.join(l2[1:])
     return head_dict
 
+def get_columnmap(sensorid):
+    """
+    DESCRIPTION:
+        return the cached column map of sensorid: a list of
+        (payload column, KEYLIST index, divisor, numerical) tuples
+    """
+    columnmap = po.identifier.get(sensorid+':columnmap')
+    if columnmap is None:
+        columnmap = []
+        keylist = po.identifier[sensorid+':keylist']
+        multilist = po.identifier[sensorid+':multilist']
+        for idx, elem in enumerate(keylist):
+            if elem in KEYLIST and not elem.endswith('time'):
+                try:
+                    divisor = float(multilist[idx])
+                except:
+                    divisor = 1.0
+                columnmap.append((idx+7, KEYLIST.index(elem), divisor, elem in NUMKEYLIST))
+        po.identifier[sensorid+':columnmap'] = columnmap
+    return columnmap
+
+
 def interprete_data(payload, stream, sensorid):
     """
     source:mqtt:
+    DESCRIPTION:
+        converts a (stacked) data payload into a ndarray of KEYLIST columns.
+        The payload is split into a 2D array at once, numerical columns are
+        returned as float64 arrays divided by their multipliers.
     """
     # future: check for json payload first
 
-    lines = payload.split(';') # for multiple lines send within one payload
+    rows = [line.split(',') for line in payload.split(';')] # for multiple lines send within one payload
+    width = max(len(row) for row in rows)
+    if not all(len(row) == width for row in rows):
+        # might fail with list index out of range - pad missing elements
+        rows = [row + ['nan']*(width-len(row)) for row in rows]
+    data = np.asarray(rows)
+    array = [np.asarray([]) for elem in KEYLIST]
+
+    timear = data[:,:7].astype(np.int64)
+    timecol = (timear[:,0]-1970).astype('datetime64[Y]') + (timear[:,1]-1).astype('timedelta64[M]')
+    timecol = timecol.astype('datetime64[D]') + (timear[:,2]-1).astype('timedelta64[D]')
+    timecol = timecol.astype('datetime64[us]') + (((timear[:,3]*60 + timear[:,4])*60 + timear[:,5])*1000000 + timear[:,6]).astype('timedelta64[us]')
+    array[0] = np.asarray(date2num(timecol), dtype=np.float64)
+
     # allow for strings in payload !!
-    array = [[] for elem in KEYLIST]
-    keylist = po.identifier[sensorid+':keylist']
-    multilist = po.identifier[sensorid+':multilist']
-    for line in lines:
-        data = line.split(',')
-        timear = list(map(int,data[:7]))
-        #log.msg(timear)
-        time = datetime(timear[0],timear[1],timear[2],timear[3],timear[4],timear[5],timear[6])
-        array[0].append(date2num(time))
-        for idx, elem in enumerate(keylist):
+    for col, index, divisor, numerical in get_columnmap(sensorid):
+        if col >= width:
+            continue
+        if numerical:
             try:
-                index = KEYLIST.index(elem)
-                if not elem.endswith('time'):
-                    if elem in NUMKEYLIST:
-                        array[index].append(float(data[idx+7])/float(multilist[idx]))
-                    else:
-                        array[index].append(data[idx+7])
-            except:
-                # might fail with list index out of range - take all others
-                pass
+                array[index] = data[:,col].astype(np.float64)/divisor
+            except ValueError:
+                array[index] = np.asarray([_tofloat(el) for el in data[:,col]])/divisor
+        else:
+            array[index] = data[:,col]
 
-    return np.asarray([np.asarray(elem) for elem in array],dtype=object)
+    return np.asarray(array,dtype=object)
+
+def _tofloat(value):
+    try:
+        return float(value)
+    except:
+        return np.nan
 
 def datetime2array(t):
         return [t.year,t.month,t.day,t.hour,t.minute,t.second,t.microsecond]
@@ -462,62 +779,42 @@ def on_message(client, userdata, msg):
                 # -------------------
                 if sensorid in headdict:
                     header = headdict.get(sensorid)
-                    if sys.version_info >= (3,0):
-                        metacheck = metacheck.decode()
-                    if metacheck.endswith('B'):
-                        packcode = metacheck.strip('<')[:-1] # drop leading < and final B
-                    else:
-                        packcode = metacheck.strip('<') # drop leading <
+                    decoder = get_decoder(sensorid)
                     # temporary code - too be deleted when lemi protocol has been updated
-                    if packcode.find('4cb6B8hb30f3Bc') >= 0:
+                    if decoder.packcode == '6hLffflll':
                         header = header.replace('<4cb6B8hb30f3BcBcc5hL 169\n','6hLffflll {}'.format(struct.calcsize('<6hLffflll')))
-                        packcode = '6hLffflll' 
-                    arrayelem = msg.payload.split(';')
-                    for ar in arrayelem:
-                        datearray = ar.split(',')
-                        # identify string values in packcode
-                        # -------------------
-                        # convert packcode numbers
-                        cpack = []
-                        for c in packcode:
-                            if c.isdigit():
-                                digit = int(c)
-                            else:
-                                cpack.extend([c] * digit)
-                                digit=1
-                        cpackcode = "".join(cpack)
-                        for i in range(len(cpackcode)):
-                            if cpackcode[-i] == 's':
-                                datearray[-i] = datearray[-i]
-                            elif cpackcode[-i] == 'f':
-                                datearray[-i] = float(datearray[-i])
-                            else:
-                                datearray[-i] = int(float(datearray[-i]))
-                        # pack data using little endian byte order
-                        data_bin = struct.pack('<'+packcode,*datearray)
-                        # Check whether destination path has been verified already
-                        # -------------------
-                        if not verifiedlocation:
-                            if not location in [None,''] and os.path.exists(location):
-                                verifiedlocation = True
-                            else:
-                                log.msg("File: destination location {} is not accessible".format(location))
-                                log.msg("      -> please use option l (e.g. -l '/my/path') to define") 
-                        if verifiedlocation:
-                            filename = "{}-{:02d}-{:02d}".format(datearray[0],datearray[1],datearray[2])
-                            acs.dataToFile(location, sensorid, filename, data_bin, header)
+                    # pack all lines of the payload at once using little endian byte order
+                    # -------------------
+                    records = decoder.decode(msg.payload)
+                    # Check whether destination path has been verified already
+                    # -------------------
+                    if not verifiedlocation:
+                        if not location in [None,''] and os.path.exists(location):
+                            verifiedlocation = True
+                        else:
+                            log.msg("File: destination location {} is not accessible".format(location))
+                            log.msg("      -> please use option l (e.g. -l '/my/path') to define") 
+                    if verifiedlocation:
+                        for filename, data_bin in records:
+                            try:
+                                acs.bufferwriter.write(location, sensorid, filename, data_bin, header, eol=False)
+                            except:
+                                log.msg("File: error while saving data of {}".format(sensorid))
             if 'websocket' in destination:
                 if not arrayinterpreted:
                     stream.ndarray = interprete_data(msg.payload, stream, sensorid)
                     #streamdict[sensorid] = stream.ndarray  # to store data from different sensors
                     arrayinterpreted = True
-                for idx,el in enumerate(stream.ndarray[0]):
-                    time = num2date(el).replace(tzinfo=None)
-                    msecSince1970 = int((time - datetime(1970,1,1)).total_seconds()*1000)
-                    datastring = ','.join([str(val[idx]) for i,val in enumerate(stream.ndarray) if len(val) > 0 and not i == 0])
+                msecs = np.round((stream.ndarray[0] - date2num(datetime(1970,1,1)))*86400000.).astype(np.int64)
+                columns = [val for i,val in enumerate(stream.ndarray) if len(val) > 0 and not i == 0]
+                messages = []
+                for idx,msecSince1970 in enumerate(msecs):
+                    datastring = ','.join([str(val[idx]) for val in columns])
                     if debug:
                         print ("Sending {}: {},{} to webserver".format(sensorid, msecSince1970,datastring))
-                    wsserver.send_message_to_all("{}: {},{}".format(sensorid,msecSince1970,datastring))
+                    messages.append("{}: {},{}".format(sensorid,msecSince1970,datastring))
+                # queued per client and sent in batches by the websocket server
+                wsserver.broadcast(messages)
             if 'diff' in destination:
                 global counter
                 counter+=1
@@ -595,9 +892,9 @@ def on_message(client, userdata, msg):
                 if debug:
                     log.msg("writing header: {}".format(headstream[sensorid]))
                 if revision != 'free':
-                    writeDB(db,stream,tablename="{}_{}".format(sensorid,'0001'))
+                    dbqueue.put(stream.ndarray,stream.header,tablename="{}_{}".format(sensorid,'0001'))
                 else:
-                    writeDB(db,stream)
+                    dbqueue.put(stream.ndarray,stream.header)
             elif 'stringio' in destination:
                 if not arrayinterpreted:
                     stream.ndarray = interprete_data(msg.payload, stream, sensorid)
@@ -680,6 +977,7 @@ def on_message(client, userdata, msg):
     if msg.topic.endswith('meta') and 'websocket' in destination:
         # send header info for each element (# sensorid   nr   key   elem   unit)
         analyse_meta(str(msg.payload),sensorid)
+        headers = []
         for (i,void) in enumerate(po.identifier[sensorid+':keylist']):
             jsonstr={}
             jsonstr['sensorid'] = sensorid
@@ -688,7 +986,9 @@ def on_message(client, userdata, msg):
             jsonstr['elem'] = po.identifier[sensorid+':elemlist'][i]
             jsonstr['unit'] = po.identifier[sensorid+':unitlist'][i]
             payload = json.dumps(jsonstr)
-            wsserver.send_message_to_all('# '+payload)
+            headers.append('# '+payload)
+        # headers are never dropped for slow clients
+        wsserver.broadcast(headers, droppable=False)
 
 
 def main(argv):
@@ -749,6 +1049,12 @@ def main(argv):
     blacklist = []
     global concount
     concount = 0
+    dbbatchsize = 500
+    dbbatchdelay = 5.0
+    dbqueuesize = 100000
+    wsbatchwindow = 0.1
+    wsqueuesize = 1000
+    wsbinary = False
 
 
     usagestring = 'collector.py -b <broker> -p <port> -t <timeout> -o <topic> -i <instrument> -d <destination> -v <revision> -l <location> -c <credentials> -r <dbcred> -q <qos> -u <user> -P <password> -s <source> -f <offset> -m <marcos> -n <number> -e <telegramconf> -a <addlib>'
@@ -859,6 +1165,12 @@ def main(argv):
                 dbcred=conf.get('databasecredentials').strip()
             if not conf.get('revision','') in ['','-']:
                 destination=conf.get('revision').strip()
+            if not conf.get('dbbatchsize','') in ['','-']:
+                dbbatchsize = int(conf.get('dbbatchsize').strip())
+            if not conf.get('dbbatchdelay','') in ['','-']:
+                dbbatchdelay = float(conf.get('dbbatchdelay').strip())
+            if not conf.get('dbqueuesize','') in ['','-']:
+                dbqueuesize = int(conf.get('dbqueuesize').strip())
             if not conf.get('offset','') in ['','-']:
                 offset = conf.get('offset').strip()
             if not conf.get('debug','') in ['','-']:
@@ -881,6 +1193,12 @@ def main(argv):
                     webport = 8080
             if not conf.get('webpath','') in ['','-']:
                 webpath = conf.get('webpath').strip()
+            if not conf.get('wsbatchwindow','') in ['','-']:
+                wsbatchwindow = float(conf.get('wsbatchwindow').strip())
+            if not conf.get('wsqueuesize','') in ['','-']:
+                wsqueuesize = int(conf.get('wsqueuesize').strip())
+            if conf.get('wsbinary','').strip() in ['True','true']:
+                wsbinary = True
             if not conf.get('telegramconf','') in ['','-']:
                 telegramconf = conf.get('telegramconf').strip()
             if not conf.get('addlib','') in ['','-']:
@@ -992,7 +1310,7 @@ def main(argv):
         if ws_available:
             # 0.0.0.0 makes the websocket accessable from anywhere
             global wsserver
-            wsserver = WebsocketServer(socketport, host='0.0.0.0')
+            wsserver = WebsocketServer(socketport, host='0.0.0.0', batchwindow=wsbatchwindow, maxqueue=wsqueuesize, binary=wsbinary)
             wsThr = threading.Thread(target=wsThread,args=(wsserver,))
             # start websocket-server in a thread as daemon, so the entire Python program exits
             wsThr.daemon = True
@@ -1022,6 +1340,10 @@ def main(argv):
                 log.msg('database {} at host {} with user {} could not be connected'.format(mpcred.lc(dbcred,'db'),mpcred.lc(dbcred,'host'),mpcred.lc(dbcred,'user')))
                 log.msg(' ... aborting ...')
                 sys.exit()
+            global dbqueue
+            dbqueue = DBWriteQueue(db, batchsize=dbbatchsize, maxdelay=dbbatchdelay, maxrows=dbqueuesize, debug=debug)
+            dbqueue.start()
+            atexit.register(dbqueue.stop)
 
     if debug:
         log.msg("Option u: debug mode switched on ...")
@@ -1030,7 +1352,18 @@ def main(argv):
 
     if source == 'mqtt':
         client = connectclient(broker, port, timeout, credentials, user, password, qos, destinationid=dbcred, debug=debug) # dbcred is used for clientid
+
+        def shutdown(signum, frame):
+            # atexit handlers are not called on SIGTERM - leave loop_forever
+            # and write the queued data below
+            log.msg("Received signal {} - disconnecting".format(signum))
+            client.disconnect()
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+
         client.loop_forever()
+        if dbqueue:
+            dbqueue.stop()
 
     elif source == 'wamp':
         log.msg("Not yet supported! -> check autobahn import, crossbario")
@@ -17,8 +17,20 @@ import re     # for interpretation of lines
 import struct # for binary representation
 import socket # for hostname identification
 import string # for ascii selection
+import threading
+import atexit
+import heapq
+import weakref
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from twisted.python import log
+try: # Python2.7
+    import Queue as queue
+except ImportError: # Python 3.x
+    import queue
+
+# monotonic clock is not available in python2
+monotonic = getattr(time, 'monotonic', time.time)
 
 SENSORELEMENTS =  ['sensorid','port','baudrate','bytesize','stopbits', 'parity','mode','init','rate','stack','protocol','name','serialnumber','revision','path','pierid','ptime','sensorgroup','sensordesc']
 
@@ -41,6 +53,99 @@ def connect(parameter):
     return ser
 
 
+def _tobytes(value):
+    if isinstance(value, bytes):
+        return value
+    return value.encode('latin-1')
+
+
+class LineReader(object):
+    """
+    DESCRIPTION:
+       Buffered line reader for serial ports. All bytes available at the port
+       are read at once, terminators are searched within the buffer and bytes
+       following a terminator are kept for the next call. The port timeout is
+       adjusted to the remaining time, so that waiting for data does not
+       require polling.
+    PARAMETERS:
+       ser:        serial port (pyserial or any object with read())
+       chunksize:  maximal amount of bytes read at once
+    APPLICATION:
+       reader = LineReader(ser)
+       line = reader.readline(eol=['\r','\x00','\n'], timelimit=30)
+    """
+    def __init__(self, ser, chunksize=4096):
+        self.ser = ser
+        self.chunksize = chunksize
+        self.buffer = bytearray()
+
+    def _available(self):
+        try:
+            return self.ser.in_waiting
+        except AttributeError:
+            try:
+                return self.ser.inWaiting()   # pyserial < 3.0
+            except AttributeError:
+                return 0
+
+    def _find(self, terminators, start):
+        # earliest terminator, the longest one if several start at the same position
+        found, length = -1, 0
+        for term in terminators:
+            pos = self.buffer.find(term, start)
+            if pos >= 0 and (found < 0 or pos < found or (pos == found and len(term) > length)):
+                found, length = pos, len(term)
+        return found, length
+
+    def readline(self, eol=None, timelimit=30):
+        """
+        DESCRIPTION:
+           return all bytes up to the next terminator (excluded). If no
+           terminator is received within timelimit seconds, the bytes
+           received so far are returned.
+        PARAMETERS:
+           eol:        (string or list) terminator(s), default '\r\n','\r','\x00','\n'
+        """
+        if not eol:
+            terminators = [b'\r\n', b'\r', b'\x00', b'\n']
+        elif isinstance(eol, (list, tuple)):
+            terminators = [_tobytes(el) for el in eol]
+        else:
+            terminators = [_tobytes(eol)]
+        maxlen = max([len(term) for term in terminators])
+        deadline = monotonic()+timelimit
+        portimeout = getattr(self.ser, 'timeout', None)
+        scanned = 0
+        try:
+            while True:
+                pos, length = self._find(terminators, max(0, scanned-maxlen+1))
+                if pos >= 0:
+                    line = bytes(self.buffer[:pos])
+                    del self.buffer[:pos+length]
+                    break
+                scanned = len(self.buffer)
+                remaining = deadline-monotonic()
+                if remaining <= 0:
+                    line = bytes(self.buffer)
+                    del self.buffer[:]
+                    break
+                amount = min(self._available(), self.chunksize)
+                if not amount:
+                    # block until at least one byte arrives or the deadline is reached
+                    amount = 1
+                    if portimeout is None or portimeout > remaining:
+                        self.ser.timeout = remaining
+                self.buffer.extend(self.ser.read(amount))
+        finally:
+            if not getattr(self.ser, 'timeout', None) == portimeout:
+                self.ser.timeout = portimeout
+        if sys.version_info >= (3, 0):
+            return line
+        return str(line)
+
+
+_linereaders = weakref.WeakKeyDictionary()
+
 def lineread(ser,eol=None,timelimit=30):
     """
     DESCRIPTION:
@@ -50,26 +155,21 @@ def lineread(ser,eol=None,timelimit=30):
        for the POS-1 magnetometer, '\r' for the envir. sensor.
        (Note: required for POS-1 because readline() cannot detect
        a linebreak and reads a never-ending line.)
+       Uses a LineReader for each port, so bytes following the
+       lineend are returned with the next call.
     PARAMETERS:
        eol:   (string) lineend character(s): can be any kind of lineend
                            if not provided, then standard eol's are used
     """
-    if not eol:
-        eollist = ['\r','\x00','\n']
-    else:
-        eollist = [eol]
-
-    timeout = time.time()+timelimit
-    ser_str = ''
-    while True:
-        char = ser.read()
-        #if char == '\x00':
-        if char in eollist:
-            break
-        if time.time() > timeout:
-            break
-        ser_str += char
-    return ser_str
+    try:
+        reader = _linereaders.get(ser)
+        if not reader:
+            reader = LineReader(ser)
+            _linereaders[ser] = reader
+    except TypeError:
+        # port objects without weak reference support
+        reader = LineReader(ser)
+    return reader.readline(eol=eol, timelimit=timelimit)
 
 
 def hexify_command(command,eol):
@@ -123,7 +223,7 @@ def send_command(ser,command,eol=None,hexify=False,bits=0,report=True):
         if not eol:
             ser.write(command)
         else:
-            ser.write(command+eol)
+            ser.write(command+_tobytes(eol))
     if bits==0:
         response = lineread(ser,eol)
     else:
@@ -153,41 +253,344 @@ def timeToArray(timestring):
         print('Error while extracting time array')
         return []
 
-def dataToFile(outputdir, sensorid, filedate, bindata, header):
-    # File Operations
-    try:
-        #hostname = socket.gethostname()
+class BufferHandle(object):
+    """
+    DESCRIPTION:
+        Open buffer file of one sensor and day as used by BufferWriter
+    """
+    def __init__(self, filedate, savefile, fh):
+        self.filedate = filedate
+        self.savefile = savefile
+        self.fh = fh
+        self.pending = 0
+        self.lastwrite = time.time()
+        self.lastflush = self.lastwrite
+
+
+class BufferWriter(object):
+    """
+    DESCRIPTION:
+        Keeps one open, buffered file handle for each (sensor, day) buffer file.
+        Replaces the open/write/close cycle of dataToFile for every single sample.
+        Handles are rolled over whenever the filedate of a sensor changes (midnight),
+        flushed if 'flushsize' bytes are pending or 'flushinterval' seconds passed,
+        optionally fsynced and closed when idle for 'idletime' seconds. If more
+        than 'maxopen' handles are open, the least recently used one is closed.
+    PARAMETERS:
+        flushsize:      (int) bytes written before flushing to disk
+        flushinterval:  (float) seconds after which pending data is flushed
+        fsync:          (bool) call os.fsync after each flush
+        maxopen:        (int) maximum amount of simultaneously open files
+        idletime:       (float) seconds after which an unused handle is closed
+    APPLICATION:
+        writer = BufferWriter(flushinterval=5)
+        writer.write('/srv/mqtt', 'ENV05_2_0001', '2021-11-11', data_bin, header)
+    """
+    def __init__(self, flushsize=8192, flushinterval=1.0, fsync=False, maxopen=32, idletime=300.0):
+        self.flushsize = int(flushsize)
+        self.flushinterval = float(flushinterval)
+        self.fsync = fsync
+        self.maxopen = max(1,int(maxopen))
+        self.idletime = float(idletime)
+        self.handles = OrderedDict()
+        self.lock = threading.Lock()
+        self.flushthread = None
+        self.running = False
+
+    def write(self, outputdir, sensorid, filedate, bindata, header, eol=True):
+        """
+        DESCRIPTION:
+            append bindata to the buffer file of sensorid and filedate.
+            header is written (followed by a linebreak) if the file is new.
+            If eol is True, a linebreak is appended to bindata.
+        """
+        key = (outputdir, sensorid)
+        with self.lock:
+            handle = self.handles.pop(key, None)
+            if handle and not handle.filedate == filedate:
+                # day rollover
+                self._close(handle)
+                handle = None
+            if not handle:
+                handle = self._open(outputdir, sensorid, filedate, header)
+            # reinsert as most recently used element
+            self.handles[key] = handle
+            data = _tobytes(bindata)
+            if eol:
+                data += b"\n"
+            handle.fh.write(data)
+            handle.pending += len(data)
+            handle.lastwrite = time.time()
+            if handle.pending >= self.flushsize or handle.lastwrite - handle.lastflush >= self.flushinterval:
+                self._flush(handle)
+            while len(self.handles) > self.maxopen:
+                oldkey, oldhandle = self.handles.popitem(last=False)
+                self._close(oldhandle)
+        if not self.running:
+            self._start()
+
+    def flush(self):
+        """
+        DESCRIPTION:
+            flush all open handles with pending data and close idle handles
+        """
+        now = time.time()
+        with self.lock:
+            for key in list(self.handles.keys()):
+                handle = self.handles[key]
+                if handle.pending > 0:
+                    self._flush(handle)
+                if now - handle.lastwrite > self.idletime:
+                    self._close(self.handles.pop(key))
+
+    def close(self):
+        """
+        DESCRIPTION:
+            flush and close all open handles
+        """
+        self.running = False
+        with self.lock:
+            while self.handles:
+                key, handle = self.handles.popitem()
+                self._close(handle)
+
+    def _open(self, outputdir, sensorid, filedate, header):
         path = os.path.join(outputdir,sensorid)
-        # outputdir defined in main options class
-        if not os.path.exists(path):
-            os.makedirs(path)
+        if not os.path.isdir(path):
+            try:
+                os.makedirs(path)
+            except:
+                print ("buffer {}: bufferdirectory could not be created - check permissions".format(sensorid))
+        savefile = os.path.join(path, sensorid+'_'+filedate+".bin")
+        newfile = not os.path.isfile(savefile)
+        fh = open(savefile, "ab", max(self.flushsize,1))
+        if newfile and header:
+            fh.write(_tobytes(header) + b"\n")
+        return BufferHandle(filedate, savefile, fh)
+
+    def _flush(self, handle):
+        try:
+            handle.fh.flush()
+            if self.fsync:
+                os.fsync(handle.fh.fileno())
+        except:
+            print("buffer {}: Error while flushing file".format(handle.savefile))
+        handle.pending = 0
+        handle.lastflush = time.time()
+
+    def _close(self, handle):
+        self._flush(handle)
+        try:
+            handle.fh.close()
+        except:
+            pass
+
+    def _run(self):
+        while self.running:
+            time.sleep(self.flushinterval)
+            self.flush()
+
+    def _start(self):
+        self.running = True
+        self.flushthread = threading.Thread(target=self._run)
+        self.flushthread.daemon = True
+        self.flushthread.start()
+
+
+def _tobytes(data):
+    if isinstance(data, bytes):
+        return data
+    return data.encode('utf-8')
+
+
+bufferwriter = BufferWriter()
+atexit.register(bufferwriter.close)
+
+
+def ConfigureBuffer(confdict):
+    """
+    DESCRIPTION:
+        set flush and eviction policy of the buffer file writer from martas.cfg
+        supported keys: bufferflushsize, bufferflushinterval, bufferfsync,
+                        buffermaxopen, bufferidletime
+    """
+    try:
+        bufferwriter.flushsize = int(confdict.get('bufferflushsize',bufferwriter.flushsize))
+        bufferwriter.flushinterval = float(confdict.get('bufferflushinterval',bufferwriter.flushinterval))
+        bufferwriter.fsync = str(confdict.get('bufferfsync',bufferwriter.fsync)) in ['True','true','1']
+        bufferwriter.maxopen = max(1,int(confdict.get('buffermaxopen',bufferwriter.maxopen)))
+        bufferwriter.idletime = float(confdict.get('bufferidletime',bufferwriter.idletime))
     except:
-        print ("buffer {}: bufferdirectory could not be created - check permissions".format(sensorid))
+        print ("buffer: could not read buffer writer configuration - using defaults")
+    return bufferwriter
+
+
+def dataToFile(outputdir, sensorid, filedate, bindata, header):
+    """
+    DESCRIPTION:
+        append a binary data line to the daily buffer file of sensorid.
+        Data is passed to the pooled bufferwriter, which keeps the file open.
+    """
     try:
-        savefile = os.path.join(path, sensorid+'_'+filedate+".bin")
-        if sys.version_info>(3,0,0):
-            if not os.path.isfile(savefile):
-                with open(savefile, "wb") as myfile:
-                    head = "{}{}".format(header,"\n")
-                    myfile.write(head.encode('utf-8'))
-                    myfile.write(bindata)
-                    myfile.write("\n".encode('utf-8'))
-            else:
-                with open(savefile, "ab") as myfile:
-                    myfile.write(bindata)
-                    myfile.write("\n".encode('utf-8'))
-        else:
-            if not os.path.isfile(savefile):
-                with open(savefile, "wb") as myfile:
-                    myfile.write(header + "\n")
-                    myfile.write("{}{}".format(bindata,"\n"))
-            else:
-                with open(savefile, "a") as myfile:
-                    myfile.write("{}{}".format(bindata,"\n"))
+        bufferwriter.write(outputdir, sensorid, filedate, bindata, header)
     except:
         print("buffer {}: Error while saving file".format(sensorid))
 
 
+class ScheduledJob(object):
+    """
+    DESCRIPTION:
+        Periodic job of the ActiveScheduler including timing statistics
+    """
+    def __init__(self, name, interval, func, group=None):
+        self.name = name
+        self.interval = float(interval)
+        self.func = func
+        self.group = group
+        self.nextrun = 0.0
+        self.running = False
+        self.runs = 0
+        self.overruns = 0    # ticks skipped because the previous call was still running
+        self.skipped = 0     # ticks coalesced because the scheduler was late
+        self.jittersum = 0.0
+        self.jittermax = 0.0
+        self.durationmax = 0.0
+
+    def statistics(self):
+        meanjitter = self.jittersum/self.runs if self.runs > 0 else 0.0
+        return {'runs':self.runs, 'overruns':self.overruns, 'skipped':self.skipped, 'meanjitter':meanjitter, 'maxjitter':self.jittermax, 'maxduration':self.durationmax}
+
+
+class ActiveScheduler(object):
+    """
+    DESCRIPTION:
+        Central scheduler for all active protocols. Replaces one threading.Timer
+        per interval and sensor. A single scheduler thread dispatches due jobs
+        to a fixed pool of worker threads on a monotonic clock with a fixed cadence
+        (next run = previous scheduled time + interval).
+        A job is never started while its previous call is still running (overrun),
+        ticks missed while the scheduler was late are coalesced into one call.
+        Optionally the amount of simultaneously running jobs of one group
+        (protocol) is limited by 'groupconcurrency'.
+    PARAMETERS:
+        workers:            (int) amount of worker threads
+        groupconcurrency:   (int) max running jobs per group, None for unlimited
+        reportinterval:     (float) seconds between statistics log messages, 0 to disable
+    APPLICATION:
+        scheduler = ActiveScheduler(workers=4)
+        scheduler.add('ENV05_2_0001', 10, protocol.sendRequest, group='Env')
+        scheduler.start()
+    """
+    def __init__(self, workers=4, groupconcurrency=None, reportinterval=3600):
+        self.workers = max(1,int(workers))
+        self.groupconcurrency = groupconcurrency
+        self.reportinterval = float(reportinterval)
+        self.jobs = []
+        self.heap = []
+        self.groups = {}
+        self.sequence = 0
+        self.condition = threading.Condition()
+        self.tasks = queue.Queue()
+        self.threads = []
+        self.running = False
+
+    def add(self, name, interval, func, group=None):
+        job = ScheduledJob(name, interval, func, group=group)
+        with self.condition:
+            job.nextrun = monotonic()
+            self.jobs.append(job)
+            self._push(job)
+            self.condition.notify()
+        return job
+
+    def _push(self, job):
+        self.sequence += 1
+        heapq.heappush(self.heap, (job.nextrun, self.sequence, job))
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        for i in range(self.workers):
+            worker = threading.Thread(target=self._work, name="scheduler-worker-{}".format(i))
+            worker.daemon = True
+            worker.start()
+            self.threads.append(worker)
+        main = threading.Thread(target=self._run, name="scheduler")
+        main.daemon = True
+        main.start()
+        self.threads.append(main)
+
+    def stop(self):
+        self.running = False
+        with self.condition:
+            self.condition.notify()
+        for i in range(self.workers):
+            self.tasks.put(None)
+
+    def _run(self):
+        lastreport = monotonic()
+        while self.running:
+            with self.condition:
+                if not self.heap:
+                    self.condition.wait(1.0)
+                    continue
+                scheduled, seq, job = self.heap[0]
+                now = monotonic()
+                if scheduled > now:
+                    self.condition.wait(scheduled-now)
+                    continue
+                heapq.heappop(self.heap)
+                grouprunning = self.groups.get(job.group,0)
+                if job.running or (self.groupconcurrency and grouprunning >= self.groupconcurrency):
+                    job.overruns += 1
+                else:
+                    job.running = True
+                    self.groups[job.group] = grouprunning + 1
+                    self.tasks.put((job, scheduled))
+                # fixed cadence: coalesce all ticks which are already in the past
+                job.nextrun = scheduled + job.interval
+                if job.nextrun <= now:
+                    missed = int((now - job.nextrun)/job.interval) + 1
+                    job.skipped += missed
+                    job.nextrun += missed*job.interval
+                self._push(job)
+            if self.reportinterval > 0 and monotonic() - lastreport > self.reportinterval:
+                lastreport = monotonic()
+                self.report()
+
+    def _work(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+            job, scheduled = task
+            start = monotonic()
+            try:
+                job.func()
+            except Exception as e:
+                log.msg("Scheduler: job {} failed: {}".format(job.name, e))
+            end = monotonic()
+            with self.condition:
+                jitter = start - scheduled
+                job.runs += 1
+                job.jittersum += jitter
+                job.jittermax = max(job.jittermax, jitter)
+                job.durationmax = max(job.durationmax, end-start)
+                job.running = False
+                self.groups[job.group] = self.groups.get(job.group,1) - 1
+
+    def statistics(self):
+        with self.condition:
+            return dict((job.name, job.statistics()) for job in self.jobs)
+
+    def report(self):
+        stats = self.statistics()
+        for name in stats:
+            st = stats[name]
+            log.msg("Scheduler: {} - runs {}, overruns {}, skipped {}, jitter mean {:.4f} s max {:.4f} s, max duration {:.3f} s".format(name, st['runs'], st['overruns'], st['skipped'], st['meanjitter'], st['maxjitter'], st['maxduration']))
+
+
 def dataToCSV(outputdir, sensorid, filedate, asciidata, header):
     """
     Writing buffer data to an ASCII file
@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+# MARTAS frame parser
+
+## 1. INTRODUCTION
+
+frameparser.py contains frame extractors for binary serial data streams.
+Incoming chunks are copied once into a preallocated bytearray. Complete frames
+are returned as memoryview slices of this buffer, so that no intermediate
+strings are created when searching for frame boundaries.
+Returned frames are only valid until the next call of feed(). Use bytes(frame)
+if a frame needs to be kept.
+
+## 2. APPLICATION
+
+>from core.frameparser import StartTagFrameParser
+>parser = StartTagFrameParser(b'L025', 153)
+>for frame in parser.feed(data):
+>    process(frame)
+
+StartTagFrameParser is used by libmqtt and libwamp lemiprotocol.
+
+>from core.frameparser import TerminatorFrameParser
+>parser = TerminatorFrameParser(b'\x00', 44)
+>for frame in parser.feed(data):
+>    process(frame)
+
+TerminatorFrameParser is used by libmqtt pos1protocol.
+
+"""
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+
+class StartTagFrameParser(object):
+    """
+    DESCRIPTION:
+        Extracts fixed length frames which begin with a start-of-line tag
+        (e.g. LEMI: 153 bytes starting with 'L025').
+        A frame is accepted if it starts with the tag and either the following
+        bytes start with the tag as well or, if no further bytes are available
+        yet, no tag is found within the frame. Otherwise the parser
+        resynchronises on the next tag. Bytes in front of a partial tag are
+        dropped, so that they are not scanned again.
+    PARAMETERS:
+        soltag:         (bytes) start-of-line tag
+        framelength:    (int) length of a frame including the tag
+        capacity:       (int) amount of frames which fit into the buffer
+    COUNTERS:
+        frames:         accepted frames
+        resyncs:        amount of resynchronisations
+        discarded:      bytes dropped while resynchronising
+    """
+    def __init__(self, soltag, framelength, capacity=16):
+        if not isinstance(soltag, (bytes, bytearray)):
+            soltag = soltag.encode('ascii')
+        self.soltag = bytes(soltag)
+        self.taglength = len(self.soltag)
+        self.framelength = int(framelength)
+        self.buffer = bytearray(self.framelength*max(2,int(capacity)))
+        self.view = memoryview(self.buffer)
+        self.start = 0      # first valid byte
+        self.end = 0        # end of valid bytes
+        self.frames = 0
+        self.resyncs = 0
+        self.discarded = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def reset(self):
+        self.start = 0
+        self.end = 0
+
+    def _append(self, data):
+        size = len(data)
+        if self.end + size > len(self.buffer):
+            # move remaining bytes (less than a few frames) to the front
+            remaining = self.end - self.start
+            if remaining + size > len(self.buffer):
+                # grow buffer - happens only if very large chunks arrive at once
+                newbuffer = bytearray(max(2*len(self.buffer), remaining+size))
+                newbuffer[:remaining] = self.view[self.start:self.end]
+                self.buffer = newbuffer
+                self.view = memoryview(self.buffer)
+            else:
+                self.buffer[:remaining] = self.buffer[self.start:self.end]
+            self.start = 0
+            self.end = remaining
+        self.buffer[self.end:self.end+size] = data
+        self.end += size
+
+    def _drop(self, position):
+        # drop everything before position
+        self.discarded += position - self.start
+        self.resyncs += 1
+        self.start = position
+
+    def feed(self, data):
+        """
+        DESCRIPTION:
+            add a chunk of data and return a list of complete frames (memoryview)
+        """
+        self._append(data)
+        frames = []
+        buf = self.buffer
+        while self.end - self.start >= self.taglength:
+            if not buf.startswith(self.soltag, self.start):
+                # resynchronise on the next tag
+                pos = buf.find(self.soltag, self.start+1, self.end)
+                if pos < 0:
+                    # keep the last bytes which might be the beginning of a tag
+                    self._drop(self.end - self.taglength + 1)
+                    break
+                self._drop(pos)
+                continue
+            frameend = self.start + self.framelength
+            if frameend > self.end:
+                break
+            if self.end - frameend < self.taglength:
+                # following tag not yet available: accept only if no tag is found within the frame
+                if buf.find(self.soltag, self.start+1, frameend) >= 0:
+                    break
+            elif not buf.startswith(self.soltag, frameend):
+                # frame is not followed by a tag - lost or inserted bytes: resync on next tag
+                pos = buf.find(self.soltag, self.start+1, self.end)
+                if pos < 0:
+                    self._drop(self.end - self.taglength + 1)
+                    break
+                self._drop(pos)
+                continue
+            frames.append(self.view[self.start:frameend])
+            self.frames += 1
+            self.start = frameend
+        if self.start == self.end:
+            self.start = 0
+            self.end = 0
+        return frames
+
+
+class TerminatorFrameParser(object):
+    """
+    DESCRIPTION:
+        Extracts fixed length frames which end with a terminator
+        (e.g. POS1: 44 bytes ending with '\x00').
+        Bytes up to and including the next terminator form a frame
+        candidate. Candidates of the expected length are accepted. Shorter
+        candidates (lost bytes) are dropped and the parser continues with
+        the bytes following their terminator. Of longer candidates (inserted
+        bytes or lost terminator) only the last framelength bytes are used.
+        Neighbouring frames are therefore not affected by a corrupted frame.
+    PARAMETERS:
+        terminator:     (bytes) end-of-frame sequence
+        framelength:    (int) length of a frame including the terminator
+        capacity:       (int) amount of frames which fit into the buffer
+    COUNTERS:
+        frames:         accepted frames
+        lost:           frame candidates of wrong length
+        resyncs:        amount of resynchronisations
+        discarded:      bytes dropped while resynchronising
+    """
+    def __init__(self, terminator, framelength, capacity=16):
+        if not isinstance(terminator, (bytes, bytearray)):
+            terminator = terminator.encode('ascii')
+        self.terminator = bytes(terminator)
+        self.termlength = len(self.terminator)
+        self.framelength = int(framelength)
+        self.buffer = bytearray(self.framelength*max(2,int(capacity)))
+        self.view = memoryview(self.buffer)
+        self.start = 0      # first valid byte
+        self.end = 0        # end of valid bytes
+        self.scanned = 0    # position up to which no terminator was found
+        self.frames = 0
+        self.lost = 0
+        self.resyncs = 0
+        self.discarded = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def reset(self):
+        self.start = 0
+        self.end = 0
+        self.scanned = 0
+
+    def statistics(self):
+        return {'frames':self.frames, 'lost':self.lost, 'resyncs':self.resyncs, 'discarded':self.discarded}
+
+    def _append(self, data):
+        size = len(data)
+        if self.end + size > len(self.buffer):
+            remaining = self.end - self.start
+            if remaining + size > len(self.buffer):
+                newbuffer = bytearray(max(2*len(self.buffer), remaining+size))
+                newbuffer[:remaining] = self.view[self.start:self.end]
+                self.buffer = newbuffer
+                self.view = memoryview(self.buffer)
+            else:
+                self.buffer[:remaining] = self.buffer[self.start:self.end]
+            self.scanned -= self.start
+            self.start = 0
+            self.end = remaining
+        self.buffer[self.end:self.end+size] = data
+        self.end += size
+
+    def _drop(self, position):
+        # drop everything before position
+        self.discarded += position - self.start
+        self.resyncs += 1
+        self.start = position
+
+    def feed(self, data):
+        """
+        DESCRIPTION:
+            add a chunk of data and return a list of complete frames (memoryview)
+        """
+        self._append(data)
+        frames = []
+        buf = self.buffer
+        while True:
+            pos = buf.find(self.terminator, max(self.start, self.scanned), self.end)
+            if pos < 0:
+                self.scanned = max(self.start, self.end - self.termlength + 1)
+                if self.end - self.start > self.framelength:
+                    # no terminator within a frame length - keep only the last bytes
+                    self._drop(self.end - self.framelength + 1)
+                break
+            frameend = pos + self.termlength
+            if frameend - self.start < self.framelength:
+                # lost bytes - continue after the terminator
+                self.lost += 1
+                self._drop(frameend)
+            else:
+                if frameend - self.start > self.framelength:
+                    # inserted bytes or lost terminator - the frame ends at the terminator
+                    self.lost += 1
+                    self._drop(frameend - self.framelength)
+                frames.append(self.view[self.start:frameend])
+                self.frames += 1
+                self.start = frameend
+            self.scanned = self.start
+        if self.start == self.end:
+            self.reset()
+        return frames
@@ -47,6 +47,14 @@ Contents of a telegram configuration file are produced as follows: The token is
 
 see MARTAS/conf/mail.cfg
 
+## 5. DISPATCHER
+
+All martaslog objects of a process share one Dispatcher (see dispatcher()). The dispatcher
+keeps the status dictionaries of all logfiles in memory and writes them atomically. Changes
+are collected for debounce seconds (martaslog(...,debounce=2)) and then sent as one message per
+receiver. MQTT and SMTP connections are kept open and reused. Pending messages are sent when
+the process ends.
+
 """
 
 from __future__ import print_function
@@ -60,6 +68,9 @@ from datetime import datetime
 import paho.mqtt.client as mqtt
 import json
 import socket
+import time
+import atexit
+import threading
 
 #import subprocess
 #from subprocess import check_call
@@ -78,9 +89,42 @@ except:
     pass
 
 
-def sendmail(dic):
+def _smtpconnect(dic):
+    """
+    Open and return an authenticated SMTP connection
+    """
+    if 'port' in dic:
+        port = int(dic['port'])
+    else:
+        port = None
+    if 'user' in dic:
+        user = dic['user']
+    else:
+        user = ''
+    # seems as if server name needs to be specified in py3.7 and 3.8, should work in older versions as well
+    if port in [465]:
+        smtp = SMTP_SSL(dic.get('smtpserver'))
+    else:
+        smtp = SMTP(dic.get('smtpserver'))
+    smtp.set_debuglevel(False)
+    if port:
+        smtp.connect(dic.get('smtpserver'), port)
+    else:
+        smtp.connect(dic.get('smtpserver'))
+    smtp.ehlo()
+    if port in [587]:
+        print ("Using tls")
+        smtp.starttls()
+    smtp.ehlo()
+    if user and not user in ['None','False']:
+        smtp.login(user, dic.get('pwd'))
+    return smtp
+
+
+def sendmail(dic, smtp=None):
     """
     Function for sending mails with attachments
+    An open connection (see _smtpconnect) can be provided as smtp, which will not be closed
     """
 
     #if not smtpserver:
@@ -93,7 +137,7 @@ def sendmail(dic):
         text = 'Cheers, Your Analysis-Robot'
     if not 'Subject' in dic:
         dic['Subject'] = 'Automatic message'
-    if 'mailcred' in dic:
+    if 'mailcred' in dic and not 'pwd' in dic:
         ## import credential routine
         import magpy.opt.cred as cred
         #read credentials
@@ -102,14 +146,6 @@ def sendmail(dic):
         dic['user'] = cred.lc(dic.get('mailcred'),'user')
         dic['pwd'] = cred.lc(dic.get('mailcred'),'passwd')
         #dic['port'] = cred.lc(dic.get('mailcred'),'port') ## port is currently not stored by addcred
-    if 'port' in dic:
-        port = int(dic['port'])
-    else:
-        port = None
-    if 'user' in dic:
-        user = dic['user']
-    else:
-        user = ''
 
     msg = MIMEMultipart()
     msg['From'] = dic['From']
@@ -132,25 +168,200 @@ def sendmail(dic):
         part.add_header('Content-Disposition', 'attachment; filename="%s"' % os.path.basename(f))
         msg.attach(part)
 
-    # seems as if server name needs to be specified in py3.7 and 3.8, should work in older versions as well
-    if port in [465]:
-        smtp = SMTP_SSL(dic.get('smtpserver'))
-    else:
-        smtp = SMTP(dic.get('smtpserver'))
-    smtp.set_debuglevel(False)
-    if port:
-        smtp.connect(dic.get('smtpserver'), port)
+    if smtp:
+        smtp.sendmail(send_from, send_to, msg.as_string())
     else:
-        smtp.connect(dic.get('smtpserver'))
-    smtp.ehlo()
-    if port in [587]:
-        print ("Using tls")
-        smtp.starttls()
-    smtp.ehlo()
-    if user and not user in ['None','False']:
-        smtp.login(user, dic.get('pwd'))
-    smtp.sendmail(send_from, send_to, msg.as_string())
-    smtp.close()
+        smtp = _smtpconnect(dic)
+        smtp.sendmail(send_from, send_to, msg.as_string())
+        smtp.close()
+
+
+class Dispatcher(object):
+    """
+    DESCRIPTION:
+        Process wide delivery of martaslog notifications.
+        Status dictionaries are kept in memory and written atomically.
+        Changes for the same receiver are collected within debounce seconds
+        and sent as a single message. MQTT clients and SMTP connections are
+        kept open and reused. MQTT messages are sent synchronously (network
+        loop called until the broker acknowledged them) - no thread is started,
+        so that pending messages can be sent by the atexit flush as well.
+    APPLICATION:
+        Used by martaslog - obtain the shared object with dispatcher()
+    """
+    def __init__(self, debounce=2.0):
+        self.debounce = float(debounce)
+        self.lock = threading.RLock()
+        self.states = {}        # logfile: status dictionary
+        self.pending = {}       # receiver key: {'receiver', 'options', 'changes'}
+        self.connections = {}   # receiver key: mqtt client or smtp connection
+        self.mailconfigs = {}   # mail config path: configuration dictionary
+        self.timer = None
+        atexit.register(self.close)
+
+    def state(self, logfile):
+        """
+        DESCRIPTION:
+            return a copy of the status dictionary of logfile or None if not existing
+        """
+        with self.lock:
+            if not logfile in self.states:
+                if not os.path.isfile(logfile):
+                    return None
+                with open(logfile, 'r') as file:
+                    self.states[logfile] = json.load(file)
+                print ("Logfile {} loaded".format(logfile))
+            return dict(self.states[logfile])
+
+    def store(self, logfile, logdict):
+        with self.lock:
+            self.states[logfile] = dict(logdict)
+            tmpfile = logfile+'.tmp'
+            with open(tmpfile, 'w') as file:
+                file.write(json.dumps(logdict)) # use `json.loads` to do the reverse
+            os.rename(tmpfile, logfile)
+
+    def submit(self, receiver, options, changes):
+        """
+        DESCRIPTION:
+            queue changes for receiver - sent after debounce seconds together
+            with all other changes for the same receiver
+        """
+        key = "{}:{}".format(receiver, json.dumps(options, sort_keys=True, default=str))
+        with self.lock:
+            entry = self.pending.setdefault(key, {'receiver':receiver, 'options':dict(options), 'changes':{}})
+            entry['changes'].update(changes)
+            if self.debounce > 0:
+                if not self.timer:
+                    timer = threading.Timer(self.debounce, self.flush)
+                    timer.daemon = True
+                    try:
+                        timer.start()
+                        self.timer = timer
+                        return
+                    except RuntimeError:
+                        # interpreter shutting down - no new threads, send now
+                        pass
+                else:
+                    return
+        self.flush()
+
+    def flush(self):
+        """
+        DESCRIPTION:
+            send all pending changes
+        """
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+            if self.timer:
+                self.timer.cancel()
+                self.timer = None
+            for key in pending:
+                entry = pending.get(key)
+                try:
+                    self._send(key, entry.get('receiver'), entry.get('options'), entry.get('changes'))
+                except Exception as e:
+                    print ("Sending notification to {} failed: {}".format(entry.get('receiver'), e))
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            for key in self.connections:
+                try:
+                    conn = self.connections.get(key)
+                    if key.startswith('mqtt'):
+                        conn.disconnect()
+                    else:
+                        conn.quit()
+                except Exception:
+                    pass
+            self.connections = {}
+
+    def _send(self, key, receiver, options, dictionary):
+        if receiver == 'mqtt':
+            self._mqtt(key, options, dictionary)
+            print ('Update sent to MQTT')
+        elif receiver == 'telegram':
+            # requires a existing configuration file for telegram_send
+            # to create one use:
+            # python
+            # import telegram_send
+            # telegram_send.configure("/path/to/my/telegram.cfg",channel=True)
+            import telegram_send
+            telegram_send.send(messages=[_text(dictionary)],conf=options.get('config'),parse_mode="markdown")
+            print ('Update sent to telegram')
+        elif receiver == 'email':
+            self._email(key, options, dictionary)
+            print ('Update sent to email')
+        elif receiver == 'log':
+            print ('Updating logfile only')
+        else:
+            print ("Given receiver is not yet supported")
+
+    def _mqtt(self, key, options, dictionary):
+        client = self.connections.get(key)
+        if client and not client.loop(timeout=0.01) == 0:
+            # pooled connection lost (e.g. keepalive expired) - reconnect
+            self.connections.pop(key, None)
+            client = None
+        if not client:
+            mqttuser = options.get('user')
+            client = mqtt.Client(options.get('client'))
+            if not mqttuser == None:
+                client.username_pw_set(username=mqttuser, password=options.get('password'))
+            print (options.get('broker'), options.get('port'), options.get('delay'))
+            client.connect(options.get('broker'), int(options.get('port')), int(options.get('delay')))
+            self.connections[key] = client
+        topic = "{}/{}/{}".format(options.get('stationid'),"statuslog",options.get('hostname'))
+        print ("Done. Topic={},".format(topic))
+        info = client.publish(topic,json.dumps(dictionary),qos=int(options.get('qos',1)))
+        # run the network loop in this thread until the broker acknowledged the message
+        timeout = time.time() + int(options.get('delay'))
+        while not info.is_published() and time.time() < timeout:
+            if not client.loop(timeout=0.1) == 0:
+                break
+        if not info.is_published():
+            self.connections.pop(key, None)
+            raise IOError("message not acknowledged by {}".format(options.get('broker')))
+
+    def _email(self, key, options, dictionary):
+        import acquisitionsupport as acs
+        config = options.get('config')
+        if not config in self.mailconfigs:
+            self.mailconfigs[config] = acs.GetConf(config)
+        dic = self.mailconfigs.get(config)
+        dic['Text'] = _text(dictionary)
+        smtp = self.connections.get(key)
+        if smtp:
+            try:
+                sendmail(dic, smtp=smtp)
+                return
+            except Exception:
+                # connection closed by server - reconnect once
+                self.connections.pop(key, None)
+        smtp = _smtpconnect(dic)
+        self.connections[key] = smtp
+        sendmail(dic, smtp=smtp)
+
+
+def _text(dictionary):
+    msg = ''
+    for elem in dictionary:
+        msg += "{}: {}\n".format(elem, dictionary[elem])
+    return msg
+
+
+_dispatcher = None
+
+def dispatcher():
+    """
+    Return the dispatcher shared by all martaslog objects of this process
+    """
+    global _dispatcher
+    if _dispatcher is None:
+        _dispatcher = Dispatcher()
+    return _dispatcher
 
 
 class martaslog(object):
@@ -158,8 +369,8 @@ class martaslog(object):
     Class for dealing with and sending out change notifications
     of acquisition and analysis states
     """
-    def __init__(self, logfile='/var/log/magpy/martasstatus.log', receiver='mqtt',loglevel='1'):
-        self.mqtt = {'broker':'localhost','delay':60,'port':1883,'stationid':'wic', 'client':'P1','user':None,'password':None}
+    def __init__(self, logfile='/var/log/magpy/martasstatus.log', receiver='mqtt',loglevel='1',debounce=None):
+        self.mqtt = {'broker':'localhost','delay':60,'port':1883,'stationid':'wic', 'client':'P1','user':None,'password':None,'qos':1}
         self.telegram = {'config':"/home/leon/telegramtest.conf"}
         self.email = {'config':"/etc/martas/mail.cfg"}
         self.logfile = logfile
@@ -168,15 +379,16 @@ class martaslog(object):
         self.loglevel = loglevel  # 1: only mark changes, don't remove non-existing inputs
                                   # 0: record all changes, remove info, which is not existing any more
         # requires json, socket etc
+        self.dispatcher = dispatcher()
+        if debounce is not None:
+            self.dispatcher.debounce = float(debounce)
 
     def updatelog(self,logfile,logdict):
         changes={}
-        if os.path.isfile(logfile):
-            # read log if exists and exentually update changed information
+        exlogdict = self.dispatcher.state(logfile)
+        if exlogdict is not None:
+            # eventually update changed information
             # return changes
-            with open(logfile, 'r') as file:
-                exlogdict = json.load(file)
-            print ("Logfile {} loaded".format(logfile))
             for el in logdict:
                 if not el in exlogdict:
                     # Adding new sensor and state
@@ -189,9 +401,9 @@ class martaslog(object):
                         # state changed
                         changes[el] = logdict[el]
             ## check for element in exlogdict which are not in logdict
+            print ("Checking for elements in existing log too be removed")
+            print ("loglevel: {}".format(self.loglevel))
             for el in exlogdict:
-                print ("Checking for elements in existing log too be removed")
-                print ("loglevel: {}".format(self.loglevel))
                 if not el in logdict:
                     if self.loglevel == '0':
                         # Sensor has been removed
@@ -203,12 +415,10 @@ class martaslog(object):
                 print ("-------------")
                 print ("Changes found")
                 print ("-------------")
-                with open(logfile, 'w') as file:
-                    file.write(json.dumps(logdict)) # use `json.loads` to do the reverse
+                self.dispatcher.store(logfile, logdict)
         else:
             # write logdict to file
-            with open(logfile, 'w') as file:
-                file.write(json.dumps(logdict)) # use `json.loads` to do the reverse
+            self.dispatcher.store(logfile, logdict)
             print ("Logfile {} written successfully".format(logfile))
 
         return changes
@@ -221,57 +431,23 @@ class martaslog(object):
 
 
     def notify(self, dictionary):
+        """
+        Queue changes for delivery - changes of all martaslog objects for the same receiver
+        are sent as one message after the debounce time (or at the latest when the process ends)
+        """
         #if receiver == "stdout":
         print ("Changed content:", dictionary)
 
         if self.receiver == 'mqtt':
-            stationid = self.mqtt.get('stationid')
-            broker = self.mqtt.get('broker')
-            mqttport = self.mqtt.get('port')
-            mqttdelay = self.mqtt.get('delay')
-            client = self.mqtt.get('client')
-            mqttuser = self.mqtt.get('user')
-            mqttpassword = self.mqtt.get('password')
-            topic = "{}/{}/{}".format(stationid,"statuslog",self.hostname)
-            print ("Done. Topic={},".format(topic))
-            print ("Done. User={},".format(mqttuser))
-            client = mqtt.Client(client)
-            if not mqttuser == None:
-                client.username_pw_set(username=mqttuser, password=mqttpassword)
-            print (broker, mqttport, mqttdelay)
-            client.connect(broker, mqttport, mqttdelay)
-            client.publish(topic,json.dumps(dictionary))
-            print ('Update sent to MQTT')
+            options = dict(self.mqtt)
+            options['hostname'] = self.hostname
         elif self.receiver == 'telegram':
-            #try: # import Ok
-            import telegram_send
-            # except: # import error
-            #try: # conf file exists
-            # except: # send howto
-            # requires a existing configuration file for telegram_send
-            # to create one use:
-            # python
-            # import telegram_send
-            # telegram_send.configure("/path/to/my/telegram.cfg",channel=True)
-            tgmsg = ''
-            for elem in dictionary:
-                tgmsg += "{}: {}\n".format(elem, dictionary[elem])
-            telegram_send.send(messages=[tgmsg],conf=self.telegram.get('config'),parse_mode="markdown")
-            print ('Update sent to telegram')
+            options = {'config':self.telegram.get('config')}
         elif self.receiver == 'email':
-            mailmsg = ''
-            for elem in dictionary:
-                mailmsg += "{}: {}\n".format(elem, dictionary[elem])
-            import acquisitionsupport as acs
-            self.email = acs.GetConf(self.email.get('config'))
-            #print(self.email)
-            self.email['Text'] = mailmsg
-            sendmail(self.email)
-            print ('Update sent to email')
-        elif self.receiver == 'log':
-            print ('Updating logfile only')
+            options = {'config':self.email.get('config')}
         else:
-            print ("Given receiver is not yet supported")
+            options = {}
+        self.dispatcher.submit(self.receiver, options, dictionary)
 
     def receiveroptions(self,receiver,options):
         dictionary = eval('self.{}'.format(receiver))
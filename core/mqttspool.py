@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+# MARTAS MQTT spool
+
+## 1. INTRODUCTION
+
+mqttspool.py provides a publishing layer between the acquisition protocols and
+the paho MQTT client. Whenever the broker is not reachable, data messages
+(topics ending with /data) are stored in append-only segment files on disk.
+After reconnection the stored messages are replayed in their original order
+with a limited rate. Data messages published while the replay is running are
+appended to the spool as well, so that the broker receives all data in order.
+Live data is published directly again once the spool is drained. The size of the spool on disk is bounded, the oldest
+segments are removed if the limit is exceeded.
+
+## 2. APPLICATION
+
+>from core.mqttspool import MQTTSpool
+>client = mqtt.Client()
+>client.on_connect = onConnect
+>spool = MQTTSpool(client, '/srv/spool', maxsize=100000000, rate=50)
+>client.connect(broker, port, delay)
+>client.loop_start()
+>spool.publish("wic/ENV05_2_0001/data", payload, qos=0)
+
+The spool object can be used everywhere a paho client is expected. All other
+attributes are passed to the client.
+
+"""
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+import os
+import glob
+import json
+import time
+import threading
+from twisted.python import log
+
+
+class MQTTSpool(object):
+    """
+    DESCRIPTION:
+        Wraps a paho client. Messages published while the broker is not
+        reachable are written to segment files in spooldir and replayed after
+        reconnection.
+    PARAMETERS:
+        client:         paho.mqtt.client.Client
+        spooldir:       (string) directory for segment files
+        maxsize:        (int) maximal size of all segments in bytes
+        segmentsize:    (int) size in bytes after which a new segment is started
+        rate:           (float) replayed messages per second
+        topicfilter:    (string) only topics ending with topicfilter are spooled
+    """
+    def __init__(self, client, spooldir, maxsize=100000000, segmentsize=1000000, rate=50, topicfilter='/data'):
+        self.client = client
+        self.spooldir = spooldir
+        self.maxsize = int(maxsize)
+        self.segmentsize = int(segmentsize)
+        self.rate = float(rate)
+        self.topicfilter = topicfilter
+        self.connected = False
+        self.backlog = False     # True while spooled messages wait for replay
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.segment = None      # file handle of the segment currently written
+        self.segmentname = None
+        self.stats = {'spooled':0, 'replayed':0, 'dropped':0}
+        if not os.path.isdir(spooldir):
+            os.makedirs(spooldir)
+        self.sequence = self._lastsequence()
+        self.backlog = len(self._segments()) > 0
+        # chain existing paho callbacks
+        self.on_connect_chain = client.on_connect
+        self.on_disconnect_chain = client.on_disconnect
+        client.on_connect = self._on_connect
+        client.on_disconnect = self._on_disconnect
+        self.thread = threading.Thread(target=self._replay, name="mqttspool")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def publish(self, topic, payload=None, qos=0, retain=False):
+        """
+        DESCRIPTION:
+            publish a message or spool it if the broker is not reachable.
+            Data messages are spooled as well while older messages are
+            waiting for replay.
+        """
+        info = None
+        spool = topic.endswith(self.topicfilter)
+        if self.connected and not (spool and self.backlog):
+            info = self.client.publish(topic, payload, qos=qos, retain=retain)
+            if _rc(info) == 0:
+                return info
+        if spool:
+            try:
+                self._append(topic, payload, qos)
+            except Exception as e:
+                log.msg("MQTTSpool: could not spool message for {}: {}".format(topic, e))
+        return info
+
+    def pending(self):
+        """
+        DESCRIPTION:
+            return amount of segments and bytes waiting for replay
+        """
+        segments = self._segments()
+        return len(segments), sum(os.path.getsize(seg) for seg in segments)
+
+    # -----------------------------------------------------------
+    # Callbacks
+    # -----------------------------------------------------------
+
+    def _on_connect(self, client, userdata, flags, rc):
+        self.connected = (rc == 0)
+        if self.on_connect_chain:
+            self.on_connect_chain(client, userdata, flags, rc)
+        if self.connected:
+            self.wakeup.set()
+
+    def _on_disconnect(self, client, userdata, rc):
+        self.connected = False
+        if self.on_disconnect_chain:
+            self.on_disconnect_chain(client, userdata, rc)
+
+    # -----------------------------------------------------------
+    # Segment files
+    # -----------------------------------------------------------
+
+    def _segments(self):
+        return sorted(glob.glob(os.path.join(self.spooldir, "spool_*.seg")))
+
+    def _lastsequence(self):
+        segments = self._segments()
+        if not segments:
+            return 0
+        try:
+            return int(os.path.basename(segments[-1])[6:-4])
+        except ValueError:
+            return len(segments)
+
+    def _append(self, topic, payload, qos):
+        if isinstance(payload, bytes):
+            payload = payload.decode('utf-8')
+        line = json.dumps({'t':topic, 'p':payload, 'q':qos}) + "\n"
+        rolled = False
+        with self.lock:
+            if not self.segment or self.segment.tell() >= self.segmentsize:
+                self._roll()
+                rolled = True
+            self.segment.write(line)
+            self.segment.flush()
+            self.backlog = True
+            self.stats['spooled'] += 1
+            if self.stats['spooled'] == 1:
+                log.msg("MQTTSpool: broker not reachable - spooling data to {}".format(self.spooldir))
+        if rolled:
+            self._limit()
+        if self.connected:
+            self.wakeup.set()
+
+    def _roll(self):
+        # close current segment and start a new one - requires lock
+        if self.segment:
+            self.segment.close()
+        self.sequence += 1
+        self.segmentname = os.path.join(self.spooldir, "spool_{:010d}.seg".format(self.sequence))
+        self.segment = open(self.segmentname, 'a')
+
+    def _close(self):
+        # close current segment so that it can be replayed - requires lock
+        if self.segment:
+            self.segment.close()
+            self.segment = None
+            self.segmentname = None
+
+    def _limit(self):
+        segments = self._segments()
+        sizes = [os.path.getsize(seg) for seg in segments]
+        while len(segments) > 1 and sum(sizes) > self.maxsize:
+            seg = segments.pop(0)
+            sizes.pop(0)
+            log.msg("MQTTSpool: spool size exceeds {} bytes - removing oldest segment {}".format(self.maxsize, seg))
+            self.stats['dropped'] += 1
+            _remove(seg)
+            _remove(seg+'.offset')
+
+    # -----------------------------------------------------------
+    # Replay
+    # -----------------------------------------------------------
+
+    def _replay(self):
+        while True:
+            self.wakeup.wait(10)
+            self.wakeup.clear()
+            while self.connected:
+                with self.lock:
+                    self._close()
+                    segments = self._segments()
+                    if not segments:
+                        # spool drained - live data is published directly again
+                        if self.backlog and self.stats['replayed'] > 0:
+                            log.msg("MQTTSpool: replay finished - {} messages sent so far".format(self.stats['replayed']))
+                        self.backlog = False
+                        break
+                for seg in segments:
+                    if not self.connected or not self._replaysegment(seg):
+                        break
+                else:
+                    # check for segments spooled during the replay
+                    continue
+                break
+
+    def _replaysegment(self, seg):
+        """
+        DESCRIPTION:
+            publish all messages of a segment starting at the stored offset.
+            Returns True if the segment has been completely sent.
+        """
+        offsetfile = seg+'.offset'
+        offset = 0
+        try:
+            with open(offsetfile) as fh:
+                offset = int(fh.read().strip())
+        except (IOError, OSError, ValueError):
+            pass
+        delay = 1./self.rate if self.rate > 0 else 0
+        try:
+            fh = open(seg)
+        except (IOError, OSError):
+            return True
+        with fh:
+            fh.seek(offset)
+            count = 0
+            while True:
+                line = fh.readline()
+                if not line:
+                    break
+                try:
+                    msg = json.loads(line)
+                except ValueError:
+                    # incomplete line (e.g. power failure while writing)
+                    offset = fh.tell()
+                    continue
+                if not self.connected or not _rc(self.client.publish(msg['t'], msg['p'], qos=msg['q'])) == 0:
+                    _writeoffset(offsetfile, offset)
+                    return False
+                offset = fh.tell()
+                count += 1
+                self.stats['replayed'] += 1
+                if count % 100 == 0:
+                    _writeoffset(offsetfile, offset)
+                if delay:
+                    time.sleep(delay)
+        _remove(seg)
+        _remove(offsetfile)
+        return True
+
+
+def _rc(info):
+    """
+    DESCRIPTION:
+        return code of a paho publish call (MQTTMessageInfo or tuple)
+    """
+    if info is None:
+        return -1
+    rc = getattr(info, 'rc', None)
+    if rc is None:
+        try:
+            rc = info[0]
+        except (TypeError, IndexError):
+            rc = -1
+    return rc
+
+
+def _writeoffset(path, offset):
+    tmp = path+'.tmp'
+    with open(tmp, 'w') as fh:
+        fh.write(str(offset))
+    os.rename(tmp, path)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
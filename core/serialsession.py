@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""
+# MARTAS serial sessions
+
+## 1. INTRODUCTION
+
+serialsession.py keeps serial ports of active (request/response) protocols
+open between requests. Opening a port resets many microcontroller boards
+(e.g. Arduino), so that reopening the port for every request is dominated by
+the reset and bootloader delay. A session is opened once, reused by all
+requests and only reopened after an error.
+Several commands can be written back-to-back (pipeline) and the replies are
+assigned to the commands in order, optionally verified by a match function.
+A missing reply (read timeout) only fails the request, the port stays open.
+Round trip times are recorded for each port.
+
+## 2. APPLICATION
+
+>from core.serialsession import SerialSession
+>session = SerialSession.get('/dev/ttyACM0', baudrate=9600, parity='N', bytesize=8, stopbits=1, timeout=2, opendelay=2)
+>answer, responsetime = session.request('owT', eol='\r\n', terminator='<MARTASEND>')
+>answers = session.pipeline(['owT','swD'], eol='\r\n', terminator='<MARTASEND>')
+>print (session.latency())
+
+Used by libmqtt activearduinoprotocol, dspprotocol and disdroprotocol.
+
+"""
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+import sys
+import time
+import string
+import threading
+from datetime import datetime
+from twisted.python import log
+import serial
+
+
+class ReplyTimeout(Exception):
+    """
+    DESCRIPTION:
+        no (complete) reply was received - the port itself is working
+    """
+    pass
+
+
+class SerialSession(object):
+    """
+    DESCRIPTION:
+        Long-lived serial connection. Use SerialSession.get to obtain the
+        session of a port, which is shared by all protocols using this port.
+    PARAMETERS:
+        port:           (string) e.g. /dev/ttyACM0
+        baudrate, parity, bytesize, stopbits, timeout: serial settings
+        opendelay:      (float) seconds to wait after opening the port (board reset)
+        maxempty:       (int) amount of empty reads (timeouts) before a reply is given up
+    """
+    sessions = {}
+    registrylock = threading.Lock()
+
+    def __init__(self, port, baudrate=9600, parity='N', bytesize=8, stopbits=1, timeout=2, opendelay=0, maxempty=5, debug=False):
+        self.port = port
+        self.settings = {'baudrate':int(baudrate), 'parity':parity, 'bytesize':int(bytesize), 'stopbits':int(stopbits), 'timeout':float(timeout)}
+        self.opendelay = float(opendelay)
+        self.maxempty = int(maxempty)
+        self.debug = debug
+        self.ser = None
+        self.lock = threading.RLock()
+        self.stats = {'requests':0, 'errors':0, 'timeouts':0, 'unmatched':0, 'opened':0, 'rtt':0., 'rttmax':0., 'rttlast':0.}
+
+    @classmethod
+    def get(cls, port, **kwargs):
+        """
+        DESCRIPTION:
+            return the session of port - created at the first call
+        """
+        with cls.registrylock:
+            session = cls.sessions.get(port)
+            if not session:
+                session = cls(port, **kwargs)
+                cls.sessions[port] = session
+            return session
+
+    def open(self):
+        with self.lock:
+            if self.ser and self.ser.isOpen():
+                return self.ser
+            self.ser = serial.Serial(self.port, **self.settings)
+            if not self.ser.isOpen():
+                self.ser.open()
+            self.stats['opened'] += 1
+            log.msg("SerialSession: opened {}".format(self.port))
+            if self.opendelay > 0:
+                # wait for board reset and bootloader
+                time.sleep(self.opendelay)
+            self._clearinput(self.ser)
+            return self.ser
+
+    def _clearinput(self, ser):
+        if hasattr(ser, 'reset_input_buffer'):
+            ser.reset_input_buffer()
+        else:
+            ser.flushInput()   # pyserial < 3.0
+
+    def close(self):
+        with self.lock:
+            if self.ser:
+                try:
+                    self.ser.close()
+                except Exception:
+                    pass
+            self.ser = None
+
+    def _write(self, ser, command):
+        if sys.version_info >= (3, 0):
+            ser.write(command.encode('ascii'))
+        else:
+            ser.write(command)
+
+    def _readline(self, ser):
+        response = ser.readline()
+        if sys.version_info >= (3, 0):
+            response = response.decode('ascii', 'ignore')
+        return response
+
+    def _read(self, ser, terminator=None, maxlines=50):
+        """
+        DESCRIPTION:
+            read a reply: the first non empty line or, if terminator is given,
+            all lines until a line starting with terminator
+        """
+        empty = 0
+        response = ''
+        while not response.strip():
+            response = self._readline(ser)
+            if not response:
+                empty += 1
+                if empty >= self.maxempty:
+                    raise ReplyTimeout("no response within {} seconds".format(self.maxempty*self.settings.get('timeout')))
+        if not terminator:
+            return response
+        fullresponse = ''
+        cnt = 0
+        while not response.startswith(terminator):
+            if cnt == maxlines:
+                return 'Maximum count {} was reached'.format(maxlines)
+            cnt += 1
+            fullresponse += response
+            response = self._readline(ser)
+            if not response:
+                empty += 1
+                if empty >= self.maxempty:
+                    raise ReplyTimeout("terminator not received within {} seconds".format(self.maxempty*self.settings.get('timeout')))
+        return fullresponse
+
+    def _record(self, rtt, amount=1):
+        self.stats['requests'] += amount
+        self.stats['rtt'] += rtt
+        self.stats['rttlast'] = rtt/amount
+        self.stats['rttmax'] = max(self.stats['rttmax'], rtt/amount)
+
+    def _failed(self, e):
+        self.stats['errors'] += 1
+        log.msg("SerialSession: error on {} ({}) - reconnecting with next request".format(self.port, e))
+        self.close()
+
+    def request(self, command, eol='\r\n', terminator=None, maxlines=50, prefix=''):
+        """
+        DESCRIPTION:
+            send command and return the reply and the time of its reception
+            (reply is '' if the port failed or no reply was received)
+        PARAMETERS:
+            eol:            appended to the command
+            prefix:         put in front of the command (e.g. eol for DSP)
+            terminator:     reply ends with a line starting with terminator
+        """
+        return self.pipeline([command], eol=eol, terminator=terminator, maxlines=maxlines, prefix=prefix)[0]
+
+    def pipeline(self, commands, eol='\r\n', terminator=None, maxlines=50, prefix='', match=None):
+        """
+        DESCRIPTION:
+            write all commands back-to-back and read their replies afterwards.
+            Replies are assigned to the commands in order. If match (function
+            of command and reply returning True/False) is given, each reply
+            is assigned to the first waiting command it matches. Commands
+            in front of this command did not get a reply. Replies matching
+            no waiting command (e.g. late replies of a previous request) are
+            skipped. Reading stops at the first read timeout.
+        RETURNS:
+            list of (reply, responsetime) tuples - one for each command,
+            reply is '' if no (matching) reply was received
+        """
+        results = [('', datetime.utcnow()) for command in commands]
+        with self.lock:
+            try:
+                ser = self.open()
+                ser.flush()
+                self._clearinput(ser)
+                start = time.time()
+                for command in commands:
+                    self._write(ser, prefix+command+eol)
+                waiting = list(range(len(commands)))
+                reads = 0
+                while waiting and reads < len(commands)+3:
+                    reads += 1
+                    try:
+                        reply = self._read(ser, terminator=terminator, maxlines=maxlines)
+                    except ReplyTimeout as e:
+                        self.stats['timeouts'] += 1
+                        log.msg("SerialSession: {} on {} - {} of {} commands without reply".format(e, self.port, len(waiting), len(commands)))
+                        break
+                    if match:
+                        matching = [idx for idx in waiting if match(commands[idx], reply)]
+                        if not matching:
+                            self.stats['unmatched'] += 1
+                            if self.debug:
+                                log.msg("SerialSession: skipping reply matching no command: {}".format(reply))
+                            continue
+                        idx = matching[0]
+                    else:
+                        idx = waiting[0]
+                    results[idx] = (reply, datetime.utcnow())
+                    waiting = [el for el in waiting if el > idx]
+                self._record(time.time()-start, len(commands))
+            except (serial.SerialException, IOError, OSError) as e:
+                self._failed(e)
+        return results
+
+    def latency(self):
+        """
+        DESCRIPTION:
+            return round trip statistics of the port (seconds per command)
+        """
+        requests = self.stats.get('requests')
+        return {'port':self.port, 'requests':requests, 'errors':self.stats.get('errors'), 'timeouts':self.stats.get('timeouts'),
+                'unmatched':self.stats.get('unmatched'), 'opened':self.stats.get('opened'),
+                'mean':self.stats.get('rtt')/requests if requests else 0., 'max':self.stats.get('rttmax'), 'last':self.stats.get('rttlast')}
+
+
+def printable(line):
+    """
+    DESCRIPTION:
+        return only printable ascii characters of line
+    """
+    return ''.join(filter(lambda x: x in string.printable, line)).strip()
@@ -3,7 +3,10 @@
 
 import re
 import sys
+import time
 import struct
+import threading
+from collections import deque
 from base64 import b64encode
 from hashlib import sha1
 import logging
@@ -86,6 +89,14 @@ class API():
     def send_message_to_all(self, msg):
         self._multicast_(msg)
 
+    def broadcast(self, messages, droppable=True):
+        """
+        Queue a list of messages for all clients. Never blocks on socket I/O.
+        Messages which are not droppable (e.g. headers) are always delivered.
+        """
+        for client in list(self.clients):
+            client['writer'].put(messages, droppable)
+
 
 # ------------------------- Implementation -----------------------------
 
@@ -100,6 +111,12 @@ class WebsocketServer(ThreadingMixIn, TCPServer, API):
             0.0.0.0.
         loglevel: Logging level from logging module to use for logging. By default
             warnings and errors are being logged.
+        batchwindow(float): Messages for a client are collected for batchwindow
+            seconds and sent as a single frame, separated by newlines.
+        maxqueue(int): Maximal amount of messages waiting for a client. If a
+            client falls behind, waiting data messages are downsampled.
+        binary(bool): Send batches as binary frames (UTF-8 encoded) instead of
+            text frames.
 
     Properties:
         clients(list): A list of connected clients. A client is a dictionary
@@ -107,7 +124,8 @@ class WebsocketServer(ThreadingMixIn, TCPServer, API):
                 {
                  'id'      : id,
                  'handler' : handler,
-                 'address' : (addr, port)
+                 'address' : (addr, port),
+                 'writer'  : ClientWriter
                 }
     """
 
@@ -117,9 +135,12 @@ class WebsocketServer(ThreadingMixIn, TCPServer, API):
     clients = []
     id_counter = 0
 
-    def __init__(self, port, host='127.0.0.1', loglevel=logging.WARNING):
+    def __init__(self, port, host='127.0.0.1', loglevel=logging.WARNING, batchwindow=0.1, maxqueue=1000, binary=False):
         logger.setLevel(loglevel)
         self.port = port
+        self.batchwindow = batchwindow
+        self.maxqueue = maxqueue
+        self.binary = binary
         TCPServer.__init__(self, (host, port), WebSocketHandler)
 
     def _message_received_(self, handler, msg):
@@ -136,23 +157,26 @@ class WebsocketServer(ThreadingMixIn, TCPServer, API):
         client = {
             'id': self.id_counter,
             'handler': handler,
-            'address': handler.client_address
+            'address': handler.client_address,
+            'writer': ClientWriter(handler, self.batchwindow, self.maxqueue, self.binary)
         }
         self.clients.append(client)
         self.new_client(client, self)
 
     def _client_left_(self, handler):
         client = self.handler_to_client(handler)
+        if not client:
+            return
         self.client_left(client, self)
+        client['writer'].stop()
         if client in self.clients:
             self.clients.remove(client)
 
     def _unicast_(self, to_client, msg):
-        to_client['handler'].send_message(msg)
+        to_client['writer'].put([msg], False)
 
     def _multicast_(self, msg):
-        for client in self.clients:
-            self._unicast_(client, msg)
+        self.broadcast([msg], False)
 
     def handler_to_client(self, handler):
         for client in self.clients:
@@ -160,6 +184,87 @@ class WebsocketServer(ThreadingMixIn, TCPServer, API):
                 return client
 
 
+class ClientWriter(object):
+    """
+        Outbound queue of a single client, served by its own writer thread.
+
+    Messages are collected for batchwindow seconds and sent as one frame
+    (joined by newlines). If more than maxqueue messages are waiting, every
+    second droppable message is removed, so that a slow client receives a
+    downsampled stream instead of stalling the sender.
+    """
+
+    def __init__(self, handler, batchwindow=0.1, maxqueue=1000, binary=False):
+        self.handler = handler
+        self.batchwindow = batchwindow
+        self.maxqueue = max(2, int(maxqueue))
+        self.binary = binary
+        self.queue = deque()
+        self.condition = threading.Condition()
+        self.running = True
+        self.sent = 0
+        self.dropped = 0
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, messages, droppable=True):
+        with self.condition:
+            if not self.running:
+                return
+            for msg in messages:
+                self.queue.append((droppable, msg))
+            if len(self.queue) > self.maxqueue:
+                self._downsample()
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.queue.clear()
+            self.condition.notify()
+
+    def _downsample(self):
+        # keep all non droppable messages and every second droppable one
+        kept = deque()
+        toggle = False
+        for droppable, msg in self.queue:
+            if droppable:
+                toggle = not toggle
+                if not toggle:
+                    self.dropped += 1
+                    continue
+            kept.append((droppable, msg))
+        self.queue = kept
+        logger.info("Client %s falls behind - %d messages dropped so far" % (self.handler.client_address, self.dropped))
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.queue:
+                    self.condition.wait(1.0)
+                if not self.running:
+                    return
+            if self.batchwindow > 0:
+                time.sleep(self.batchwindow)
+            with self.condition:
+                batch = [msg for droppable, msg in self.queue]
+                self.queue.clear()
+            if not batch:
+                continue
+            try:
+                if self.binary:
+                    self.handler.send_binary('\n'.join(batch))
+                else:
+                    self.handler.send_text('\n'.join(batch))
+                self.sent += len(batch)
+            except Exception as e:
+                logger.warning("Could not send to client %s: %s" % (self.handler.client_address, e))
+                self.handler.keep_alive = False
+                self.stop()
+                return
+
+
 class WebSocketHandler(StreamRequestHandler):
 
     def __init__(self, socket, addr, server):
@@ -169,6 +274,7 @@ class WebSocketHandler(StreamRequestHandler):
     def setup(self):
         StreamRequestHandler.setup(self)
         self.keep_alive = True
+        self.send_lock = threading.Lock()
         self.handshake_done = False
         self.valid_client = False
 
@@ -245,6 +351,13 @@ class WebSocketHandler(StreamRequestHandler):
     def send_pong(self, message):
         self.send_text(message, OPCODE_PONG)
 
+    def send_binary(self, message):
+        if not isinstance(message, bytes):
+            message = encode_to_UTF8(message)
+            if not message:
+                return False
+        self.send_frame(message, OPCODE_BINARY)
+
     def send_text(self, message, opcode=OPCODE_TEXT):
         """
         Important: Fragmented(=continuation) messages are not supported since
@@ -265,8 +378,11 @@ class WebSocketHandler(StreamRequestHandler):
             logger.warning('Can\'t send message, message has to be a string or bytes. Given type is %s' % type(message))
             return False
 
-        header  = bytearray()
         payload = encode_to_UTF8(message)
+        self.send_frame(payload, opcode)
+
+    def send_frame(self, payload, opcode):
+        header  = bytearray()
         payload_length = len(payload)
 
         # Normal payload
@@ -290,7 +406,9 @@ class WebSocketHandler(StreamRequestHandler):
             raise Exception("Message is too big. Consider breaking it into chunks.")
             return
 
-        self.request.send(header + payload)
+        # pongs (handler thread) and batches (writer thread) share the socket
+        with self.send_lock:
+            self.request.sendall(bytes(header) + payload)
 
     def handshake(self):
         message = self.request.recv(1024).decode().strip()
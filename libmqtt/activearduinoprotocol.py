@@ -14,14 +14,47 @@ from twisted.protocols.basic import LineReceiver
 from twisted.python import log
 from core import acquisitionsupport as acs
 from magpy.stream import KEYLIST
-import serial
+from core.serialsession import SerialSession
 import subprocess
-import sys
-import time
 
 ## Aktive Arduino protocol
 ## -----------------------
 
+# Replies of the MARTAS Arduino sketch (sketchbook/sketch_MARTAS_ac_ow_sw)
+# do not repeat the command. They are identified by their content:
+# command key -> (reply start, required text, excluded text)
+REPLYSIGNATURES = {
+    'owT': (('H','M','D','CRC'), '', 'Pin4'),
+    'swD': (('H','M','D'), 'Pin4', ''),
+    'swS': (('Status',), '', ''),
+    'swP': (('Switching',), '', ''),
+    'owD': (('Getting',), '', ''),
+    'reS': (('Sending reset',), '', ''),
+}
+
+
+def replymatches(command, reply):
+    """
+    DESCRIPTION:
+        check whether reply belongs to command (used by SerialSession.pipeline).
+        Replies of unknown commands must not look like a reply of a known one.
+    """
+    reply = reply.strip()
+    if reply.startswith('Command not recognized'):
+        return reply.endswith(command.split(':')[0])
+    signature = REPLYSIGNATURES.get(command[:3])
+    if not signature:
+        return not any(replymatches(key, reply) for key in REPLYSIGNATURES)
+    starts, required, excluded = signature
+    if not reply.startswith(starts):
+        return False
+    if required and not required in reply:
+        return False
+    if excluded and excluded in reply:
+        return False
+    return True
+
+
 class ActiveArduinoProtocol(object):
     """
     Protocol to read Arduino data (usually from ttyACM0)
@@ -94,6 +127,8 @@ class ActiveArduinoProtocol(object):
         self.bytesize=sensordict.get('bytesize')
         self.stopbits=sensordict.get('stopbits')
         self.timeout=2 # should be rate depended
+        # the port is kept open between requests - opening resets the board (opendelay)
+        self.session = SerialSession.get(self.port, baudrate=self.baudrate, parity=self.parity, bytesize=self.bytesize, stopbits=self.stopbits, timeout=self.timeout, opendelay=2)
 
         # QOS
         self.qos=int(confdict.get('mqttqos',0))
@@ -124,49 +159,6 @@ class ActiveArduinoProtocol(object):
         self.headlist = []
 
 
-    def send_command(self,ser,command,eol,hex=False):
-        response = ''
-        fullresponse = ''
-        maxcnt = 50
-        cnt = 0
-        command = command+eol
-        ser.flush()
-        sendtime = datetime.utcnow()
-        #print ("Sending command ... {}".format(command))
-        if sys.version_info >= (3, 0):
-            ser.write(command.encode('ascii'))
-        else:
-            ser.write(command)
-        #print (" ... waiting for response")
-        # skipping all empty lines
-        try: ## check for exeception in  raise SerialException
-            while not response or response == '':
-                response = ser.readline()
-                if sys.version_info >= (3, 0):
-                    response = response.decode('ascii')
-            # read until end-of-messageblock signal is obtained (use some break value)
-            while not response.startswith('<MARTASEND>') and not cnt == maxcnt:
-                cnt += 1
-                fullresponse += response
-                #time.sleep(0.01)
-                response = ser.readline()
-                if sys.version_info >= (3, 0):
-                    response = response.decode('ascii')
-        except serial.SerialException as e:
-            if self.debug:
-                log.msg("SerialException found ({})".format(e)) # - restarting martas ...")
-            time.sleep(0.5)
-            #self.restart()
-        except:
-            log.msg("Other exception found")
-            raise
-
-        responsetime = datetime.utcnow()
-        if cnt == maxcnt:
-            fullresponse = 'Maximum count {} was reached'.format(maxcnt)
-        return fullresponse, responsetime
-
-
     def datetime2array(self,t):
         return [t.year,t.month,t.day,t.hour,t.minute,t.second,t.microsecond]
 
@@ -419,53 +411,38 @@ class ActiveArduinoProtocol(object):
 
     def sendRequest(self):
 
-        # connect to serial
-        ser = serial.Serial(self.port, baudrate=int(self.baudrate), parity=self.parity, bytesize=int(self.bytesize), stopbits=int(self.stopbits), timeout=self.timeout)
-
-        # Open Connection
-        try:
-            ser.open()
-        except Exception as e:
-            #if travistestrun:
-            #    print ("ardcomm: serial port not available in testrun - finishing")
-            #   sys.exit(0)
-            #print ("lib activearduino: error open serial port: {}".format(str(e)))
-            # ser is already open dur to serial.Serial command
-            pass
+        # send all request strings back-to-back on the open session
+        items, commands = [], []
+        for sensordict in self.commands:
+            for item in sensordict:
+                command = sensordict.get(item)
+                n = command.count(":")
+                miss=-(n-2)
+                for n in range(miss):
+                    command += ':'
+                if self.debug:
+                    log.msg("DEBUG - sending command key {}: {}".format(item,command))
+                items.append(item)
+                commands.append(command)
+        # replies are assigned by their content - a missing reply does not shift the others
+        answers = self.session.pipeline(commands, eol=self.eol, terminator='<MARTASEND>', match=replymatches)
+        if self.debug:
+            log.msg("DEBUG - round trip times of {}: {}".format(self.port, self.session.latency()))
 
-        if ser.isOpen():
-            # send request string()
-            for sensordict in self.commands:
-                for item in sensordict:
-                    command = sensordict.get(item)
-                    n = command.count(":")
-                    miss=-(n-2)
-                    for n in range(miss):
-                        command += ':'
-                    if self.debug:
-                        log.msg("DEBUG - sending command key {}: {}".format(item,command))
-                    #time.sleep(2) # doesnt help
-                    answer, actime = self.send_command(ser,command,self.eol,hex=self.hexcoding)
-                    if self.debug:
-                        log.msg("DEBUG - received {}".format(answer))
-
-                    # analyze return if data is requested
-                    if item.startswith('data') and not answer.find('-') > -1 and not answer.find('Starting') > -1:
-                        # get all lines in answer
-                        lines = answer.split('\n')
-                        for line in lines:
-                            try:
-                                if line and len(line)>2 and (line[2] == ':' or line[3] == ':'):
-                                    self.analyzeline(line)
-                            except:
-                                pass
-
-            # disconnect from serial
-            ser.close()
-            if ser.isOpen():
-                print ("but seems to be still open")
-        else:
-            print ("lib activearduino: Could not open serial port")
+        for item, (answer, actime) in zip(items, answers):
+            if self.debug:
+                log.msg("DEBUG - received {}".format(answer))
+
+            # analyze return if data is requested
+            if item.startswith('data') and not answer.find('-') > -1 and not answer.find('Starting') > -1:
+                # get all lines in answer
+                lines = answer.split('\n')
+                for line in lines:
+                    try:
+                        if line and len(line)>2 and (line[2] == ':' or line[3] == ':'):
+                            self.analyzeline(line)
+                    except:
+                        pass
 
     def analyzeline(self, line):
 
@@ -14,32 +14,17 @@ from twisted.protocols.basic import LineReceiver
 from twisted.python import log
 from core import acquisitionsupport as acs
 from magpy.stream import KEYLIST
-import serial
+from core.serialsession import SerialSession, printable
 import sys
 
-def send_command_ascii(ser,command,eol):
-    #use printable here
-    response = ''
-    command = eol+command+eol
-    if(ser.isOpen() == False):
-        ser.open()
-    sendtime = datetime.utcnow()
-    # encode to binary if python3
-    if sys.version_info >= (3, 0):
-        ser.write(command.encode('ascii'))
-    else:
-        ser.write(command)
-    # skipping all empty lines
-    while response == '':
-        response = ser.readline()
-    #responsetime = datetime.utcnow()
-    # decode from binary if py3
-    if sys.version_info >= (3, 0):
-        response = response.decode('ascii')
-    responsetime = datetime.utcnow()
+def send_command_ascii(session,command,eol):
+    """
+    send command on the open serial session (see core.serialsession)
+    and return the printable response and the time of its reception
+    """
+    response, responsetime = session.request(command, eol=eol, prefix=eol)
     # return only ascii
-    line = ''.join(filter(lambda x: x in string.printable, response))
-    line = line.strip()
+    line = printable(response)
     return line, responsetime
 
 
@@ -85,6 +70,8 @@ class DSPProtocol(object):
         self.bytesize=sensordict.get('bytesize')
         self.stopbits=sensordict.get('stopbits')
         self.timeout=2 # should be rate depended
+        # the port is kept open between requests
+        self.session = SerialSession.get(self.port, baudrate=self.baudrate, parity=self.parity, bytesize=self.bytesize, stopbits=self.stopbits, timeout=self.timeout)
 
         self.hostname = socket.gethostname()
         self.printable = set(string.printable)
@@ -181,17 +168,13 @@ class DSPProtocol(object):
     def sendRequest(self):
 
         success = True
-        # connect to serial
-        ser = serial.Serial(self.port, baudrate=int(self.baudrate), parity=self.parity, bytesize=int(self.bytesize), stopbits=int(self.stopbits), timeout=int(self.timeout))
         for commdict in self.commands:
             for item in sorted(commdict):
                 comm = commdict.get(item)
                 if self.debug:
                     print ("sending item {} with command {}".format(item, comm))
                 # eventually more frequently ask for 'data'
-                answer, actime = send_command_ascii(ser,comm,self.eol)
-                # disconnect from serial
-                ser.close()
+                answer, actime = send_command_ascii(self.session,comm,self.eol)
                 if self.debug:
                     print ("got answer: {}".format(answer))
                 self.serialnum = self.serial1+self.serial2
@@ -231,8 +214,8 @@ class DSPProtocol(object):
                     #os.system("/etc/init.d/martas restart")
                     log.msg('SerialCall: Restarted martas process')
                 """
-        # disconnect from serial
-        ser.close()
+        if self.debug:
+            log.msg("DEBUG - round trip times of {}: {}".format(self.port, self.session.latency()))
 
         # get answer
         #print("All commands send")
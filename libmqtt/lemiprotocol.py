@@ -38,13 +38,18 @@ import struct # for binary representation
 import socket # for hostname identification
 import string # for ascii selection
 import numpy as np
-import os     # binary data saved directly without acs helper method
+import os
 from datetime import datetime, timedelta
 from twisted.protocols.basic import LineReceiver
 from twisted.python import log
 from core import acquisitionsupport as acs
+from core.frameparser import StartTagFrameParser
 from subprocess import check_call
 
+# precompiled packing codes of LEMI frames and the appended NTP time
+LEMIFRAME = struct.Struct("<4cB6B8hb30f3BcB")
+LEMIDATE = struct.Struct('<6hL')
+
 
 ## Lemi protocol (Lemi025 and Lemi036)
 ## -------------
@@ -109,7 +114,12 @@ class LemiProtocol(LineReceiver):
         # LEMI Specific        
         self.soltag = self.sensor[0]+self.sensor[4:7]    # Start-of-line-tag
         self.errorcnt = {'gps':'A', 'time':'0', 'buffer':0}
-        self.buffer = ''
+        self.parser = StartTagFrameParser(self.soltag, 153)
+        packcode = "<4cb6B8hb30f3BcBcc5hL"
+        self.header = "LemiBin %s %s %s %s %s %s %d" % (self.sensor, '[x,y,z,t1,t2]', '[X,Y,Z,T_sensor,T_elec]', '[nT,nT,nT,deg_C,deg_C]', '[0.001,0.001,0.001,100,100]', packcode, struct.calcsize(packcode))
+        sendpackcode = '6hLffflll'
+        #headforsend = "# MagPyBin {} {} {} {} {} {} {}".format(self.sensor, '[x,y,z,t1,t2,var2,str1]', '[X,Y,Z,T_sensor,T_elec,VDD,GPS]', '[nT,nT,nT,deg_C,deg_C,V,Status]', '[0.001,0.001,0.001,100,100,10]', sendpackcode, struct.calcsize('<'+sendpackcode))
+        self.headforsend = "# MagPyBin {} {} {} {} {} {} {}".format(self.sensor, '[x,y,z,t1,t2,var2]', '[X,Y,Z,T_sensor,T_elec,VDD]', '[nT,nT,nT,deg_C,deg_C,V]', '[0.001,0.001,0.001,100,100,10]', sendpackcode, struct.calcsize('<'+sendpackcode))
         self.gpsstate1 = 'A'
         self.gpsstate2 = 'Z'  # Initialize with Z so that current state is send when startet
         self.gpsstatelst = []
@@ -135,7 +145,7 @@ class LemiProtocol(LineReceiver):
     def initiateRestart(self):
         log.msg('LEMI - Protocol: Cannot fix problem - restarting process')
         log.msg('!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!')
-        self.buffer = ''
+        self.parser.reset()
         self.buffererrorcnt = 0
         print (" ... performing restart now...") 
         try:
@@ -158,59 +168,38 @@ class LemiProtocol(LineReceiver):
         """ TIMESHIFT between serial output (and thus NTP time) and GPS timestamp """
 
         currenttime = datetime.utcnow()
-        date = datetime.strftime(currenttime, "%Y-%m-%d")
-        timestamp = datetime.strftime(currenttime, "%Y-%m-%d %H:%M:%S.%f")
-        outtime = datetime.strftime(currenttime, "%H:%M:%S")
-        datearray = acs.timeToArray(timestamp)
-        date_bin = struct.pack('<6hL',datearray[0]-2000,datearray[1],datearray[2],datearray[3],datearray[4],datearray[5],datearray[6])   ## Added "<" to pack code to get correct length in new machines
-
-        # define pathname for local file storage 
-        # (default dir plus hostname plus sensor plus year) and create if not existing
-        path = os.path.join(self.confdict.get('bufferdirectory'), self.sensor)
-
-        if not os.path.exists(path):
-            os.makedirs(path)
-
-        packcode = "<4cb6B8hb30f3BcBcc5hL"
-        header = "LemiBin %s %s %s %s %s %s %d\n" % (self.sensor, '[x,y,z,t1,t2]', '[X,Y,Z,T_sensor,T_elec]', '[nT,nT,nT,deg_C,deg_C]', '[0.001,0.001,0.001,100,100]', packcode, struct.calcsize(packcode))
-        sendpackcode = '6hLffflll'
-        #headforsend = "# MagPyBin {} {} {} {} {} {} {}".format(self.sensor, '[x,y,z,t1,t2,var2,str1]', '[X,Y,Z,T_sensor,T_elec,VDD,GPS]', '[nT,nT,nT,deg_C,deg_C,V,Status]', '[0.001,0.001,0.001,100,100,10]', sendpackcode, struct.calcsize('<'+sendpackcode))
-        headforsend = "# MagPyBin {} {} {} {} {} {} {}".format(self.sensor, '[x,y,z,t1,t2,var2]', '[X,Y,Z,T_sensor,T_elec,VDD]', '[nT,nT,nT,deg_C,deg_C,V]', '[0.001,0.001,0.001,100,100,10]', sendpackcode, struct.calcsize('<'+sendpackcode))
+        date = "{:04d}-{:02d}-{:02d}".format(currenttime.year, currenttime.month, currenttime.day)
+        date_bin = LEMIDATE.pack(currenttime.year-2000,currenttime.month,currenttime.day,currenttime.hour,currenttime.minute,currenttime.second,currenttime.microsecond)   ## Added "<" to pack code to get correct length in new machines
+        header = self.header
+        headforsend = self.headforsend
 
         # save binary raw data to buffer file ### please note that this file always contains GPS readings
-        lemipath = os.path.join(path,self.sensor+'_'+date+".bin")
-        if not os.path.exists(lemipath):
-            with open(lemipath, "ab") as myfile:
-                myfile.write(header)
+        # the pooled bufferwriter keeps the daily file open (header is written for new files only)
         try:
-            with open(lemipath, "ab") as myfile:
-                myfile.write(data+date_bin)
-            pass
+            acs.bufferwriter.write(self.confdict.get('bufferdirectory'), self.sensor, date, data.tobytes()+date_bin, header, eol=False)
         except:
             log.err('LEMI - Protocol: Could not write data to file.')
 
         # unpack data and extract time and first field values
         # This data is streamed via mqtt
         try:
-            data_array = struct.unpack("<4cB6B8hb30f3BcB", data)
+            data_array = LEMIFRAME.unpack(data)
         except:
             log.err("LEMI - Protocol: Bit error while reading.")
 
         try:
-            newtime = []
             biasx = float(data_array[16])/400.
             biasy = float(data_array[17])/400.
             biasz = float(data_array[18])/400.
-            x = (data_array[20])*1000.
-            xarray = [elem * 1000. for elem in data_array[20:50:3]]
-            y = (data_array[21])*1000.
-            yarray = [elem * 1000. for elem in data_array[21:50:3]]
-            z = (data_array[22])*1000.
-            zarray = [elem * 1000. for elem in data_array[22:50:3]]
-            temp_sensor = data_array[11]/100.
-            temp_el = data_array[12]/100.
-            vdd = float(data_array[52])/10.
+            xarray = data_array[20:50:3]
+            yarray = data_array[21:50:3]
+            zarray = data_array[22:50:3]
+            temp_sensor = data_array[11]
+            temp_el = data_array[12]
+            vdd = data_array[52]
             gpsstat = data_array[53]
+            if isinstance(gpsstat, bytes) and not isinstance(gpsstat, str):
+                gpsstat = gpsstat.decode('ascii','ignore')
             gpstime = datetime(2000+self.h2d(data_array[5]),self.h2d(data_array[6]),self.h2d(data_array[7]),self.h2d(data_array[8]),self.h2d(data_array[9]),self.h2d(data_array[10]))-timedelta(microseconds=300000)
             #gps_time = datetime.strftime(gps_array, "%Y-%m-%d %H:%M:%S")
             self.compensation[0] = biasx
@@ -264,25 +253,17 @@ class LemiProtocol(LineReceiver):
         ### check LEMI Records whether secondary time (NTP) is readable and extractable
 
         # Create a dataarray
+        # the ten sub-samples are 0.1 sec apart: the time prefix of samples
+        # exceeding the full second is taken from the following second
+        secondtime = gpstime+timedelta(seconds=1)
+        prefix = ("{},{},{},{},{},{},".format(gpstime.year,gpstime.month,gpstime.day,gpstime.hour,gpstime.minute,gpstime.second),
+                  "{},{},{},{},{},{},".format(secondtime.year,secondtime.month,secondtime.day,secondtime.hour,secondtime.minute,secondtime.second))
+        suffix = ",{},{},{}".format(int(temp_sensor),int(temp_el),int(vdd))
+        ### TODO Add GPS and secondary time to this list
         linelst = []
-        for idx,el in enumerate(xarray):
-            datalst = []
-            tincr = idx/10.
-            timear = gpstime+timedelta(seconds=tincr)
-            gps_time = datetime.strftime(timear.replace(tzinfo=None), "%Y-%m-%d %H:%M:%S.%f")
-            datalst = acs.timeToArray(gps_time)
-            datalst.append(xarray[idx]/1000.)
-            datalst.append(yarray[idx]/1000.)
-            datalst.append(zarray[idx]/1000.)
-            datalst.append(int(temp_sensor*100))
-            datalst.append(int(temp_el*100))
-            datalst.append(int(vdd*10))
-            ### TODO Add GPS and secondary time to this list
-            #datalst.append(gpsstat)
-            #current_time = datetime.strftime(currenttime.replace(tzinfo=None), "%Y-%m-%d %H:%M:%S.%f")
-            #datalst.extend(current_time)
-            linestr = ','.join(list(map(str,datalst)))
-            linelst.append(linestr)
+        for idx in range(len(xarray)):
+            usec = gpstime.microsecond + idx*100000
+            linelst.append("{}{},{},{},{}{}".format(prefix[usec//1000000], usec%1000000, xarray[idx], yarray[idx], zarray[idx], suffix))
         dataarray = ';'.join(linelst)
 
 
@@ -294,145 +275,66 @@ class LemiProtocol(LineReceiver):
 
 
     def dataReceived(self, data):
-
-        #print ("Lemi data here!", self.buffer)
-        """
-        Sometime the code is starting wrongly -> 148 bit length
-        self healing not working - Check data
-        """
-
-        topic = self.confdict.get('station') + '/' + self.sensordict.get('sensorid')
-
-        flag = 0
-        WSflag = 0
-        #debug = self.debug
-
         """
-        # Test range
-        self.buffer = self.buffer + data
-        if not (self.buffer).startswith(self.soltag):
-            lemisearch = (self.buffer).find(self.soltag, 6)
-            if not lemisearch == -1:
-                print ("Lemisearch", lemisearch, self.buffer)
-                self.buffer = self.buffer[lemisearch:len(self.buffer)]
-        if len(self.buffer) == 153:
-            # Process data
-            print (self.buffer)
-            self.buffer = ''
+        Incoming chunks are passed to a StartTagFrameParser, which resynchronises
+        on the start-of-line tag and returns complete 153 byte frames.
         """
-
+        resyncs = self.parser.resyncs
         try:
-            # 1. Found correct data length
-            if (self.buffer).startswith(self.soltag) and len(self.buffer) == 153:
-                currdata = self.buffer
-                self.buffer = ''
-                dataarray, head = self.processLemiData(currdata)
-                if not dataarray == '':
-                    WSflag = 2
-
-            # 2. Found incorrect data length
-
-            ### Note: this code for fixing data is more complex than the POS fix code
-            ### due to the LEMI device having a start code rather than an EOL code.
-            ### It can handle and deal with multiple errors:
-            ###  - multiple data parts arriving at once
-            ###  - databits being lost. Bad string is then deleted.
-            ###  - bad bits infiltrating the data. Bad string is deleted.
-
-            if len(self.buffer) > 153:
-                if self.debug:
-                    log.msg('LEMI - Protocol: Warning: Bufferlength ({}) exceeds 153 characters, fixing...'.format(len(self.buffer)))
-                    log.msg("BUFFER: {}".format(self.buffer))
-                lemisearch = (self.buffer).find(self.soltag)
-                #print '1', lemisearch
-                if (self.buffer).startswith(self.soltag):
-                    datatest = len(self.buffer)%153
-                    dataparts = int(len(self.buffer)/153)
-                    log.msg('LEMI - Protocol: datatest {} and dataparts {}'.format(datatest,dataparts))
-                    if datatest == 0:
-                        if self.debug:
-                            log.msg('LEMI - Protocol: It appears multiple parts came in at once, amount N of parts: {}'.format(dataparts))
-                        for i in range(dataparts):
-                            split_data_string = self.buffer[0:153]
-                            if (split_data_string).startswith(self.soltag):
-                                if self.debug:
-                                    log.msg('LEMI - Protocol: Processing data part N {} in string...'.format(str(i+1)))
-                                dataarray, head = self.processLemiData(split_data_string)
-                                WSflag = 2
-                                self.buffer = self.buffer[153:len(self.buffer)]
-                            else:
-                                flag = 1
-                                break
-                    else:
-                        for i in range(dataparts):
-                            lemisearch = (self.buffer).find(self.soltag, 6)
-                            if lemisearch >= 153:
-                                split_data_string = self.buffer[0:153]
-                                dataarray, head = self.processLemiData(split_data_string)
-                                WSflag = 2
-                                self.buffer = self.buffer[153:len(self.buffer)]
-                            elif lemisearch == -1:
-                                log.msg('LEMI - Protocol: No header found. Deleting buffer.')
-                                self.buffer = ''
-                            else:
-                                log.msg('LEMI - Protocol: String contains bad data ({} bits). Deleting. Lemisearchpos: {}'.format(len(self.buffer[:lemisearch]), lemisearch))
-                                #self.buffer = ''
-                                self.buffer = self.buffer[lemisearch:len(self.buffer)]
-                                flag = 1
-                                self.buffererrorcnt += 1
-                                #break #uncommented on 2018-09-11
-                    if self.buffererrorcnt == 10:
-                        self.initiateRestart()
-
-                else:
-                    log.msg('LEMI - Protocol: Incorrect header. Attempting to fix buffer... Bufferlength: {}'.format(len(self.buffer)))
-                    lemisearch = (self.buffer).find(self.soltag, 6)
-                    #lemisearch = repr(self.buffer).find(self.soltag)
-                    if lemisearch == -1:
-                        log.msg('LEMI - Protocol: No header found. Deleting buffer.')
-                        self.buffer = ''
-                    else:
-                        self.buffer = self.buffer[lemisearch:len(self.buffer)]
-                        log.msg('LEMI - Protocol: Bad data ({} bits) deleted. New bufferlength: {}'.format(lemisearch,len(self.buffer)))
-                        flag = 1
-
-            if flag in [0,1]: #flag == 0: #uncommented 2018-09-11
-                self.buffer = self.buffer + data
-
+            frames = self.parser.feed(data)
         except:
             log.msg('LEMI - Protocol: Error while parsing data.')
             #Emtpying buffer
-            self.buffer = ''
+            self.parser.reset()
+            frames = []
             self.buffererrorcnt += 1
-            if self.buffererrorcnt == 10:
-                self.initiateRestart()
 
-        ## publish events to all clients subscribed to topic
-        if WSflag == 2:
-
-            self.buffererrorcnt = 0
-            senddata = False
-            coll = int(self.sensordict.get('stack'))
-            if coll > 1:
-                self.metacnt = 1 # send meta data with every block
-                if self.datacnt < coll:
-                    self.datalst.append(dataarray)
-                    self.datacnt += 1
-                else:
-                    senddata = True
-                    dataarray = ';'.join(self.datalst)
-                    self.datalst = []
-                    self.datacnt = 0
-            else:
-                senddata = True
+        if self.parser.resyncs > resyncs:
+            log.msg('LEMI - Protocol: Bad data deleted - resynchronising on header. Total amount of deleted bytes: {}'.format(self.parser.discarded))
+            self.buffererrorcnt += 1
 
-            if senddata:
-                self.client.publish(topic+"/data", dataarray, qos=self.qos)
-                if self.count == 0:
-                    add = "SensorID:{},StationID:{},DataPier:{},SensorModule:{},SensorGroup:{},SensorDescription:{},DataTimeProtocol:{},DataNTPTimeDelay:{},DataCompensationX:{},DataCompensationY:{},DataCompensationZ:{}".format( self.sensordict.get('sensorid',''),self.confdict.get('station',''),self.sensordict.get('pierid',''),self.sensordict.get('protocol',''),self.sensordict.get('sensorgroup',''),self.sensordict.get('sensordesc','').rstrip(),self.sensordict.get('ptime',''),self.timedelay, self.compensation[0],self.compensation[1],self.compensation[2] )
-                    self.client.publish(topic+"/dict", add, qos=self.qos)
-                    self.client.publish(topic+"/meta", head, qos=self.qos)
-                self.count += 1
-                if self.count >= self.metacnt:
-                    self.count = 0
+        for frame in frames:
+            if self.debug:
+                log.msg('LEMI - Protocol: Processing data frame {}'.format(self.parser.frames))
+            try:
+                dataarray, head = self.processLemiData(frame)
+            except:
+                log.msg('LEMI - Protocol: Error while processing data.')
+                continue
+            if not dataarray == '':
+                self.buffererrorcnt = 0
+                self.publishLemiData(dataarray, head)
+
+        if self.buffererrorcnt >= 10:
+            self.initiateRestart()
+
+    def publishLemiData(self, dataarray, head):
+        """
+        publish events to all clients subscribed to topic
+        """
+        topic = self.confdict.get('station') + '/' + self.sensordict.get('sensorid')
 
+        senddata = False
+        coll = int(self.sensordict.get('stack'))
+        if coll > 1:
+            self.metacnt = 1 # send meta data with every block
+            if self.datacnt < coll:
+                self.datalst.append(dataarray)
+                self.datacnt += 1
+            else:
+                senddata = True
+                dataarray = ';'.join(self.datalst)
+                self.datalst = []
+                self.datacnt = 0
+        else:
+            senddata = True
+
+        if senddata:
+            self.client.publish(topic+"/data", dataarray, qos=self.qos)
+            if self.count == 0:
+                add = "SensorID:{},StationID:{},DataPier:{},SensorModule:{},SensorGroup:{},SensorDescription:{},DataTimeProtocol:{},DataNTPTimeDelay:{},DataCompensationX:{},DataCompensationY:{},DataCompensationZ:{}".format( self.sensordict.get('sensorid',''),self.confdict.get('station',''),self.sensordict.get('pierid',''),self.sensordict.get('protocol',''),self.sensordict.get('sensorgroup',''),self.sensordict.get('sensordesc','').rstrip(),self.sensordict.get('ptime',''),self.timedelay, self.compensation[0],self.compensation[1],self.compensation[2] )
+                self.client.publish(topic+"/dict", add, qos=self.qos)
+                self.client.publish(topic+"/meta", head, qos=self.qos)
+            self.count += 1
+            if self.count >= self.metacnt:
+                self.count = 0
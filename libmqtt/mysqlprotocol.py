@@ -10,6 +10,7 @@ import struct # for binary representation
 import socket # for hostname identification
 import string # for ascii selection
 import numpy as np
+import threading
 from datetime import datetime, timedelta
 from twisted.protocols.basic import LineReceiver
 from twisted.python import log
@@ -57,6 +58,19 @@ class MySQLProtocol(object):
 
         self.deltathreshold = confdict.get('timedelta')
 
+        # header and sampling rate are cached and refreshed every metarefresh seconds
+        try:
+            self.metarefresh = int(confdict.get('mysqlmetarefresh',3600))
+        except:
+            self.metarefresh = 3600
+        self.metadata = {}
+        # amount of parallel database connections for data requests
+        try:
+            self.workers = max(1,int(confdict.get('mysqlworkers',1)))
+        except:
+            self.workers = 1
+        self.connections = []
+
         # debug mode
         debugtest = confdict.get('debug')
         self.debug = False
@@ -77,8 +91,9 @@ class MySQLProtocol(object):
         # get existing sensors for the relevant board
         log.msg("  -> IMPORTANT: MySQL assumes that database credentials ")
         log.msg("     are saved locally using magpy.opt.cred with the same name as database")
+        self.dbname = self.sensor
         try:
-            self.db = mdb.mysql.connect(host=mpcred.lc(self.sensor,'host'),user=mpcred.lc(self.sensor,'user'),passwd=mpcred.lc(self.sensor,'passwd'),db=self.sensor)
+            self.db = self.connect(self.dbname)
             self.connectionMade(self.sensor)
         except:
             self.connectionLost(self.sensor,"Database could not be connected - check existance/credentials")
@@ -100,6 +115,9 @@ class MySQLProtocol(object):
         #print (self.sensorlist)
 
 
+    def connect(self, dbname):
+        return mdb.mysql.connect(host=mpcred.lc(dbname,'host'),user=mpcred.lc(dbname,'user'),passwd=mpcred.lc(dbname,'passwd'),db=dbname)
+
     def connectionMade(self, dbname):
         log.msg('  -> Database {} connected.'.format(dbname))
 
@@ -179,6 +197,157 @@ class MySQLProtocol(object):
         return senslist3
 
 
+    def getList(self, sql, db=None):
+        """
+        DESCRIPTION:
+            return all rows of sql query (list of tuples) or an error message
+        """
+        if not db:
+            db = self.db
+        cursor = db.cursor()
+        try:
+            cursor.execute(sql)
+        except mdb.mysql.IntegrityError as message:
+            return message
+        except mdb.mysql.Error as message:
+            return message
+        except:
+            return 'dbgetlines: unkown error'
+        return list(cursor.fetchall())
+
+
+    def getMeta(self, sensorid):
+        """
+        DESCRIPTION:
+            return cached header information of sensorid. The information is
+            obtained from the database at the first call and refreshed every
+            metarefresh seconds.
+        RETURNS:
+            dictionary with keys (list of columns), header, packcode and samplingrate
+        """
+        now = datetime.utcnow()
+        meta = self.metadata.get(sensorid)
+        if meta and (now-meta.get('time')).total_seconds() < self.metarefresh:
+            return meta
+
+        if self.debug:
+            log.msg("  -> DEBUG - requesting header {}".format(sensorid))
+        # load keys, elements and units
+        #header = "# MagPyBin %s %s %s %s %s %s %d" % (sensorid, key, ele, unit, multplier, packcode, struct.calcsize('<'+packcode))
+        dataid = sensorid+'_'+self.revision
+        keystab = [el[0] for el in self.getList('SHOW COLUMNS FROM {}'.format(dataid))]
+        keystab = [key for key in keystab if not key in ['time','flag','typ','comment']]
+        sensorvals = self.getList('SELECT SensorElements, SensorKeys FROM SENSORS WHERE SensorID LIKE "{}"'.format(sensorid))
+        infovals = self.getList('SELECT ColumnUnits, ColumnContents, DataSamplingRate FROM DATAINFO WHERE SensorID LIKE "{}"'.format(sensorid))
+
+        def split(rows, idx):
+            try:
+                return rows[0][idx].split(',')
+            except:
+                return []
+        elem = split(sensorvals, 0)
+        keyssens = split(sensorvals, 1)
+        unit = split(infovals, 0)
+        cont = split(infovals, 1)
+        units, elems = [], []
+        for key in keystab:
+            try:
+                pos1 = keyssens.index(key)
+                ele = elem[pos1]
+            except:
+                ele = key
+            elems.append(ele)
+            try:
+                pos2 = cont.index(ele)
+                units.append(unit[pos2])
+            except:
+                units.append('None')
+        if self.debug:
+            log.msg("  -> DEBUG - creating head line {}".format(sensorid))
+        multplier = '['+','.join(map(str, [10000]*len(keystab)))+']'
+        packcode = '6HL'+''.join(['q']*len(keystab))
+        header = ("# MagPyBin {} {} {} {} {} {} {}".format(sensorid, '['+','.join(keystab)+']', '['+','.join(elems)+']', '['+','.join(units)+']', multplier, packcode, struct.calcsize('<'+packcode)))
+        try:
+            sr = float(infovals[0][2])
+        except:
+            # keep previous sampling rate if not readable
+            sr = meta.get('samplingrate') if meta else 1.0
+        meta = {'keys':keystab, 'header':header, 'packcode':packcode, 'samplingrate':sr, 'time':now}
+        self.metadata[sensorid] = meta
+        return meta
+
+
+    def getData(self, index, sensorid, meta, db=None):
+        """
+        DESCRIPTION:
+            return new rows of sensorid. The first request obtains the most
+            recent rows covering the request rate, all further requests only
+            rows after the last transmitted time (limited to the same amount,
+            remaining rows are obtained by the next requests).
+        """
+        dataid = sensorid+'_'+self.revision
+        sr = meta.get('samplingrate') if meta.get('samplingrate') > 0 else 1.0
+        coverage = int(self.requestrate/sr)+120
+        keys = ','.join(['time']+meta.get('keys'))
+        lastt = self.lastt[index]
+        if not lastt:
+            sql = 'SELECT {} FROM {} ORDER BY time DESC LIMIT {}'.format(keys, dataid, coverage)
+        else:
+            sql = 'SELECT {} FROM {} WHERE time > "{}" ORDER BY time ASC LIMIT {}'.format(keys, dataid, lastt, coverage)
+        li = self.getList(sql, db=db)
+        if not isinstance(li, list):
+            log.msg("  -> Data request for {} failed: {}".format(dataid, li))
+            return []
+        return sorted(li)
+
+
+    def getAllData(self, requests):
+        """
+        DESCRIPTION:
+            obtain data for a list of (index, sensorid, meta) requests. If
+            mysqlworkers > 1, requests are distributed to parallel connections.
+        RETURNS:
+            dictionary index: rows
+        """
+        results = {}
+        if self.workers < 2 or len(requests) < 2:
+            for index, sensorid, meta in requests:
+                results[index] = self.getData(index, sensorid, meta)
+            return results
+
+        while len(self.connections) < min(self.workers, len(requests)):
+            try:
+                self.connections.append(self.connect(self.dbname))
+            except:
+                log.msg("  -> Could not open additional connection to {}".format(self.dbname))
+                break
+        if not self.connections:
+            self.connections.append(self.db)
+        pending = list(requests)
+        lock = threading.Lock()
+
+        def work(db):
+            while True:
+                with lock:
+                    if not pending:
+                        return
+                    index, sensorid, meta = pending.pop(0)
+                try:
+                    rows = self.getData(index, sensorid, meta, db=db)
+                except Exception as e:
+                    log.msg("  -> Data request for {} failed: {}".format(sensorid, e))
+                    rows = []
+                with lock:
+                    results[index] = rows
+
+        threads = [threading.Thread(target=work, args=(db,)) for db in self.connections]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+
     def sendRequest(self):
         """
         source:mysql:
@@ -191,113 +360,26 @@ class MySQLProtocol(object):
         if self.debug:
             log.msg("  -> DEBUG - Sending periodic request ...")
 
-        def getList(sql):
-            cursor = self.db.cursor()
-            try:
-                cursor.execute(sql)
-            except mysql.IntegrityError as message:
-                return message
-            except mysql.Error as message:
-                return message
-            except:
-                return 'dbgetlines: unkown error'
-            head = cursor.fetchall()
-            keys = list(np.transpose(np.asarray(head))[0])
-            return keys
-
         # get self.sensorlist
-        # get last timestamps 
+        # get cached header information
         # read all data for each sensor since last timestamp
         # send that and store last timestamp 
+        requests = []
         for index,sensdict in enumerate(self.sensorlist):
             sensorid = sensdict.get('sensorid')
             if self.debug:
                 log.msg("  -> DEBUG - dealing with sensor {}".format(sensorid))
-            # 1. Getting header
-            # -----------------
-            # load keys, elements and units
-            #header = "# MagPyBin %s %s %s %s %s %s %d" % (sensorid, key, ele, unit, multplier, packcode, struct.calcsize('<'+packcode))
-            dataid = sensorid+'_'+self.revision
-            keyssql = 'SHOW COLUMNS FROM %s' % (dataid)
-            keystab = getList(keyssql)
-            if 'time' in keystab:
-                keystab.remove('time')
-            if 'flag' in keystab:
-                keystab.remove('flag')
-            if 'typ' in keystab:
-                keystab.remove('typ')
-            if 'comment' in keystab:
-                keystab.remove('comment')
-            keys = ','.join(keystab)
-            if self.debug:
-                log.msg("  -> DEBUG - requesting header {}".format(sensorid))
-            sql1 = 'SELECT SensorElements FROM SENSORS WHERE SensorID LIKE "{}"'.format(sensorid)
-            sql2 = 'SELECT Sensorkeys FROM SENSORS WHERE SensorID LIKE "{}"'.format(sensorid)
-            sql3 = 'SELECT ColumnUnits FROM DATAINFO WHERE SensorID LIKE "{}"'.format(sensorid)
-            sql4 = 'SELECT ColumnContents FROM DATAINFO WHERE SensorID LIKE "{}"'.format(sensorid)
-            try:
-                elem = getList(sql1)[0].split(',')
-            except:
-                elem =[]
-            try:
-                keyssens = getList(sql2)[0].split(',')
-            except:
-                keyssens =[]
-            try:
-                unit = getList(sql3)[0].split(',')
-            except:
-                unit =[]
             try:
-                cont = getList(sql4)[0].split(',')
-            except:
-                cont =[]
-            units, elems = [], []
-            for key in keystab:
-                try:
-                    pos1 = keyssens.index(key)
-                    ele = elem[pos1]
-                except:
-                    ele = key
-                elems.append(ele)
-                try:
-                    pos2 = cont.index(ele)
-                    units.append(unit[pos2])
-                except:
-                    units.append('None')
-            if self.debug:
-                log.msg("  -> DEBUG - creating head line {}".format(sensorid))
-            multplier = '['+','.join(map(str, [10000]*len(keystab)))+']'
-            packcode = '6HL'+''.join(['q']*len(keystab))
-            header = ("# MagPyBin {} {} {} {} {} {} {}".format(sensorid, '['+','.join(keystab)+']', '['+','.join(elems)+']', '['+','.join(units)+']', multplier, packcode, struct.calcsize('<'+packcode)))
-
-            # 2. Getting dict
-            sql = 'SELECT DataSamplingRate FROM DATAINFO WHERE SensorID LIKE "{}"'.format(sensorid)
-            sr = float(getList(sql)[0])
-            coverage = int(self.requestrate/sr)+120
-
-            # 3. Getting data
-            # get data and create typical message topic
-            # based on sampling rate and collection rate -> define coverage
-
-            li = sorted(mdb.dbselect(self.db, 'time,'+keys, dataid, expert='ORDER BY time DESC LIMIT {}'.format(int(coverage))))
-            if not self.lastt[index]:
-                self.lastt[index]=li[0][0]
-
-            # drop
-            newdat = False
-            newli = []
-            for elem in li:
-                if elem[0] == self.lastt[index]:
-                    newdat = True
-                if newdat:
-                    newli.append(elem)
-
-            if not len(newli) > 0:
-                # if last time not included in li then newli will be empty
-                # in this case just add the list
-                for elem in li:
-                    newli.append(elem)
-
+                requests.append((index, sensorid, self.getMeta(sensorid)))
+            except Exception as e:
+                log.msg("  -> Could not obtain header of {}: {}".format(sensorid, e))
+        results = self.getAllData(requests)
+
+        for index, sensorid, meta in requests:
+            newli = results.get(index,[])
+            keystab = meta.get('keys')
+            packcode = meta.get('packcode')
+            header = meta.get('header')
             for dataline in newli:
                 timestamp = dataline[0]
                 data_bin = None
@@ -320,7 +402,8 @@ class MySQLProtocol(object):
                     log.msg("  -> DEBUG - sending ... {}".format(','.join(list(map(str,datearray))), header))
                 self.sendData(sensorid,','.join(list(map(str,datearray))),header,len(newli)-1)
 
-            self.lastt[index]=li[-1][0]
+            if len(newli) > 0:
+                self.lastt[index]=newli[-1][0]
 
         t2 = datetime.utcnow()
         if self.debug:
@@ -10,6 +10,9 @@ import sys    # for version identification
 import struct # for binary representation
 import socket # for hostname identification
 import string # for ascii selection
+import json
+import time
+import threading
 from datetime import datetime, timedelta
 #from twisted.protocols.basic import LineReceiver
 from twisted.python import log
@@ -50,14 +53,22 @@ if onewire:
             self.printable = set(string.printable)
             self.reconnectcount = 0
             self.removelist = [] # list of sensorspaths from sensors.cfg which are not found
+            # bus topology is cached and scanned again every owrescan seconds or after read errors
+            self.rescaninterval = int(confdict.get('owrescan',600))
+            self.workers = max(1,int(confdict.get('owworkers',4)))
+            self.simultaneous = not confdict.get('owsimultaneous','True') in ['False','false']
+            self.proxies = []
+            self.lastscan = 0
+            self.rescan = False
             # Extract eventually existing one wire sensors from sensors.cfg
             log.msg("  -> one wire: Checking existing sensors ...")
             self.existinglist = acs.GetSensors(confdict.get('sensorsconf'),identifier='!')
             log.msg("  -> one wire: Checking for new sensors ...")
             self.sensorarray = self.GetOneWireSensorList(self.existinglist)
+            self.lastscan = time.time()
             self.count = [0]*len(self.sensorarray)  ## counter for sending header information
             self.metacnt = 2  # Send header information often for OW
-            self.datalst = [[]]*len(self.sensorarray)
+            self.datalst = [[] for el in self.sensorarray]
             self.datacnt = [0]*len(self.sensorarray)
             log.msg("  -> one wire: Initialized")
             #print (self.existinglist)
@@ -142,6 +153,80 @@ if onewire:
                         idlist.append(values)
             return idlist
 
+        def GetProxies(self, amount):
+            """
+            DESCRIPTION:
+                return a list of persistent owserver connections for parallel reads
+            """
+            while len(self.proxies) < amount:
+                try:
+                    proxy = pyownet.protocol.proxy(host=self.owhost, port=self.owport, persistent=True)
+                except TypeError:
+                    # old pyownet versions without persistent connections
+                    proxy = pyownet.protocol.proxy(host=self.owhost, port=self.owport)
+                except Exception as e:
+                    log.msg("OW: could not open connection to owserver: {}".format(e))
+                    break
+                self.proxies.append(proxy)
+            return self.proxies[:amount]
+
+        def CloseProxies(self):
+            for proxy in self.proxies:
+                try:
+                    proxy.close_connection()
+                except Exception:
+                    pass
+            self.proxies = []
+
+        def ReadValues(self, sensorarray):
+            """
+            DESCRIPTION:
+                read all parameters of all sensors. Reads are distributed to
+                up to owworkers owserver connections.
+            RETURNS:
+                a list of value dictionaries (None if a read failed) and the amount of errors
+            """
+            tasks = []
+            for idx, line in enumerate(sensorarray):
+                for para in typedef.get(line.get('name'),[]):
+                    tasks.append((idx, para, line.get('path')+para))
+            results = [{} for line in sensorarray]
+            failed = set()
+            lock = threading.Lock()
+
+            def work(proxy):
+                while True:
+                    with lock:
+                        if not tasks:
+                            return
+                        idx, para, path = tasks.pop(0)
+                    try:
+                        value = proxy.read(path)
+                    except Exception as e:
+                        log.msg("OW: could not read {}: {}".format(path, e))
+                        value = None
+                    with lock:
+                        if value is None:
+                            failed.add(idx)
+                        else:
+                            results[idx][para] = value
+
+            proxies = self.GetProxies(min(self.workers, len(tasks)))
+            if not proxies:
+                # owserver not reachable
+                return [None for line in sensorarray], len(sensorarray)
+            if len(proxies) > 1:
+                threads = [threading.Thread(target=work, args=(proxy,)) for proxy in proxies]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            elif tasks:
+                work(proxies[0])
+            for idx in failed:
+                results[idx] = None
+            return results, len(failed)
+
         #def connectionMade(self):
         #    log.msg('%s connected.' % self.sensor)
 
@@ -151,29 +236,37 @@ if onewire:
 
         def sendRequest(self):
             #log.msg("Sending periodic request ...")
-            sensorarray = self.GetOneWireSensorList(self.existinglist)
+            t0 = time.time()
+            if self.rescan or t0-self.lastscan > self.rescaninterval:
+                self.sensorarray = self.GetOneWireSensorList(self.existinglist)
+                self.lastscan = t0
+                self.rescan = False
+            sensorarray = self.sensorarray
             if not len(self.count) == len(sensorarray):
                 # if length of sensorarray is changing - reset counters 
                 self.count = [0]*len(sensorarray)
-                self.datalst = [[]]*len(self.sensorarray)
-                self.datacnt = [0]*len(self.sensorarray)
+                self.datalst = [[] for el in sensorarray]
+                self.datacnt = [0]*len(sensorarray)
+            t1 = time.time()
+            if self.simultaneous and any([line.get('name','').startswith('DS18') for line in sensorarray]):
+                # one temperature conversion for all sensors - owserver skips conversions when reading temperatures afterwards
+                try:
+                    self.owproxy.write('/simultaneous/temperature', b'1')
+                except Exception as e:
+                    log.msg("OW: simultaneous conversion failed: {}".format(e))
+            t2 = time.time()
+            values, errors = self.ReadValues(sensorarray)
+            t3 = time.time()
+            if errors or not sensorarray:
+                # sensors might have been removed or owserver restarted - scan bus and reconnect with next request
+                self.rescan = True
+                self.CloseProxies()
             for idx, line in enumerate(sensorarray):
                 #print ("Getting sensor ID:", line.get('sensorid'))
                 sensorid = line.get('sensorid')
-                valuedict = {}
-                for para in typedef.get(line.get('name')):
-                    path = line.get('path')+para
-                    if para == 'humidity': ## Check whether separete treatment is necessary
-                        pass
-                        #line.get('path')+para
-                        #print ("ALL", self.owproxy.dir())
-                        #print ("sens",self.owproxy.dir(line.get('path')))
-                        #if para == 'pressure':
-                        #    #if sensortypus == "pressure":
-                        #    #    #print "Pressure [hPa]: ", self.mpxa4100(vad,temp)
-                        #    #    humidity = self.mpxa4100(vad,temp)
-                        #    pass
-                    valuedict[para] = self.owproxy.read(path)
+                valuedict = values[idx]
+                if valuedict is None:
+                    continue
 
                 topic = self.confdict.get('station') + '/' + sensorid
                 data, head  = self.processOwData(sensorid, valuedict)
@@ -213,6 +306,10 @@ if onewire:
                     if self.count[idx] >= self.metacnt:
                         self.count[idx] = 0
 
+            # read latency of this cycle
+            latency = {'sensors':len(sensorarray), 'errors':errors, 'scan':round(t1-t0,3), 'conversion':round(t2-t1,3), 'read':round(t3-t2,3), 'total':round(time.time()-t0,3)}
+            self.client.publish(self.confdict.get('station') + '/' + str(self.sensor) + '/latency', json.dumps(latency), qos=0)
+
 
         def processOwData(self, sensorid, datadict):
             """Process OW data """
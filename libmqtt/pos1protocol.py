@@ -9,10 +9,12 @@ import re     # for interpretation of lines
 import struct # for binary representation
 import socket # for hostname identification
 import string # for ascii selection
+import numpy as np
 from datetime import datetime, timedelta
 from twisted.protocols.basic import LineReceiver
 from twisted.python import log
 from core import acquisitionsupport as acs
+from core.frameparser import TerminatorFrameParser
 
 
 ## POS1 protocol
@@ -62,8 +64,11 @@ class POS1Protocol(LineReceiver):
         self.ntp_gps_offset = 6.2 # sec - is only used for time diff checks - true ntp time is stored
         self.timethreshold = 3 # secs - waring if timedifference is larger the 3 seconds
 
-        delimiter = '\x00'
-        self.buffer = ''
+        # POS1 frames: 44 ascii characters terminated by '\x00'
+        self.parser = TerminatorFrameParser(b'\x00', 44)
+        self.lost = 0
+        self.packcode = '6hLLLh6hL'
+        self.header = "# MagPyBin %s %s %s %s %s %s %d" % (self.sensor, '[f,df,var1,sectime]', '[f,df,var1,GPStime]', '[nT,nT,none,none]', '[1000,1000,1,1]', self.packcode, struct.calcsize('<'+self.packcode))
 
         # QOS
         self.qos=int(confdict.get('mqttqos',0))
@@ -79,158 +84,115 @@ class POS1Protocol(LineReceiver):
     def connectionLost(self, reason):
         log.msg('  -> {} lost.'.format(self.sensor))
 
-    def processPos1Data(self, data):
-        """Convert raw ADC counts into SI units as per datasheets"""
-        if len(data) != 44:
-            log.err('POS1 - Protocol: Unable to parse data of length %i' % len(data))
-
-        currenttime = datetime.utcnow()
+    def decodePos1Frame(self, frame):
+        """
+        DESCRIPTION:
+            decode a POS1 frame (e.g. memoryview from TerminatorFrameParser)
+        RETURNS:
+            dictionary with intensity (nT), sigma (nT), errorcode (int) and
+            gpstime (datetime). Raises ValueError if the frame is not readable.
+        """
+        line = bytes(frame).rstrip(b'\x00').decode('ascii', 'ignore')
+        data_array = line.split()
+        if len(data_array) < 6:
+            raise ValueError("incomplete frame: {}".format(line))
+        dataelements = datetime.strptime(data_array[4],"%m-%d-%y")
+        gps_time = datetime.strftime(dataelements,"%Y-%m-%d") + ' ' + str(data_array[5])[:11]
+        return {'intensity': float(data_array[0])/1000.,
+                'sigma': float(data_array[2])/1000.,
+                'errorcode': int(data_array[3].strip('[').strip(']')),
+                'gpstime': datetime.strptime(gps_time, "%Y-%m-%d %H:%M:%S.%f")}
+
+    def processPos1Data(self, fields, currenttime):
+        """
+        DESCRIPTION:
+            store the decoded values (see decodePos1Frame) in the buffer file
+        RETURNS:
+            the data line as list of integers and the header
+        """
         outdate = datetime.strftime(currenttime, "%Y-%m-%d")
-        actualtime = datetime.strftime(currenttime, "%Y-%m-%dT%H:%M:%S.%f")
-        outtime = datetime.strftime(currenttime, "%H:%M:%S")
-        timestamp = datetime.strftime(currenttime, "%Y-%m-%d %H:%M:%S.%f")
         filename = outdate
         sensorid = self.sensor
-
-        packcode = '6hLLLh6hL'
-        header = "# MagPyBin %s %s %s %s %s %s %d" % (self.sensor, '[f,df,var1,sectime]', '[f,df,var1,GPStime]', '[nT,nT,none,none]', '[1000,1000,1,1]', packcode, struct.calcsize('<'+packcode))
-
-        try:
-            # Extract data
-            data_array = data.split()
-            intensity = float(data_array[0])/1000.
-            sigma_int = float(data_array[2])/1000.
-            err_code = int(data_array[3].strip('[').strip(']'))
-            dataelements = datetime.strptime(data_array[4],"%m-%d-%y")
-            newdate = datetime.strftime(dataelements,"%Y-%m-%d")
-            gps_time = newdate + ' ' + str(data_array[5])[:11]
-        except:
-            log.err('POS1 - Protocol: Data formatting error.')
-            intensity = 0.0
-            sigma_int = 0.0
-            err_code = 0.0
-
-        try:
-            # Analyze time difference between POS1 internal time and utc from PC
-            # Please note that the time difference between POS1-GPS (data recorded) 
-            # and NTP (data received at PC) can be very large
-            # for our POS1 it is 6.2 seconds
-
-            gpstime = datetime.strptime(gps_time, "%Y-%m-%d %H:%M:%S.%f")
-            timelist = sorted([gpstime,currenttime])
-            timediff = timelist[1]-timelist[0]
-            delta = timediff.total_seconds()
-            if not delta in [0.0, np.nan, None]:
-                self.delaylist.append(delta)
-                self.delaylist = self.delaylist[-1000:]
-            if len(self.delaylist) > 100:
-                try:
-                    self.timedelay = np.median(np.asarray(self.delaylist))
-                except:
-                    self.timedelay = 0.0
-            if delta-self.ntp_gps_offset > self.timethreshold:
-                self.errorcnt['time'] +=1
-                if self.errorcnt.get('time') < 2:
-                    log.msg("{} protocol: large time difference observed for {}: {} sec".format(self.sensordict.get('protocol'), sensorid, secdiff))
-            else:
-                self.errorcnt['time'] = 0 
-        except:
-            pass
+        gpstime = fields.get('gpstime')
+
+        # Analyze time difference between POS1 internal time and utc from PC
+        # Please note that the time difference between POS1-GPS (data recorded) 
+        # and NTP (data received at PC) can be very large
+        # for our POS1 it is 6.2 seconds
+        timelist = sorted([gpstime,currenttime])
+        delta = (timelist[1]-timelist[0]).total_seconds()
+        if not delta == 0.0:
+            self.delaylist.append(delta)
+            self.delaylist = self.delaylist[-1000:]
+        if len(self.delaylist) > 100:
+            self.timedelay = np.median(np.asarray(self.delaylist))
+        if delta-self.ntp_gps_offset > self.timethreshold:
+            self.errorcnt['time'] +=1
+            if self.errorcnt.get('time') < 2:
+                log.msg("{} protocol: large time difference observed for {}: {} sec".format(self.sensordict.get('protocol'), sensorid, delta))
+        else:
+            self.errorcnt['time'] = 0 
 
         if self.sensordict.get('ptime','') in ['NTP','ntp']:
-            secondtime = gps_time
-            maintime = timestamp
+            maintime, secondtime = currenttime, gpstime
         else:
-            maintime = gps_time
-            secondtime = timestamp
+            maintime, secondtime = gpstime, currenttime
 
+        datearray = acs.datetime2array(maintime)
+        datearray.append(int(round(fields.get('intensity')*1000)))
+        datearray.append(int(round(fields.get('sigma')*1000)))
+        datearray.append(fields.get('errorcode'))
+        datearray.extend(acs.datetime2array(secondtime))
         try:
-            # extract time data
-            datearray = acs.timeToArray(maintime)
-            sectarray = acs.timeToArray(secondtime)
-            try:
-                datearray.append(int(intensity*1000))
-                datearray.append(int(sigma_int*1000))
-                datearray.append(err_code)
-                datearray.extend(sectarray)
-                data_bin = struct.pack('<'+packcode,datearray[0],datearray[1],datearray[2],datearray[3],datearray[4],datearray[5],datearray[6],datearray[7],datearray[8],datearray[9],datearray[10],datearray[11],datearray[12],datearray[13],datearray[14],datearray[15],datearray[16])
-            except:
-                log.msg('POS1 - Protocol: Error while packing binary data')
-                pass
+            data_bin = struct.pack('<'+self.packcode,*datearray)
             if not self.confdict.get('bufferdirectory','') == '':
-                acs.dataToFile(self.confdict.get('bufferdirectory'), sensorid, filename, data_bin, header)
+                acs.dataToFile(self.confdict.get('bufferdirectory'), sensorid, filename, data_bin, self.header)
         except:
             log.msg('POS1 - Protocol: Error with binary save routine')
-            pass
 
-        return ','.join(list(map(str,datearray))), header
+        return datearray, self.header
 
     def dataReceived(self, data):
 
         topic = self.confdict.get('station') + '/' + self.sensordict.get('sensorid')
-        # extract only ascii characters 
-
-        ok = False
-        try:
-            if len(self.buffer) == 44:
-                dataarray, head = self.processPos1Data(self.buffer[:44])
-                self.buffer = ''
-                try:
-                    value = float(dataarray.split(',')[7])
-                except:
-                    value = 0.0
-                if value > 0:
-                    ok = True
-                else:
-                    log.err('POS1 - Protocol: Zero value, skipping. (Value still written to file.)')
-            self.buffer = self.buffer + data
-            if len(self.buffer) > 44:
-                log.msg('POS1 - Protocol: Warning: Bufferlength (%s) exceeds 44 characters, fixing...' % len(self.buffer))
-                if repr(data).endswith("x00'"):    # check if last part read is end of POS string.
-                    datatest = (len(self.buffer))%44
-                    # OPTION 1: Data is good, but too much arrived at once. Split and process.
-                    if datatest == 0:
-                        dataparts = int(len(self.buffer)/44)
-                        log.msg('POS1 - Protocol: It appears multiple parts came in at once, # of parts:', dataparts)
-                        for i in range(dataparts):
-                            split_data_string = self.buffer[i*44:(i*44)+44]
-                            log.msg('POS1 - Protocol: Processing data part # %s in string (%s)' % (str(i+1), split_data_string))
-                            dataarray, head = self.processPos1Data(split_data_string)
-                            try:
-                                value = float(dataarray.split(',')[7])
-                            except:
-                                value = 0.0
-                            if value > 0:
-                                ok = True
-                            else:
-                                log.err('POS1 - Protocol: Zero value, skipping. (Value still written to file.)')
-                        self.buffer = ''
-                    # OPTION 2: Data is bad; bit was lost.
-                    else:
-                        log.msg('POS1 - Protocol: String contains bad data. Deleting. (String content: %s)' % self.buffer)
-                        self.buffer = ''              # If true, bad data. Log and delete.
-                else:    # if last part read is not end of POS string, continue reading.
-                    log.msg('POS1 - Protocol: Attempting to fix buffer... last part read:', self.buffer[-10:], "Bufferlength:", len(self.buffer))
-        except:
-            print('{}: Data seems not be POS1Data: Looks like {}'.format(self.sensordict.get('protocol'),data))
-            ok = False
+        if not isinstance(data, (bytes, bytearray)):
+            data = data.encode('latin-1')
+
+        # all complete frames of this chunk are published as one message
+        lines = []
+        head = self.header
+        for frame in self.parser.feed(data):
+            currenttime = datetime.utcnow()
+            try:
+                fields = self.decodePos1Frame(frame)
+            except ValueError as e:
+                log.err('POS1 - Protocol: Data formatting error ({})'.format(e))
+                continue
+            datearray, head = self.processPos1Data(fields, currenttime)
+            if fields.get('intensity') > 0:
+                lines.append(','.join(list(map(str,datearray))))
+            else:
+                log.err('POS1 - Protocol: Zero value, skipping. (Value still written to file.)')
 
+        if self.parser.lost > self.lost:
+            self.lost = self.parser.lost
+            log.msg('POS1 - Protocol: corrupted frames skipped - {}'.format(self.parser.statistics()))
 
-        if ok:
+        if lines:
             senddata = False
             coll = int(self.sensordict.get('stack'))
             if coll > 1:
                 self.metacnt = 1 # send meta data with every block
-                if self.datacnt < coll:
-                    self.datalst.append(dataarray)
-                    self.datacnt += 1
-                else:
+                self.datalst.extend(lines)
+                self.datacnt += len(lines)
+                if self.datacnt >= coll:
                     senddata = True
                     dataarray = ';'.join(self.datalst)
                     self.datalst = []
                     self.datacnt = 0
             else:
                 senddata = True
+                dataarray = ';'.join(lines)
 
             if senddata:
                 self.client.publish(topic+"/data", dataarray, qos=self.qos)
@@ -242,4 +204,3 @@ class POS1Protocol(LineReceiver):
                 self.count += 1
                 if self.count >= self.metacnt:
                     self.count = 0
-
@@ -0,0 +1,99 @@
+"""
+Filename:               registry
+Part of package:        acquisition
+Type:                   Part of data acquisition library
+
+PURPOSE:
+        Declarative registry of all MARTAS acquisition protocols.
+        Maps the protocol names used in sensors.cfg to the module and class
+        providing the protocol. Protocol modules are imported only when a
+        sensor requests them. Import times are measured and logged.
+
+CONTAINS:
+        PROTOCOLS:      (dict) protocol name -> module, class, mode, python versions, capabilities
+        supported:      (Func) list of supported protocol names
+        load:           (Func) import a protocol class (cached)
+        create:         (Func) create a protocol object for a sensor
+        importtimes:    (Func) import times of all loaded protocols
+
+CALLED BY:
+        acquisition.py
+"""
+from __future__ import print_function
+from __future__ import absolute_import
+
+import importlib
+import time
+from twisted.python import log
+
+
+# mode:     passive (serial port, twisted), active (scheduled sendRequest), autonomous (own thread)
+PROTOCOLS = {
+    'Env':           {'module':'envprotocol',           'class':'EnvProtocol',           'mode':'passive',    'python':'py2,py3', 'capabilities':['environment']},
+    'Ow':            {'module':'owprotocol',            'class':'OwProtocol',            'mode':'active',     'python':'py2,py3', 'capabilities':['environment','group']},
+    'Arduino':       {'module':'arduinoprotocol',       'class':'ArduinoProtocol',       'mode':'passive',    'python':'py2,py3', 'capabilities':['environment','group']},
+    'ActiveArduino': {'module':'activearduinoprotocol', 'class':'ActiveArduinoProtocol', 'mode':'active',     'python':'py2,py3', 'capabilities':['all','group']},
+    'BM35':          {'module':'bm35protocol',          'class':'BM35Protocol',          'mode':'passive',    'python':'py2',     'capabilities':['environment']},
+    'Lemi':          {'module':'lemiprotocol',          'class':'LemiProtocol',          'mode':'passive',    'python':'py2,py3', 'capabilities':['mag']},
+    'GSM90':         {'module':'gsm90protocol',         'class':'GSM90Protocol',         'mode':'passive',    'python':'py2',     'capabilities':['mag','init']},
+    'GSM19':         {'module':'gsm19protocol',         'class':'GSM19Protocol',         'mode':'passive',    'python':'py2',     'capabilities':['mag']},
+    'GP20S3':        {'module':'gp20s3protocol',        'class':'GP20S3Protocol',        'mode':'passive',    'python':'py2,py3', 'capabilities':['mag']},
+    'POS1':          {'module':'pos1protocol',          'class':'POS1Protocol',          'mode':'passive',    'python':'py2,py3', 'capabilities':['mag','init']},
+    'Cs':            {'module':'csprotocol',            'class':'CsProtocol',            'mode':'passive',    'python':'py2,py3', 'capabilities':['mag']},
+    'Lm':            {'module':'lmprotocol',            'class':'LmProtocol',            'mode':'passive',    'python':'py2,py3', 'capabilities':['environment']},
+    'MySQL':         {'module':'mysqlprotocol',         'class':'MySQLProtocol',         'mode':'active',     'python':'py2,py3', 'capabilities':['all','group','db']},
+    'Test':          {'module':'testprotocol',          'class':'TestProtocol',          'mode':'active',     'python':'py2,py3', 'capabilities':['random']},
+    'DSP':           {'module':'dspprotocol',           'class':'DSPProtocol',           'mode':'active',     'python':'py2,py3', 'capabilities':['environment']},
+    'Disdro':        {'module':'disdroprotocol',        'class':'DisdroProtocol',        'mode':'active',     'python':'py2,py3', 'capabilities':['environment']},
+    'ad7714':        {'module':'ad7714protocol',        'class':'ad7714Protocol',        'mode':'autonomous', 'python':'py2,py3', 'capabilities':['all','spi']},
+    'cr1000jc':      {'module':'cr1000jcprotocol',      'class':'cr1000jcProtocol',      'mode':'active',     'python':'py2,py3', 'capabilities':['all']},
+    'GIC':           {'module':'gicprotocol',           'class':'GICProtocol',           'mode':'active',     'python':'py3',     'capabilities':['all','web']},
+}
+
+_loaded = {}
+_importtimes = {}
+
+
+def supported():
+    """
+    DESCRIPTION:
+        return a list of all protocol names
+    """
+    return sorted(PROTOCOLS.keys())
+
+
+def load(name):
+    """
+    DESCRIPTION:
+        import the module of protocol 'name' and return the protocol class.
+        Modules are imported once and only when requested.
+    """
+    if name in _loaded:
+        return _loaded[name]
+    entry = PROTOCOLS.get(name)
+    if not entry:
+        raise ValueError("protocol {} not found in registry".format(name))
+    start = time.time()
+    module = importlib.import_module("libmqtt.{}".format(entry.get('module')))
+    _importtimes[name] = time.time()-start
+    log.msg("  -> Imported protocol {} in {:.3f} sec".format(name, _importtimes[name]))
+    protocolclass = getattr(module, entry.get('class'))
+    _loaded[name] = protocolclass
+    return protocolclass
+
+
+def create(name, client, sensordict, confdict):
+    """
+    DESCRIPTION:
+        create a protocol object for a sensor
+    """
+    protocolclass = load(name)
+    return protocolclass(client, sensordict, confdict)
+
+
+def mode(name):
+    return PROTOCOLS.get(name,{}).get('mode')
+
+
+def importtimes():
+    return _importtimes.copy()
@@ -6,6 +6,7 @@ from datetime import datetime, timedelta
 from matplotlib.dates import date2num, num2date
 import numpy as np
 from subprocess import check_call
+from core import acquisitionsupport as acs
 
 # Twisted
 from twisted.protocols.basic import LineReceiver
@@ -50,16 +51,7 @@ if call:
             # for the POS-1 magnetometer, '\r' for the envir. sensor.
             # (Note: required for POS-1 because readline() cannot detect    
             # a linebreak and reads a never-ending line.)
-            ser_str = ''
-            timeout = time.time()+15
-            while True:
-                char = ser.read()
-                if char == eol:
-                    break
-                if time.time() > timeout:
-                    break
-                ser_str += char
-            return ser_str
+            return acs.lineread(ser,eol,timelimit=15)
 
         def hexify_command(self, command,eol):
             # FUNCTION 'HEXIFY_COMMAND'
@@ -26,6 +26,7 @@ import sys, time, os, socket
 import sys, time, os, socket
 import struct, binascii, re, csv
 from datetime import datetime, timedelta
+from core.frameparser import StartTagFrameParser
 
 # Twisted
 from twisted.protocols.basic import LineReceiver
@@ -51,8 +52,8 @@ class LemiProtocol(LineReceiver):
     def __init__(self, wsMcuFactory, sensor, soltag, outputdir):
         self.wsMcuFactory = wsMcuFactory
         self.sensor = sensor
-        self.buffer = ''
         self.soltag = soltag 	# Start-of-line-tag
+        self.parser = StartTagFrameParser(soltag, 153)
         self.hostname = socket.gethostname()
         self.outputdir = outputdir
         self.gpsstate1 = 'A'
@@ -234,75 +235,12 @@ class LemiProtocol(LineReceiver):
         """            
 
         try:
-            if (self.buffer).startswith(self.soltag) and len(self.buffer) == 153:
-                currdata = self.buffer
-                self.buffer = ''
-                evt1,evt3,evt4,evt11,evt12,evt13,evt31,evt32,evt60,evt99 = self.processLemiData(currdata)
+            for frame in self.parser.feed(data):
+                evt1,evt3,evt4,evt11,evt12,evt13,evt31,evt32,evt60,evt99 = self.processLemiData(frame.tobytes())
                 WSflag = 2
-
-            ### Note: this code for fixing data is more complex than the POS fix code
-            ### due to the LEMI device having a start code rather than an EOL code.
-            ### It can handle and deal with multiple errors:
-            ###  - multiple data parts arriving at once
-            ###  - databits being lost. Bad string is then deleted.
-            ###  - bad bits infiltrating the data. Bad string is deleted.
-
-            if len(self.buffer) > 153:
-                if debug:
-                    log.msg('LEMI - Protocol: Warning: Bufferlength (%s) exceeds 153 characters, fixing...' % len(self.buffer))
-                lemisearch = (self.buffer).find(self.soltag)
-                #print '1', lemisearch
-                if (self.buffer).startswith(self.soltag):
-                    datatest = len(self.buffer)%153
-                    dataparts = int(len(self.buffer)/153)
-                    if datatest == 0:
-                        if debug:
-                            log.msg('LEMI - Protocol: It appears multiple parts came in at once, # of parts:', dataparts)
-                        for i in range(dataparts):
-                            split_data_string = self.buffer[0:153]
-                            if (split_data_string).startswith(self.soltag):
-                                if debug:
-                                    log.msg('LEMI - Protocol: Processing data part # %s in string...' % (str(i+1)))
-                                evt1,evt3,evt4,evt11,evt12,evt13,evt31,evt32,evt60,evt99 = self.processLemiData(split_data_string)
-                                WSflag = 2
-                                self.buffer = self.buffer[153:len(self.buffer)]
-                            else:
-                                flag = 1
-                                break
-                    else:
-                        for i in range(dataparts):
-                            lemisearch = (self.buffer).find(self.soltag, 6)
-                            if lemisearch >= 153:
-                                split_data_string = self.buffer[0:153]
-                                evt1,evt3,evt4,evt11,evt12,evt13,evt31,evt32,evt60,evt99 = self.processLemiData(split_data_string)
-                                WSflag = 2
-                                self.buffer = self.buffer[153:len(self.buffer)]
-                            elif lemisearch == -1:
-                                log.msg('LEMI - Protocol: No header found. Deleting buffer.')
-                                self.buffer = ''
-                            else:
-                                log.msg('LEMI - Protocol: String contains bad data (%s bits). Deleting.' % len(self.buffer[:lemisearch]))
-                                self.buffer = self.buffer[lemisearch:len(self.buffer)]
-                                flag = 1
-                                break
-
-                else:
-                    log.msg('LEMI - Protocol: Incorrect header. Attempting to fix buffer... Bufferlength:', len(self.buffer))
-                    lemisearch = (self.buffer).find(self.soltag, 6)
-                    #lemisearch = repr(self.buffer).find(self.soltag)
-                    if lemisearch == -1:
-                        log.msg('LEMI - Protocol: No header found. Deleting buffer.')
-                        self.buffer = ''
-                    else:
-                        log.msg('LEMI - Protocol: Bad data (%s bits) deleted. New bufferlength: %s' % (lemisearch,len(self.buffer)))
-                        self.buffer = self.buffer[lemisearch:len(self.buffer)]
-                        flag = 1
-
-            if flag == 0:
-                self.buffer = self.buffer + data
-
         except:
             log.err('LEMI - Protocol: Error while parsing data.')
+            self.parser.reset()
 
         ## publish event to all clients subscribed to topic
         if WSflag == 2:
@@ -77,6 +77,12 @@ import telepot
 from telepot.loop import MessageLoop
 import sys, getopt
 import glob
+import threading
+from collections import deque
+try:
+    import paho.mqtt.client as mqtt
+except ImportError:
+    mqtt = None
 
 # Relative import of core methods as long as martas is not configured as package
 scriptpath = os.path.dirname(os.path.realpath(__file__))
@@ -415,6 +421,208 @@ def sensors():
     return mesg
 
 
+class LatestValues(object):
+    """
+    DESCRIPTION
+        in-memory cache of the latest values of all sensors. The cache
+        subscribes to the meta, dict and data topics of the local MQTT broker
+        and keeps a rolling window of window seconds for each sensor. Sums
+        and counts of each key are updated with every message, so that means
+        are available without reading buffer files.
+    APPLICATION
+        latest = LatestValues(window=60)
+        latest.start('localhost', 1883, station='wic')
+        valdict = latest.getdata(sensorid='LEMI025_22_0003')
+    """
+    def __init__(self, window=60):
+        self.window = int(window)
+        self.lock = threading.Lock()
+        self.sensors = {}
+        self.client = None
+
+    def start(self, broker='localhost', port=1883, station='', user=None, password=None):
+        if not mqtt:
+            tglogger.warning("paho-mqtt not available - reading data from buffer files")
+            return False
+        self.station = station
+        self.client = mqtt.Client(clean_session=True)
+        if user and password:
+            self.client.username_pw_set(username=user, password=password)
+        self.client.on_connect = self._on_connect
+        self.client.on_message = self._on_message
+        try:
+            self.client.connect_async(broker, int(port), 60)
+            self.client.loop_start()
+        except Exception as e:
+            tglogger.warning("Could not connect to broker {}: {} - reading data from buffer files".format(broker, e))
+            self.client = None
+            return False
+        tglogger.info("Latest value cache subscribing to {}:{}".format(broker, port))
+        return True
+
+    def _on_connect(self, client, userdata, flags, rc):
+        station = self.station if self.station else '+'
+        for topic in ['meta','dict','data']:
+            client.subscribe("{}/+/{}".format(station, topic))
+
+    def _on_message(self, client, userdata, msg):
+        try:
+            payload = msg.payload
+            if not isinstance(payload, str):
+                payload = payload.decode('utf-8')
+            parts = msg.topic.split('/')
+            sensorid, typ = parts[-2], parts[-1]
+            if typ == 'meta':
+                self._meta(sensorid, payload)
+            elif typ == 'dict':
+                self._dict(sensorid, payload)
+            elif typ == 'data':
+                self._data(sensorid, payload)
+        except Exception as e:
+            tglogger.debug("Latest value cache: could not interprete {}: {}".format(msg.topic, e))
+
+    def _meta(self, sensorid, header):
+        header = header.replace(', ',',').replace('deg C','deg')
+        h_elem = header.strip().split()
+        keylist = h_elem[3].strip('[').strip(']').split(',')
+        elemlist = h_elem[4].strip('[').strip(']').split(',')
+        unitlist = h_elem[5].strip('[').strip(']').split(',')
+        multilist = []
+        for el in h_elem[6].strip('[').strip(']').split(','):
+            try:
+                multilist.append(float(el))
+            except ValueError:
+                multilist.append(1.0)
+        with self.lock:
+            entry = self.sensors.get(sensorid)
+            if entry and entry.get('keys') == keylist:
+                return
+            self.sensors[sensorid] = {'keys':keylist, 'elements':elemlist, 'units':unitlist,
+                                      'multipliers':multilist, 'header':{},
+                                      'values':deque(), 'sums':[0.]*len(keylist), 'counts':[0]*len(keylist)}
+
+    def _dict(self, sensorid, payload):
+        with self.lock:
+            entry = self.sensors.get(sensorid)
+            if not entry:
+                return
+            for elem in payload.split(','):
+                keyvaluespair = elem.split(':')
+                if len(keyvaluespair) > 1 and not keyvaluespair[1].strip() in ['-','']:
+                    entry['header'][keyvaluespair[0]] = keyvaluespair[1].strip()
+
+    def _data(self, sensorid, payload):
+        with self.lock:
+            entry = self.sensors.get(sensorid)
+            if not entry:
+                # header not yet received
+                return
+            values, sums, counts = entry['values'], entry['sums'], entry['counts']
+            nkeys = len(entry['keys'])
+            for line in payload.split(';'):
+                row = line.split(',')
+                if len(row) < 7:
+                    continue
+                t = datetime(*[int(el) for el in row[:7]])
+                vals = []
+                for idx in range(nkeys):
+                    try:
+                        val = float(row[idx+7])/entry['multipliers'][idx]
+                    except (IndexError, ValueError, ZeroDivisionError):
+                        val = None
+                    if val is not None and not val == val:
+                        val = None
+                    vals.append(val)
+                    if val is not None:
+                        sums[idx] += val
+                        counts[idx] += 1
+                values.append((t, vals))
+            # remove values outside of the window
+            while values and (values[-1][0]-values[0][0]).total_seconds() > self.window:
+                t, vals = values.popleft()
+                for idx, val in enumerate(vals):
+                    if val is not None:
+                        sums[idx] -= val
+                        counts[idx] -= 1
+
+    def available(self, sensorid, starttime=None, interval=60):
+        """
+        DESCRIPTION
+            True if data of sensorid can be served from the cache, i.e. the
+            newest cached sample is not older than interval seconds
+        """
+        if starttime or interval > self.window or not self.client:
+            return False
+        with self.lock:
+            entry = self.sensors.get(sensorid)
+            if not entry or not entry.get('values'):
+                return False
+            # sensor stopped publishing - read files (or report no data) instead
+            return (datetime.utcnow()-entry.get('values')[-1][0]).total_seconds() <= interval
+
+    def getdata(self, sensorid, interval=60, mean='mean'):
+        """
+        DESCRIPTION
+            return a content dictionary of sensorid as used by getdata
+        """
+        with self.lock:
+            entry = self.sensors.get(sensorid)
+            keys = entry.get('keys')
+            values = entry.get('values')
+            endtime = values[-1][0]
+            if interval == self.window and mean == 'mean':
+                # precomputed running means
+                starttime = values[0][0]
+                results = [su/co if co > 0 else None for su, co in zip(entry['sums'], entry['counts'])]
+            else:
+                starttime = endtime
+                columns = [[] for key in keys]
+                for t, vals in reversed(values):
+                    if (endtime-t).total_seconds() > interval:
+                        break
+                    starttime = t
+                    for idx, val in enumerate(vals):
+                        if val is not None:
+                            columns[idx].append(val)
+                results = [_average(col, mean) for col in columns]
+            contentdict = {'keys':[], 'starttime':starttime, 'endtime':endtime}
+            for idx, key in enumerate(keys):
+                if results[idx] is None:
+                    continue
+                contentdict['keys'].append(key)
+                contentdict[key] = {'value':results[idx], 'unit':entry['units'][idx], 'element':entry['elements'][idx]}
+        return contentdict
+
+    def sensorinfo(self, sensorid):
+        """
+        DESCRIPTION
+            return samplingrate, keys and elements of sensorid or None
+        """
+        with self.lock:
+            entry = self.sensors.get(sensorid)
+            if not self.client or not entry or not len(entry.get('values')) > 1:
+                return None
+            times = [t for t, vals in entry.get('values')]
+            diffs = sorted([(t2-t1).total_seconds() for t1, t2 in zip(times[:-1],times[1:])])
+            samplingrate = diffs[len(diffs)//2]
+            keys = entry['header'].get('SensorKeys', ','.join(entry['keys']))
+            elements = entry['header'].get('SensorElements', ','.join(entry['elements']))
+        return samplingrate, keys, elements
+
+
+def _average(values, mean='mean'):
+    if not values:
+        return None
+    if mean == 'median':
+        values = sorted(values)
+        n = len(values)
+        return (values[(n-1)//2]+values[n//2])/2.
+    return sum(values)/len(values)
+
+
+latestvalues = LatestValues()
+
+
 def _identifySensor(text):
     """
     DESCRIPTION
@@ -485,6 +693,7 @@ def getdata(starttime=None,sensorid=None,interval=60, mean='mean'):
          unit = header.get('unit-'+keystr,'arb')
          return element,unit
 
+    reqtime = starttime
     if not starttime:
         starttime = datetime.utcnow() - timedelta(seconds=interval)
         endtime = None
@@ -496,6 +705,9 @@ def getdata(starttime=None,sensorid=None,interval=60, mean='mean'):
         senslist = [sensorid]
     returndict = {}
     for s in senslist:
+        if latestvalues.available(s, starttime=reqtime, interval=interval):
+            returndict[s] = latestvalues.getdata(s, interval=interval, mean=mean)
+            continue
         contentdict = {}
         try:
             data = read(os.path.join(mqttpath,s,'*'),starttime=starttime,endtime=endtime)
@@ -658,12 +870,15 @@ def sensorstats(sensorid):
     DESCRIPTION:
        details on sensors
     """
-    lf = _latestfile(os.path.join(mqttpath,sensorid,'*'))
-    data = read(lf)
+    info = latestvalues.sensorinfo(sensorid)
+    if not info:
+        lf = _latestfile(os.path.join(mqttpath,sensorid,'*'))
+        data = read(lf)
+        info = (data.samplingrate(), data.header.get('SensorKeys'), data.header.get('SensorElements'))
     mesg = "Sensor info for {}:\n".format(sensorid)
-    mesg += "Samplingrate: {} seconds\n".format(data.samplingrate())
-    mesg += "Keys: {}\n".format(data.header.get('SensorKeys'))
-    mesg += "Elements: {}\n".format(data.header.get('SensorElements'))
+    mesg += "Samplingrate: {} seconds\n".format(info[0])
+    mesg += "Keys: {}\n".format(info[1])
+    mesg += "Elements: {}\n".format(info[2])
     start = datetime.strftime(_latestfile(os.path.join(mqttpath,sensorid,'*'),date=True, latest=False),"%Y-%m-%d")
     end = datetime.strftime(_latestfile(os.path.join(mqttpath,sensorid,'*'),date=True),"%Y-%m-%d")
     if start==end:
@@ -1154,6 +1369,19 @@ if vers=='2':
     bot = telepot.Bot(str(bot_id))
 else:
     bot = telepot.Bot(bot_id)
+if tgpar.purpose in ['martas','Martas','MARTAS'] and not tgconf.get('livecache','True') in ['False','false']:
+    # keep latest values of all sensors in memory - getdata and sensorstats fall back to buffer files
+    try:
+        mqttuser = conf.get('mqttuser','')
+        mqttpwd = None
+        if not mqttuser in ['','-',None,'None'] and tgconf.get('mqttcred'):
+            mqttpwd = mpcred.lc(tgconf.get('mqttcred').strip(),'passwd',path=conf.get('credentialpath',None))
+        latestvalues.window = int(tgconf.get('cachewindow',60))
+        broker = conf.get('broker','localhost').strip()
+        latestvalues.start(broker, conf.get('mqttport',1883), station=conf.get('station','').strip(), user=mqttuser, password=mqttpwd)
+    except Exception as e:
+        tglogger.warning("Could not start latest value cache: {}".format(e))
+
 MessageLoop(bot, handle).run_as_thread()
 tglogger.info('Listening ...')
 
@@ -100,7 +100,24 @@
     };
 
 
+    // batches of messages separated by newlines, either as text or binary (UTF-8) frames
+    wsconnection.binaryType = 'arraybuffer';
+    var utf8decoder = (typeof TextDecoder !== 'undefined') ? new TextDecoder('utf-8') : null;
+
     wsconnection.onmessage = function (e) {
+        var text = e.data;
+        if (typeof text !== 'string') {
+            text = utf8decoder.decode(new Uint8Array(text));
+        }
+        var lines = text.split('\n');
+        for (var l=0; l < lines.length; l++) {
+            if (lines[l].length > 0) {
+                handleMessage({data: lines[l]});
+            }
+        }
+    };
+
+    function handleMessage(e) {
         if (e.data[0] == '#') {
             // header
             // # json
@@ -144,7 +161,7 @@
             }
         }
         // console.log('data from collector: ' + e.data);
-    };
+    }
     wsconnection.onopen = function (){
         console.log('websocket connection open');
     };